@@ -5,11 +5,27 @@
 # License:   MIT, see the LICENSE file for more details
 #
 
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import threading
+import time
 
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
 from functools import total_ordering
+from functools import wraps
+from inspect import isgeneratorfunction
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
 
 
 # Regular expression matching the start of a mail signature.
@@ -24,9 +40,54 @@ REF_RE = re.compile(
     ''', re.VERBOSE
 )
 
+# Regular expression matching a character that cannot be before reference
+# (the same as in REF_RE).
+REF_PREFIX_RE = r'\w|\]|\)'
+
 # Regular expression matching a word.
 WORD_RE = r'[-\w_]+'
 
+# Regular expression matching a bare URL in text, optionally enclosed in angle
+# brackets (<http://www.url.com>).
+URL_RE = re.compile(
+    r'''
+    (?<![\w/])                     # What cannot be before URL.
+    (<)?                           # Optional opening angle bracket.
+    ((?:https?|ftp)://[^\s<>"]+)   # URL.
+    (?(1)>)                        # Closing angle bracket if it was opened.
+    ''', re.VERBOSE
+)
+
+# Characters that are not considered to be part of a URL at its end.
+URL_TRAILING_CHARS = '.,;:!?\'"'
+
+# Query parameters that only track where a link was clicked. They are ignored
+# when URLs are compared.
+TRACKING_PARAMS = (
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'fbclid', 'gclid'
+)
+
+# Number of canonical forms of URLs that are remembered.
+CANONICAL_URLS_CACHE_SIZE = 4096
+
+# Version of the format of indexes cached on disk. Cached indexes with another
+# version are ignored.
+INDEX_CACHE_VERSION = 1
+
+# Maximal total size of indexes cached on disk (in bytes). When it is exceeded,
+# the least recently used indexes are removed.
+INDEX_CACHE_SIZE_LIMIT = 8 * 1024 * 1024
+
+# Names of files with cached indexes (see _get_index_cache_path()). Other files
+# in the cache directory are never removed.
+INDEX_CACHE_NAME_RE = re.compile(r'^[0-9a-f]{40}\.json$')
+
+# Minimal number of lines of a buffer that is scanned for references in
+# parallel (see set_scan_workers()). Smaller buffers are scanned faster than
+# they are sent to other processes.
+PARALLEL_SCAN_MIN_LINES = 50000
+
 
 @total_ordering
 class Ref:
@@ -71,53 +132,1391 @@ class RefWithUrl(namedtuple('RefWithUrl', ['ref', 'url'])):
         return cls(ref=Ref(int(m.group(1))), url=m.group(2))
 
 
-def add_ref(buffer, cursor, ref_or_url):
+# A single reference in the mail body, located at buffer[row][start:end].
+RefOccurrence = namedtuple('RefOccurrence', ['row', 'start', 'end', 'ref'])
+
+# Problems with references in a buffer:
+# - dangling: occurrences of references that have no URL,
+# - unused: (row, ref_with_url) for URLs that are not referenced.
+RefDiagnostics = namedtuple('RefDiagnostics', ['dangling', 'unused'])
+
+# Statistics of references in a buffer:
+# - total: number of references in the mail body,
+# - used: number of distinct references in the mail body,
+# - defined: number of URLs in the reference list,
+# - dangling: number of distinct references without a URL,
+# - needs_renumbering: whether references are not numbered by their position.
+RefStats = namedtuple(
+    'RefStats',
+    ['total', 'used', 'defined', 'dangling', 'needs_renumbering']
+)
+
+
+class RefIndex:
+    '''Positions of references and of the reference list in a buffer.
+
+    The index is built in a single pass over a snapshot of the buffer (a list
+    of lines). When scanned_rows (ScannedRows) is given, only rows that were
+    not scanned yet are read and scanned. Rows and columns are zero-based and
+    relative to the whole buffer, including the signature.
+    '''
+
+    def __init__(self, lines, scanned_rows=None):
+        if scanned_rows is None:
+            scanned_rows = ScannedRows(len(lines))
+        body_end = scanned_rows.get_signature_start(lines)
+        ref_list_start, ref_list_end = _get_ref_list_bounds(lines, body_end)
+        self._init_layout(
+            line_count=len(lines),
+            body_end=body_end,
+            ref_list_start=ref_list_start,
+            ref_list_end=ref_list_end,
+            refs_with_urls=[
+                RefWithUrl.from_str(line)
+                for line in lines[ref_list_start:ref_list_end]
+            ],
+            occurrences=scanned_rows.get_occurrences(lines, 0, ref_list_start)
+        )
+
+    @classmethod
+    def from_layout(cls, line_count, body_end, ref_list_start, ref_list_end,
+                    refs_with_urls, occurrences):
+        '''Creates an index from already parsed layout of a buffer (e.g. an
+        index cached on disk) without scanning its lines.
+        '''
+        index = cls.__new__(cls)
+        index._init_layout(
+            line_count, body_end, ref_list_start, ref_list_end,
+            refs_with_urls, occurrences
+        )
+        return index
+
+    @classmethod
+    def from_matches(cls, lines, matches, signature_start=None):
+        '''Creates an index from references found by another scanner (e.g. by
+        matchbufline() in Vim), reading only the lines at the end of the mail
+        body (the reference list).
+
+        matches are (row, start, end, text, prefix) of all matches of
+        references in lines, where text is the reference ([1]) and prefix is
+        the character before it ('' at the start of a line).
+        signature_start is the row where the signature starts (None when
+        there is no signature).
+        '''
+        body_end = len(lines) if signature_start is None else signature_start
+        ref_list_start, ref_list_end = _get_ref_list_bounds(lines, body_end)
+        occurrences = [
+            RefOccurrence(row, start, end, Ref.from_str(text))
+            for row, start, end, text, prefix in sorted(matches)
+            if row < ref_list_start and not re.match(REF_PREFIX_RE, prefix)
+        ]
+        return cls.from_layout(
+            line_count=len(lines),
+            body_end=body_end,
+            ref_list_start=ref_list_start,
+            ref_list_end=ref_list_end,
+            refs_with_urls=[
+                RefWithUrl.from_str(line)
+                for line in lines[ref_list_start:ref_list_end]
+            ],
+            occurrences=occurrences
+        )
+
+    def _init_layout(self, line_count, body_end, ref_list_start, ref_list_end,
+                     refs_with_urls, occurrences):
+        self.line_count = line_count
+        self.body_end = body_end
+        self.ref_list_start = ref_list_start
+        self.ref_list_end = ref_list_end
+        self.refs_with_urls = refs_with_urls
+        self.occurrences = occurrences
+        self.urls = {ref.number: url for ref, url in self.refs_with_urls}
+        self.ref_rows = {
+            ref.number: self.ref_list_start + i
+            for i, (ref, url) in enumerate(self.refs_with_urls)
+        }
+        self.usages = _get_ref_occurrences_by_number(self.occurrences)
+        self._rows = _get_ref_occurrences_by_row(self.occurrences)
+        self._positions = [(o.row, o.start) for o in self.occurrences]
+        self._max_numbers = _get_running_max_numbers(self.occurrences)
+        self.max_number = max(
+            list(self.urls) + list(self.usages), default=0
+        )
+        self._stats = None
+
+    def get_ref_at(self, row, col):
+        '''Returns the occurrence of a reference at the given position in the
+        mail body, or None if there is no reference.
+        '''
+        row_occurrences = self._rows.get(row)
+        if row_occurrences is None:
+            return None
+        starts, occurrences = row_occurrences
+        i = bisect_right(starts, col) - 1
+        if i < 0 or col >= occurrences[i].end:
+            return None
+        return occurrences[i]
+
+    def get_occurrences_in_rows(self, start_row, end_row):
+        '''Returns occurrences of references in rows [start_row, end_row).'''
+        i = bisect_left(self._positions, (start_row, 0))
+        j = bisect_left(self._positions, (end_row, 0))
+        return self.occurrences[i:j]
+
+    def get_max_number_before(self, row, col):
+        '''Returns the highest number of a reference that occurs before the
+        given position in the mail body (0 if there is no such reference).
+        '''
+        i = bisect_left(self._positions, (row, col))
+        return self._max_numbers[i - 1] if i > 0 else 0
+
+    def get_ref_number_at(self, row, col):
+        '''Returns the number of the reference at the given position, either in
+        the mail body or in the reference list, or None if there is none.
+        '''
+        if self.ref_list_start <= row < self.ref_list_end:
+            return self.refs_with_urls[row - self.ref_list_start].ref.number
+        occurrence = self.get_ref_at(row, col)
+        if occurrence is None:
+            return None
+        return occurrence.ref.number
+
+    def get_diagnostics(self):
+        '''Returns RefDiagnostics of the buffer.'''
+        dangling = [
+            occurrence for occurrence in self.occurrences
+            if occurrence.ref.number not in self.urls
+        ]
+        unused = [
+            (self.ref_rows[ref.number], RefWithUrl(ref, url))
+            for ref, url in self.refs_with_urls
+            if ref.number not in self.usages
+        ]
+        return RefDiagnostics(dangling, unused)
+
+    def get_stats(self):
+        '''Returns RefStats of the buffer.
+
+        The statistics are computed only once per index.
+        '''
+        if self._stats is None:
+            self._stats = RefStats(
+                total=len(self.occurrences),
+                used=len(self.usages),
+                defined=len(self.refs_with_urls),
+                dangling=sum(
+                    1 for number in self.usages if number not in self.urls
+                ),
+                needs_renumbering=self._needs_renumbering()
+            )
+        return self._stats
+
+    def _needs_renumbering(self):
+        # Usages are ordered by the first appearance of references.
+        for expected, number in enumerate(self.usages, start=1):
+            if number != expected:
+                return True
+        numbers = [ref.number for ref, url in self.refs_with_urls]
+        return numbers != sorted(numbers)
+
+    def get_url_at(self, row, col):
+        '''Returns the URL of the reference at the given position in the mail
+        body, or None if there is no reference or it has no URL.
+        '''
+        occurrence = self.get_ref_at(row, col)
+        if occurrence is None:
+            return None
+        return self.urls.get(occurrence.ref.number)
+
+    def get_jump_target(self, row, col):
+        '''Returns the position of the counterpart of the reference at the
+        given position (see get_ref_jump_target()), or None.
+        '''
+        number = self.get_ref_number_at(row, col)
+        if number is None:
+            return None
+
+        if self.ref_list_start <= row < self.ref_list_end:
+            usages = self.usages.get(number)
+            if not usages:
+                return None
+            return usages[0].row, usages[0].start
+
+        if number not in self.ref_rows:
+            return None
+        return self.ref_rows[number], 0
+
+    def get_usages(self, row, col):
+        '''Returns (number, positions) for the reference at the given position
+        (see get_ref_usages()).
+        '''
+        number = self.get_ref_number_at(row, col)
+        if number is None:
+            return None, []
+        return number, [
+            (occurrence.row, occurrence.start)
+            for occurrence in self.usages.get(number, [])
+        ]
+
+
+class ScannedRows:
+    '''References (and signature delimiters) found in rows of a buffer.
+
+    Rows are scanned on first use and the results are kept until the rows are
+    replaced (see replace_rows()), so after a change of the buffer, only the
+    changed rows are scanned again.
+    '''
+
+    def __init__(self, line_count):
+        # Row -> (refs, is_signature_start), or None when not scanned yet.
+        self._rows = [None] * line_count
+
+    def replace_rows(self, start, end, count):
+        '''Forgets rows [start, end), which were replaced by count rows.'''
+        self._rows[start:end] = [None] * count
+
+    def get_signature_start(self, lines):
+        '''Returns the row where the signature starts (len(lines) if there is
+        no signature).
+        '''
+        self._check_line_count(lines)
+        for row in range(len(lines) - 1, -1, -1):
+            if self._get_row(lines, row)[1]:
+                return row
+        return len(lines)
+
+    def get_occurrences(self, lines, start_row, end_row):
+        '''Returns all references in lines[start_row:end_row] in the order of
+        their appearance.
+        '''
+        self._check_line_count(lines)
+        occurrences = []
+        for row in range(start_row, end_row):
+            for start, end, ref in self._get_row(lines, row)[0]:
+                occurrences.append(RefOccurrence(row, start, end, ref))
+        return occurrences
+
+    def seed(self, lines, index):
+        '''Fills in rows of the mail body from an index of lines that was not
+        built from these rows (e.g. loaded from the cache), so that they do
+        not have to be scanned after a change of the buffer.
+
+        Only the start of the signature is looked for in the lines. Rows from
+        the reference list on are scanned on first use.
+        '''
+        self._check_line_count(lines)
+        refs = [[] for _ in range(index.ref_list_start)]
+        for occurrence in index.occurrences:
+            refs[occurrence.row].append(
+                (occurrence.start, occurrence.end, occurrence.ref)
+            )
+        for row in range(index.ref_list_start):
+            line = lines[row]
+            is_signature_start = line.startswith('--') and \
+                re.match(SIGNATURE_START_RE, line) is not None
+            self._rows[row] = (tuple(refs[row]), is_signature_start)
+
+    def _get_row(self, lines, row):
+        scanned = self._rows[row]
+        if scanned is None:
+            line = lines[row]
+            scanned = (
+                _get_refs_in_line(line),
+                re.match(SIGNATURE_START_RE, line) is not None
+            )
+            self._rows[row] = scanned
+        return scanned
+
+    def _check_line_count(self, lines):
+        # A change was not reported, so nothing can be trusted.
+        if len(self._rows) != len(lines):
+            self._rows = [None] * len(lines)
+
+
+# Cached indexes of buffers: buffer key -> (changedtick, RefIndex).
+_ref_indexes = {}
+
+# Indexes being built in the background: buffer key -> (changedtick, future).
+_pending_ref_indexes = {}
+
+# Scanned rows of buffers whose changes are reported: buffer key ->
+# ScannedRows.
+_scanned_rows = {}
+
+# Executor building indexes in the background (created on first use).
+_prewarm_executor = None
+
+# Number of processes scanning large buffers (0 when they are not used).
+_scan_workers = 0
+
+# Executor scanning chunks of large buffers (created by set_scan_workers()).
+_scan_executor = None
+
+# Query parameters that are ignored when URLs are compared.
+_tracking_params = frozenset(TRACKING_PARAMS)
+
+# Names of functions whose calls are recorded when tracing is enabled.
+_traced_functions = []
+
+# Functions replaced by their traced versions while tracing: name -> function.
+_untraced_functions = {}
+
+# Recorded events in the Chrome trace-event format (None when not tracing).
+_trace_events = None
+
+
+def _traced(func):
+    '''Marks a phase of a command whose calls are recorded by start_tracing().
+
+    The function itself is not changed, so phases cost nothing when tracing
+    is disabled.
+    '''
+    _traced_functions.append(func.__name__)
+    return func
+
+
+@_traced
+def add_ref(buffer, cursor, ref_or_url, ordered=False, changedtick=None,
+            index=None):
     '''Adds a reference into the buffer.
 
     If ref_or_url is a URL, it adds a reference to this URL into the current
     cursor position in the mail body, including adding the URL to the end of
     the buffer. Otherwise, if ref_or_url is a reference, it adds this reference
     into the current cursor position in the mail body.
+
+    By default, a new URL gets the next unused number. If ordered is True, it
+    gets the number following the references before the cursor and all
+    references with the same or a higher number are renumbered (only lines
+    with such references are changed).
+
+    If index (a RefIndex of the buffer) is given, it is used for ordered
+    numbering instead of get_ref_index().
     '''
     row, col = cursor
+    if ordered and index is None:
+        index = get_ref_index(buffer, changedtick)
     with _removed_signature(buffer):
         _remove_trailing_empty_lines(buffer)
-        ref = _get_or_create_ref(buffer, ref_or_url)
+        if ordered:
+            ref, col = _get_or_create_ordered_ref(
+                buffer, index, row, col, ref_or_url
+            )
+        else:
+            ref = _get_or_create_ref(buffer, ref_or_url)
         row, col = _insert_ref(buffer, row, col, ref)
     return row, col
 
 
-def get_refs_with_urls_for_menu(buffer):
+@_traced
+def remove_ref(buffer, cursor, changedtick=None, index=None):
+    '''Removes the reference at the cursor from the buffer.
+
+    If the cursor is on a reference in the mail body, this reference is
+    removed. If the cursor is on the reference list, the URL and all its
+    references are removed. When a reference is no longer used, its URL is
+    removed and references with higher numbers are renumbered to fill the gap
+    (only lines with such references are changed).
+
+    If index (a RefIndex of the buffer) is given, it is used instead of
+    get_ref_index().
+    '''
+    if index is None:
+        index = get_ref_index(buffer, changedtick)
+    row, col = cursor
+    number = index.get_ref_number_at(row, col)
+    if number is None:
+        return row, col
+
+    usages = index.usages.get(number, [])
+    if index.ref_list_start <= row < index.ref_list_end:
+        removed = usages
+    else:
+        removed = [index.get_ref_at(row, col)]
+
+    changes = {}
+    if len(removed) == len(usages):
+        changes = _get_shift_changes(index, number + 1, -1)
+    for occurrence in removed:
+        start = occurrence.start
+        # Remove also the space that separates the reference from the text.
+        if start > 0 and buffer[occurrence.row][start - 1] == ' ':
+            start -= 1
+        changes.setdefault(occurrence.row, []).append(
+            (start, occurrence.end, '')
+        )
+        if occurrence.row == row:
+            col = _get_moved_col(changes[row], start)
+
+    with _removed_signature(buffer):
+        _remove_trailing_empty_lines(buffer)
+        _apply_line_changes(buffer, changes)
+        if len(removed) == len(usages):
+            _remove_from_ref_list(buffer, index, number)
+            _remove_trailing_empty_lines(buffer)
+    return _put_cursor_at_valid_pos(buffer, (row, col))
+
+
+def get_refs_with_urls_for_menu(buffer, changedtick=None):
     '''Returns a list of references with URLs to be used when generating a menu.
 
     Each reference with a URL is a string of a following form:
 
         [1] http://www.url.com
+
+    When changedtick is given, the references are taken from the (possibly
+    prewarmed) index of the buffer.
     '''
-    with _removed_signature(buffer):
-        refs_with_urls = _get_refs_with_urls(buffer)
+    if changedtick is not None:
+        refs_with_urls = get_ref_index(buffer, changedtick).refs_with_urls
+    else:
+        with _removed_signature(buffer):
+            refs_with_urls = _get_refs_with_urls(buffer)
 
     return [
         '{} {}'.format(str(ref), url) for ref, url in refs_with_urls
     ]
 
 
-def fix_mail_refs(buffer, cursor):
+@_traced
+def fix_mail_refs(buffer, cursor, line_range=None, changedtick=None,
+                  index=None):
     '''Normalizes all references used in the buffer.
 
     The following normalizations are performed:
+    - references to equivalent URLs (see canonicalize_url()) are merged
     - unused references are removed
     - references are renumbered by their position in the buffer ([1], [2], ...)
+
+    If line_range (start_row, end_row) is given, only references used in these
+    rows are renumbered by their position, among the numbers they already
+    have, and unused references are kept. The reference list and other uses
+    of the renumbered references are updated accordingly.
+
+    If index (a RefIndex of the buffer) is given, it is used instead of
+    get_ref_index() or scanning the buffer.
     '''
-    with _removed_signature(buffer):
-        _remove_trailing_empty_lines(buffer)
-        _remove_unused_refs_with_urls(buffer)
-        _remove_trailing_empty_lines(buffer)
-        _renumber_refs(buffer)
-    row, col = _put_cursor_at_valid_pos(buffer, cursor)
-    return row, col
+    if line_range is not None:
+        return _fix_mail_refs_in_range(
+            buffer, cursor, line_range, changedtick, index
+        )
+
+    if index is None:
+        index = _get_built_ref_index(buffer, changedtick)
+    if index is not None:
+        # The index may have been built from matches found outside of Python
+        # (see index_ref_matches()), so lines of the mail body are read only
+        # when their references change.
+        _renumber_refs(
+            buffer, index.ref_list_start, index.body_end,
+            index.refs_with_urls,
+            [(o.row, o.start, o.end, o.ref.number) for o in index.occurrences],
+            list(index.usages)
+        )
+        return _put_cursor_at_valid_pos(buffer, cursor)
+
+    body_end = _get_signature_start(buffer)
+    ref_list_start, ref_list_end = _get_ref_list_bounds(buffer, body_end)
+    refs_with_urls = [
+        RefWithUrl.from_str(line)
+        for line in buffer[ref_list_start:ref_list_end]
+    ]
+    # The mail body is scanned only once, both for used references and for
+    # their order.
+    occurrences, numbers = _scan_refs(buffer[:ref_list_start])
+    _renumber_refs(
+        buffer, ref_list_start, body_end, refs_with_urls, occurrences, numbers
+    )
+    return _put_cursor_at_valid_pos(buffer, cursor)
+
+
+@_traced
+def check_mail_refs(buffer, line_range=None, changedtick=None):
+    '''Returns a list of problems with references in the buffer.
+
+    Each problem is a tuple (row, col, message). The following problems are
+    reported:
+    - references without a URL,
+    - URLs that are not used (only when line_range is not given).
+
+    If line_range (start_row, end_row) is given, only these rows are scanned
+    for references.
+    '''
+    if line_range is None:
+        dangling, unused = get_ref_diagnostics(buffer, changedtick)
+    else:
+        start_row, end_row = line_range
+        ref_list_start, ref_list_end, refs_with_urls = _get_ref_list(buffer)
+        defined_refs = set(ref for ref, url in refs_with_urls)
+        dangling = [
+            occurrence
+            for occurrence in _get_ref_occurrences(
+                buffer, start_row, min(end_row, ref_list_start)
+            )
+            if occurrence.ref not in defined_refs
+        ]
+        unused = []
+
+    problems = [
+        (occurrence.row, occurrence.start,
+            'reference {} has no URL'.format(occurrence.ref))
+        for occurrence in dangling
+    ]
+    problems.extend(
+        (row, 0, 'URL {} is not used'.format(ref_with_url.ref))
+        for row, ref_with_url in unused
+    )
+    return problems
 
 
+@_traced
+def extract_mail_refs(buffer, cursor):
+    '''Replaces all bare URLs in the mail body with references.
+
+    URLs that are already in the reference list (or that occur several times)
+    get the same reference. The buffer is updated by a single edit.
+    '''
+    lines = buffer[:]
+    index = RefIndex(lines)
+    get_ref_for_url, new_refs_with_urls = _get_ref_allocator(index)
+
+    row, col = cursor
+    new_lines = lines[:index.ref_list_start]
+    for i, line in enumerate(new_lines):
+        new_line, new_col = _replace_urls_with_refs(
+            line, col if i == row else None, get_ref_for_url
+        )
+        new_lines[i] = new_line
+        if i == row:
+            col = new_col
+
+    if not new_refs_with_urls:
+        # All URLs are already in the reference list.
+        new_lines.extend(lines[index.ref_list_start:])
+        _commit_lines(buffer, lines, new_lines)
+        return _put_cursor_at_valid_pos(buffer, (row, col))
+
+    _extend_ref_list(new_lines, lines, index, new_refs_with_urls)
+    _commit_lines(buffer, lines, new_lines)
+    return _put_cursor_at_valid_pos(buffer, (row, col))
+
+
+@_traced
+def paste_mail_refs(buffer, cursor, pasted_lines, changedtick=None,
+                    index=None):
+    '''Pastes lines with their own references below the cursor line.
+
+    The pasted lines may end with their own reference list. References in the
+    pasted text are renumbered to the references of the same URLs in the
+    buffer, and URLs that are not in the buffer yet get new references that
+    are added to the reference list. References without a URL are pasted as
+    they are. The buffer is updated by a single edit.
+
+    If index (a RefIndex of the buffer) is given, it is used instead of
+    get_ref_index().
+
+    Returns the position of the start of the pasted text.
+    '''
+    lines = buffer[:]
+    if index is None:
+        index = get_ref_index(buffer, changedtick)
+    get_ref_for_url, new_refs_with_urls = _get_ref_allocator(index)
+
+    pasted_start, pasted_end = _get_ref_list_bounds(
+        pasted_lines, len(pasted_lines)
+    )
+    ref_map = {}
+    for ref, url in (
+            RefWithUrl.from_str(line)
+            for line in pasted_lines[pasted_start:pasted_end]):
+        # Only the first URL of a reference is used. The next ones must not
+        # get new references (get_ref_for_url() adds them to the list).
+        if ref not in ref_map:
+            ref_map[ref] = get_ref_for_url(url)
+
+    pasted_body = [
+        _replace_refs_in_line(line, ref_map)
+        for line in pasted_lines[:pasted_start]
+    ]
+    while pasted_body and not pasted_body[-1]:
+        pasted_body.pop()
+    if not pasted_body:
+        return _put_cursor_at_valid_pos(buffer, cursor)
+
+    # Text is pasted below the cursor line, but always into the mail body.
+    row = cursor[0] + 1
+    if index.refs_with_urls:
+        row = max(min(row, index.ref_list_start - 1), 0)
+    else:
+        row = min(row, index.ref_list_start)
+
+    new_lines = lines[:row] + pasted_body + lines[row:index.ref_list_start]
+    if new_refs_with_urls:
+        _extend_ref_list(new_lines, lines, index, new_refs_with_urls)
+    else:
+        new_lines.extend(lines[index.ref_list_start:])
+    _commit_lines(buffer, lines, new_lines)
+    return row, 0
+
+
+def canonicalize_url(url, tracking_params=None):
+    '''Returns the canonical form of the URL, used to compare URLs.
+
+    The scheme and host are lowercased, trailing slashes are removed from the
+    path and so are query parameters from tracking_params (the parameters set
+    by set_tracking_params() by default). Strings that are not URLs are
+    returned unchanged.
+    '''
+    if tracking_params is None:
+        tracking_params = _tracking_params
+    return _canonicalize_url(url, frozenset(tracking_params))
+
+
+def set_tracking_params(params):
+    '''Sets the query parameters that are ignored when URLs are compared.'''
+    global _tracking_params
+    _tracking_params = frozenset(params)
+
+
+def set_scan_workers(workers):
+    '''Sets the number of processes that scan large buffers for references
+    when all references are fixed (see fix_mail_refs()).
+
+    Buffers with at least PARALLEL_SCAN_MIN_LINES lines are split into chunks
+    of lines that are scanned in parallel. With fewer than 2 workers, all
+    buffers are scanned in the calling thread.
+
+    The processes are not forked from the calling process, which may already
+    run other threads, but started by a fork server (or spawned where there
+    is none). Call this function at startup, before any other threads are
+    started, as the executor is created here.
+    '''
+    global _scan_workers, _scan_executor
+
+    if _scan_executor is not None:
+        _scan_executor.shutdown()
+        _scan_executor = None
+    _scan_workers = workers
+    if workers >= 2:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        _scan_executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=context
+        )
+
+
+def get_lines_edit(old_lines, new_lines):
+    '''Returns [start, end, lines] such that replacing old_lines[start:end]
+    with lines results in new_lines, or None when there is no change.
+    '''
+    if old_lines == new_lines:
+        return None
+
+    start = 0
+    max_start = min(len(old_lines), len(new_lines))
+    while start < max_start and old_lines[start] == new_lines[start]:
+        start += 1
+
+    old_end, new_end = len(old_lines), len(new_lines)
+    while old_end > start and new_end > start and \
+            old_lines[old_end - 1] == new_lines[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    return [start, old_end, new_lines[start:new_end]]
+
+
+@_traced
+def get_ref_index(buffer, changedtick=None):
+    '''Returns a RefIndex of the buffer.
+
+    When changedtick (b:changedtick in Vim) is given and the buffer has a
+    number (a Vim buffer), the index is cached and reused until changedtick
+    changes.
+    '''
+    key = _get_buffer_key(buffer)
+    if changedtick is None or key is None:
+        return RefIndex(buffer[:])
+    scanned_rows = _scanned_rows.get(key)
+
+    cached = _ref_indexes.get(key)
+    if cached is not None and cached[0] == changedtick:
+        return cached[1]
+
+    pending = _pending_ref_indexes.pop(key, None)
+    if pending is not None and pending[0] == changedtick:
+        # The index is being built in the background, so just wait for it.
+        index = pending[1].result()
+    elif scanned_rows is not None:
+        # Only rows that have changed are read from the buffer.
+        index = RefIndex(buffer, scanned_rows)
+    else:
+        index = RefIndex(buffer[:])
+    _ref_indexes[key] = (changedtick, index)
+    return index
+
+
+def prewarm_ref_index(buffer, changedtick):
+    '''Starts building the index of the buffer in a background thread.
+
+    Only a snapshot of the lines is taken here. The index is built from the
+    snapshot without accessing the buffer, so it is safe to do so outside of
+    Vim's main loop. The next get_ref_index() with the same changedtick uses
+    the result.
+    '''
+    global _prewarm_executor
+
+    key = _get_buffer_key(buffer)
+    if key is None:
+        return
+    cached = _ref_indexes.get(key)
+    if cached is not None and cached[0] == changedtick:
+        return
+    pending = _pending_ref_indexes.get(key)
+    if pending is not None and pending[0] == changedtick:
+        return
+
+    if _prewarm_executor is None:
+        _prewarm_executor = ThreadPoolExecutor(max_workers=1)
+    future = _prewarm_executor.submit(RefIndex, buffer[:])
+    _pending_ref_indexes[key] = (changedtick, future)
+
+
+def track_rows(buffer):
+    '''Starts keeping scanned rows of the buffer between its changes, so that
+    get_ref_index() scans only changed rows.
+
+    From now on, every change of the buffer has to be reported by
+    replace_rows().
+    '''
+    key = _get_buffer_key(buffer)
+    if key is not None:
+        _scanned_rows[key] = ScannedRows(len(buffer))
+
+
+def replace_rows(buffer, start, end, count):
+    '''Reports that rows [start, end) of the buffer were replaced by count
+    rows (see track_rows()).
+    '''
+    scanned_rows = _scanned_rows.get(_get_buffer_key(buffer))
+    if scanned_rows is not None:
+        scanned_rows.replace_rows(start, end, count)
+
+
+def forget_ref_index(buffer_key):
+    '''Drops the cached index and scanned rows of the buffer with the given
+    key (the buffer number in Vim).
+    '''
+    _ref_indexes.pop(buffer_key, None)
+    _pending_ref_indexes.pop(buffer_key, None)
+    _scanned_rows.pop(buffer_key, None)
+
+
+@_traced
+def index_ref_matches(buffer, changedtick, matches, signature_start=None):
+    '''Builds the index of the buffer from references found outside of Python
+    (see RefIndex.from_matches()) and caches it, so that the next
+    get_ref_index() with the same changedtick uses it.
+
+    Only the lines of the reference list are read from the buffer, so the
+    cost does not depend on the number of lines without references.
+    '''
+    index = RefIndex.from_matches(buffer, matches, signature_start)
+    key = _get_buffer_key(buffer)
+    if key is not None:
+        _ref_indexes[key] = (changedtick, index)
+    return index
+
+
+def load_ref_index(buffer, changedtick, path, cache_dir=None):
+    '''Loads the index of the buffer cached on disk by save_ref_index(), so
+    that the next get_ref_index() with the same changedtick does not have to
+    build it.
+
+    path is the path of the file edited in the buffer. The cached index is
+    used only when it was saved for the same path and the same lines. Returns
+    True when the index was loaded.
+    '''
+    key = _get_buffer_key(buffer)
+    if key is None:
+        return False
+    lines = buffer[:]
+    index = read_cached_ref_index(lines, path, cache_dir)
+    if index is None:
+        return False
+    _ref_indexes[key] = (changedtick, index)
+    scanned_rows = _scanned_rows.get(key)
+    if scanned_rows is not None:
+        # Otherwise, the first change of the buffer would scan all its rows.
+        scanned_rows.seed(lines, index)
+    return True
+
+
+def save_ref_index(buffer, changedtick, path, cache_dir=None):
+    '''Saves the index of the buffer to the cache on disk (see
+    load_ref_index()).
+    '''
+    write_cached_ref_index(
+        get_ref_index(buffer, changedtick), buffer[:], path, cache_dir
+    )
+
+
+def read_cached_ref_index(lines, path, cache_dir=None):
+    '''Returns the index of lines of the file with the given path cached in
+    cache_dir (the default cache directory when None), or None when there is
+    no valid cached index.
+    '''
+    cache_path = _get_index_cache_path(path, cache_dir)
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or \
+            data.get('version') != INDEX_CACHE_VERSION or \
+            data.get('path') != path or \
+            data.get('hash') != _get_lines_hash(lines):
+        return None
+
+    try:
+        index = _load_ref_index(data['index'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    # Mark the index as recently used.
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return index
+
+
+def write_cached_ref_index(index, lines, path, cache_dir=None,
+                           size_limit=INDEX_CACHE_SIZE_LIMIT):
+    '''Caches the index of lines of the file with the given path in cache_dir
+    (the default cache directory when None).
+
+    When the total size of cached indexes exceeds size_limit, the least
+    recently used ones are removed.
+    '''
+    if cache_dir is None:
+        cache_dir = _get_default_cache_dir()
+    cache_path = _get_index_cache_path(path, cache_dir)
+    data = {
+        'version': INDEX_CACHE_VERSION,
+        'path': path,
+        'hash': _get_lines_hash(lines),
+        'index': _dump_ref_index(index),
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write into a temporary file first, so that a concurrently running Vim
+    # never reads a partially written index.
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _evict_cached_ref_indexes(cache_dir, size_limit)
+
+
+def start_tracing():
+    '''Starts recording durations of commands and their phases (e.g. removal
+    of the signature in add_ref() or renumbering of references in
+    fix_mail_refs()).
+
+    The events are returned by stop_tracing().
+    '''
+    global _trace_events
+
+    if _trace_events is not None:
+        return
+    _trace_events = []
+    module = globals()
+    for name in _traced_functions:
+        func = module[name]
+        _untraced_functions[name] = func
+        module[name] = _get_traced_function(func)
+
+
+def stop_tracing(path=None):
+    '''Stops tracing and returns the recorded events in the Chrome trace-event
+    format.
+
+    When path is given, the trace is also written into this file, which can be
+    loaded in chrome://tracing or https://ui.perfetto.dev.
+    '''
+    global _trace_events
+
+    events = _trace_events or []
+    _trace_events = None
+    globals().update(_untraced_functions)
+    _untraced_functions.clear()
+
+    if path is not None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return events
+
+
+def get_url_at_cursor(buffer, cursor, changedtick=None):
+    '''Returns the URL of the reference at the cursor, or None if there is no
+    reference or it has no URL.
+    '''
+    return get_ref_index(buffer, changedtick).get_url_at(*cursor)
+
+
+def _get_signature_start(lines):
+    '''Returns the row where the signature starts (len(lines) if there is no
+    signature).
+    '''
+    for row in range(len(lines) - 1, -1, -1):
+        line = lines[row]
+        # Most lines are ruled out without running the regular expression.
+        if line.startswith('--') and re.match(SIGNATURE_START_RE, line):
+            return row
+    return len(lines)
+
+
+def _get_ref_list_bounds(lines, body_end):
+    '''Returns (start, end) of the list of references with URLs at the end of
+    the mail body.
+
+    When there is no such list, both start and end point right after the last
+    non-empty line of the mail body.
+    '''
+    end = body_end
+    while end > 0 and not lines[end - 1]:
+        end -= 1
+
+    start = end
+    while start > 0 and RefWithUrl.from_str(lines[start - 1]) is not None:
+        start -= 1
+    return start, end
+
+
+def _get_ref_occurrences(lines, start_row, end_row):
+    '''Returns all references in lines[start_row:end_row] in the order of
+    their appearance.
+    '''
+    occurrences = []
+    for row in range(start_row, end_row):
+        for start, end, ref in _get_refs_in_line(lines[row]):
+            occurrences.append(RefOccurrence(row, start, end, ref))
+    return occurrences
+
+
+def _get_refs_in_line(line):
+    '''Returns (start, end, ref) of all references in the line.'''
+    return tuple(
+        (m.start(1), m.end(1), Ref.from_str(m.group(1)))
+        for m in REF_RE.finditer(line)
+    )
+
+
+def get_ref_diagnostics(buffer, changedtick=None):
+    '''Returns RefDiagnostics with dangling references (references without a
+    URL) and unused URLs in the buffer.
+    '''
+    return get_ref_index(buffer, changedtick).get_diagnostics()
+
+
+def get_ref_stats(buffer, changedtick=None):
+    '''Returns RefStats of the buffer.
+
+    When changedtick is given, the statistics are computed only once per
+    change of the buffer, so it is cheap to call this function repeatedly
+    (e.g. from a statusline).
+    '''
+    return get_ref_index(buffer, changedtick).get_stats()
+
+
+def get_ref_jump_target(buffer, cursor, changedtick=None):
+    '''Returns the position to jump to from the reference at the cursor, or
+    None if there is nowhere to jump.
+
+    From a reference in the mail body, it jumps to its URL in the reference
+    list. From the reference list, it jumps to the first use of the reference.
+    '''
+    return get_ref_index(buffer, changedtick).get_jump_target(*cursor)
+
+
+def get_ref_usages(buffer, cursor, changedtick=None):
+    '''Returns (number, positions) for the reference at the cursor, where
+    positions are (row, col) of all its uses in the mail body.
+
+    When there is no reference at the cursor, (None, []) is returned.
+    '''
+    return get_ref_index(buffer, changedtick).get_usages(*cursor)
+
+
+@lru_cache(maxsize=CANONICAL_URLS_CACHE_SIZE)
+def _canonicalize_url(url, tracking_params):
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    if not parts.scheme or not parts.netloc:
+        return url
+
+    userinfo, at, host = parts.netloc.rpartition('@')
+    query = '&'.join(
+        param for param in parts.query.split('&')
+        if param and param.split('=', 1)[0] not in tracking_params
+    )
+    return urlunsplit((
+        parts.scheme.lower(),
+        userinfo + at + host.lower(),
+        parts.path.rstrip('/'),
+        query,
+        parts.fragment
+    ))
+
+
+def _get_traced_function(func):
+    '''Returns a version of the function that records its calls as complete
+    ('X') trace events. Calls of context managers are recorded up to the end
+    of their with blocks.
+    '''
+    name = func.__name__
+
+    if isgeneratorfunction(getattr(func, '__wrapped__', None)):
+        @wraps(func)
+        @contextmanager
+        def traced_context_manager(*args, **kwargs):
+            with _trace_span(name), func(*args, **kwargs) as value:
+                yield value
+        return traced_context_manager
+
+    @wraps(func)
+    def traced_function(*args, **kwargs):
+        with _trace_span(name):
+            return func(*args, **kwargs)
+    return traced_function
+
+
+@contextmanager
+def _trace_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        events = _trace_events
+        if events is not None:
+            events.append({
+                'name': name,
+                'cat': 'vim-mail-refs',
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+            })
+
+
+def _get_default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'vim-mail-refs')
+
+
+def _get_index_cache_path(path, cache_dir):
+    if cache_dir is None:
+        cache_dir = _get_default_cache_dir()
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.json')
+
+
+def _get_lines_hash(lines):
+    h = hashlib.sha1()
+    for line in lines:
+        h.update(line.encode('utf-8', 'surrogateescape'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def _dump_ref_index(index):
+    '''Returns the layout of the index in a compact form that can be stored as
+    JSON. Occurrences are stored in a flat list of (row, start, end, number).
+    '''
+    occurrences = []
+    for row, start, end, ref in index.occurrences:
+        occurrences.extend((row, start, end, ref.number))
+    return {
+        'line_count': index.line_count,
+        'body_end': index.body_end,
+        'ref_list': [index.ref_list_start, index.ref_list_end],
+        'refs_with_urls': [
+            [ref.number, url] for ref, url in index.refs_with_urls
+        ],
+        'occurrences': occurrences,
+    }
+
+
+def _load_ref_index(data):
+    '''Returns a RefIndex from the layout returned by _dump_ref_index().'''
+    flat = data['occurrences']
+    occurrences = [
+        RefOccurrence(flat[i], flat[i + 1], flat[i + 2], Ref(flat[i + 3]))
+        for i in range(0, len(flat), 4)
+    ]
+    ref_list_start, ref_list_end = data['ref_list']
+    return RefIndex.from_layout(
+        line_count=data['line_count'],
+        body_end=data['body_end'],
+        ref_list_start=ref_list_start,
+        ref_list_end=ref_list_end,
+        refs_with_urls=[
+            RefWithUrl(Ref(number), url)
+            for number, url in data['refs_with_urls']
+        ],
+        occurrences=occurrences
+    )
+
+
+def _evict_cached_ref_indexes(cache_dir, size_limit):
+    '''Removes the least recently used indexes from cache_dir until their
+    total size is at most size_limit.
+
+    Only files named like cached indexes are considered, so other files in
+    cache_dir are neither counted nor removed.
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and INDEX_CACHE_NAME_RE.match(entry.name):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= size_limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def _get_built_ref_index(buffer, changedtick):
+    '''Returns the index of the buffer when it is cached, being built in the
+    background or only changed rows have to be scanned for it, and None when
+    the whole buffer would have to be scanned.
+    '''
+    key = _get_buffer_key(buffer)
+    if changedtick is None or key is None:
+        return None
+    cached = _ref_indexes.get(key)
+    pending = _pending_ref_indexes.get(key)
+    if (cached is not None and cached[0] == changedtick) or \
+            (pending is not None and pending[0] == changedtick) or \
+            key in _scanned_rows:
+        return get_ref_index(buffer, changedtick)
+    return None
+
+
+def _get_buffer_key(buffer):
+    # Vim buffers have numbers. Other buffers (e.g. lists) have no key, as
+    # their identity may be reused by another buffer, so they are not cached.
+    return getattr(buffer, 'number', None)
+
+
+def _get_ref_occurrences_by_number(occurrences):
+    '''Returns {number: occurrences} of all references.'''
+    usages = {}
+    for occurrence in occurrences:
+        usages.setdefault(occurrence.ref.number, []).append(occurrence)
+    return usages
+
+
+def _get_running_max_numbers(occurrences):
+    '''Returns a list whose i-th item is the highest number of the first i + 1
+    occurrences.
+    '''
+    max_numbers = []
+    max_number = 0
+    for occurrence in occurrences:
+        max_number = max(max_number, occurrence.ref.number)
+        max_numbers.append(max_number)
+    return max_numbers
+
+
+def _get_ref_occurrences_by_row(occurrences):
+    '''Returns {row: (starts, occurrences)} for bisecting by column.'''
+    rows = {}
+    for occurrence in occurrences:
+        starts, row_occurrences = rows.setdefault(occurrence.row, ([], []))
+        starts.append(occurrence.start)
+        row_occurrences.append(occurrence)
+    return rows
+
+
+def _replace_urls_with_refs(line, col, get_ref_for_url):
+    '''Returns (line, col) where all URLs in the line are replaced with
+    references obtained by get_ref_for_url(url).
+
+    col is a column in the original line that is to be moved to the same place
+    in the new line (it is None if there is no such column).
+    '''
+    parts = []
+    new_col = col
+    last_end = 0
+    for m in URL_RE.finditer(line):
+        if m.group(1):
+            url = m.group(2)
+            start, end = m.start(), m.end()
+        else:
+            url = _strip_url_trailing_chars(m.group(2))
+            start, end = m.start(), m.start() + len(url)
+        ref = str(get_ref_for_url(url))
+        # Separate the reference from what it would stick to.
+        if start > 0 and re.match(r'[\w\])]', line[start - 1]):
+            ref = ' ' + ref
+        parts.append(line[last_end:start])
+        parts.append(ref)
+        if col is not None and col >= start:
+            if col < end:
+                new_col += start - col
+            else:
+                new_col += len(ref) - (end - start)
+        last_end = end
+    if not parts:
+        return line, col
+    parts.append(line[last_end:])
+    return ''.join(parts), new_col
+
+
+def _strip_url_trailing_chars(url):
+    url = url.rstrip(URL_TRAILING_CHARS)
+    # Keep a closing parenthesis only when it is a part of the URL, e.g.
+    # https://en.wikipedia.org/wiki/Vim_(text_editor).
+    while url.endswith(')') and url.count(')') > url.count('('):
+        url = url[:-1].rstrip(URL_TRAILING_CHARS)
+    return url
+
+
+def _get_ref_allocator(index):
+    '''Returns (get_ref_for_url, new_refs_with_urls) for the indexed buffer.
+
+    get_ref_for_url(url) returns the reference of the URL, looked up by its
+    canonical form. URLs that are not in the reference list get new
+    references, which are collected in new_refs_with_urls.
+    '''
+    refs_for_urls = {}
+    for ref, url in index.refs_with_urls:
+        refs_for_urls.setdefault(canonicalize_url(url), ref)
+    new_refs_with_urls = []
+    next_number = index.max_number + 1
+
+    def get_ref_for_url(url):
+        nonlocal next_number
+        key = canonicalize_url(url)
+        ref = refs_for_urls.get(key)
+        if ref is None:
+            ref = Ref(next_number)
+            next_number += 1
+            refs_for_urls[key] = ref
+            new_refs_with_urls.append(RefWithUrl(ref, url))
+        return ref
+
+    return get_ref_for_url, new_refs_with_urls
+
+
+def _extend_ref_list(new_lines, lines, index, new_refs_with_urls):
+    '''Appends the reference list of lines extended with new_refs_with_urls,
+    followed by the rest of lines (the signature), to new_lines.
+    '''
+    if not index.refs_with_urls:
+        new_lines.append('')
+    new_lines.extend(lines[index.ref_list_start:index.ref_list_end])
+    new_lines.extend(str(ref_with_url) for ref_with_url in new_refs_with_urls)
+    tail = lines[index.ref_list_end:]
+    if tail and tail[0]:
+        new_lines.append('')
+    new_lines.extend(tail)
+
+
+def _replace_refs_in_line(line, ref_map):
+    '''Returns the line with references replaced according to ref_map.'''
+    def replace_ref(m):
+        ref = Ref.from_str(m.group(1))
+        return str(ref_map.get(ref, ref))
+
+    return REF_RE.sub(replace_ref, line)
+
+
+@_traced
+def _commit_lines(buffer, old_lines, new_lines):
+    '''Changes the buffer containing old_lines to contain new_lines by a single
+    replacement of the changed lines.
+    '''
+    edit = get_lines_edit(old_lines, new_lines)
+    if edit is not None:
+        start, end, lines = edit
+        buffer[start:end] = lines
+
+
+@_traced
+def _fix_mail_refs_in_range(buffer, cursor, line_range, changedtick, index):
+    if index is None:
+        index = get_ref_index(buffer, changedtick)
+    start_row, end_row = line_range
+    occurrences = index.get_occurrences_in_rows(start_row, end_row)
+
+    # Numbers used in the range, in the order of their first appearance, get
+    # the same numbers, only sorted.
+    numbers = list(OrderedDict.fromkeys(o.ref.number for o in occurrences))
+    ref_map = {
+        old: new for old, new in zip(numbers, sorted(numbers)) if old != new
+    }
+    if not ref_map:
+        return _put_cursor_at_valid_pos(buffer, cursor)
+
+    changes = {}
+    for old, new in ref_map.items():
+        for occurrence in index.usages[old]:
+            changes.setdefault(occurrence.row, []).append(
+                (occurrence.start, occurrence.end, str(Ref(new)))
+            )
+    _apply_line_changes(buffer, changes)
+
+    refs_with_urls = sorted(
+        RefWithUrl(Ref(ref_map.get(ref.number, ref.number)), url)
+        for ref, url in index.refs_with_urls
+    )
+    if refs_with_urls != index.refs_with_urls:
+        buffer[index.ref_list_start:index.ref_list_end] = [
+            str(ref_with_url) for ref_with_url in refs_with_urls
+        ]
+
+    row, col = cursor
+    return _put_cursor_at_valid_pos(
+        buffer, (row, _get_moved_col(changes.get(row, []), col))
+    )
+
+
+def _get_ref_list(buffer):
+    '''Returns (start, end, refs_with_urls) of the reference list.
+
+    The signature is searched for from the end of the buffer, so all lines are
+    read when there is no signature; of the mail body, only the lines from its
+    end up to the start of the reference list are read.
+    '''
+    body_end = _get_signature_start(buffer)
+    start, end = _get_ref_list_bounds(buffer, body_end)
+    refs_with_urls = [
+        RefWithUrl.from_str(line) for line in buffer[start:end]
+    ]
+    return start, end, refs_with_urls
+
+
+@_traced
 @contextmanager
 def _removed_signature(buffer):
     for i, line in enumerate(reversed(buffer)):
@@ -203,8 +1602,9 @@ def _get_refs_with_urls(buffer):
 def _get_ref_for_url(refs, ref_url):
     '''Returns (ref, ref_exists) for ref_url based on existing refs.
     '''
+    key = canonicalize_url(ref_url)
     for ref, url in refs:
-        if url == ref_url:
+        if canonicalize_url(url) == key:
             return ref, True
     return Ref(len(refs) + 1), False
 
@@ -214,6 +1614,7 @@ def _add_empty_line_before_ref_list_if_needed(buffer, refs):
         buffer.append('')
 
 
+@_traced
 def _remove_trailing_empty_lines(buffer):
     if len(buffer) <= 1 or buffer[-1]:
         return
@@ -225,93 +1626,136 @@ def _remove_trailing_empty_lines(buffer):
     del buffer[-i:]
 
 
-def _renumber_refs(buffer):
-    with _removed_refs_with_urls(buffer) as refs_with_urls:
-        ref_map = _renumber_refs_in_mail_body(buffer)
-        _update_refs_with_urls(refs_with_urls, ref_map)
-
-
-def _renumber_refs_in_mail_body(buffer):
-    ref_counter = 1
-    ref_map = {}
-    row, col = 0, 0
-
-    while True:
-        pos = _get_next_ref_pos(buffer, row, col)
-        if pos is None:
-            break
-        row, (col_start, col_end) = pos
-        ref = Ref.from_str(buffer[row][col_start:col_end])
-        new_ref = ref_map.setdefault(ref, Ref(ref_counter))
-        if new_ref.number == ref_counter:
-            ref_counter += 1
-        row, col = _replace_ref(buffer, row, col_start, col_end, new_ref)
-
-    return ref_map
-
-
-def _get_next_ref_pos(buffer, row, col):
-    for r in range(row, len(buffer)):
-        for m in re.finditer(REF_RE, buffer[r][col:]):
-            return r, (col + m.start(1), col + m.end(1))
-        col = 0
-
-
-def _replace_ref(buffer, row, col_start, col_end, new_ref):
-    line = buffer[row][:col_start] + str(new_ref) + buffer[row][col_end:]
-    buffer[row] = line
-    return row, col_start + len(str(new_ref))
-
-
-def _update_refs_with_urls(refs_with_urls, ref_map):
-    for i, (ref, url) in enumerate(refs_with_urls):
-        refs_with_urls[i] = RefWithUrl(ref_map[ref], url)
-    refs_with_urls.sort()
-
-
-@contextmanager
-def _removed_refs_with_urls(buffer):
-    refs_with_urls = _remove_refs_with_urls(buffer)
-    try:
-        yield refs_with_urls
-    finally:
-        _add_refs_with_urls(buffer, refs_with_urls)
-
-
-def _remove_unused_refs_with_urls(buffer):
-    with _removed_refs_with_urls(buffer) as refs_with_urls:
-        used_refs = _get_used_refs(buffer)
-        new_refs_with_urls = [
-            RefWithUrl(ref, url)
-            for ref, url in refs_with_urls
-            if ref in used_refs
-        ]
-        refs_with_urls[:] = new_refs_with_urls
-
-
-def _remove_refs_with_urls(buffer):
-    refs = _get_refs_with_urls(buffer)
-    if refs:
-        del buffer[-len(refs):]
-    return refs
-
-
-def _add_refs_with_urls(buffer, refs_with_urls):
-    lines = [str(ref_with_url) for ref_with_url in refs_with_urls]
-    _add_block(buffer, lines)
+@_traced
+def _renumber_refs(buffer, ref_list_start, body_end, refs_with_urls,
+                   occurrences, numbers):
+    '''Merges references to equivalent URLs, removes unused URLs and
+    renumbers references by their first appearance in the mail body.
 
+    occurrences are (row, start, end, number) of all references in the mail
+    body and numbers are the distinct numbers in the order of their first
+    appearance (see _scan_refs()). Only rows with changed references and the
+    lines from the end of the mail body on are written.
+    '''
+    first_numbers = {}
+    merged = {}
+    for ref, url in refs_with_urls:
+        first = first_numbers.setdefault(canonicalize_url(url), ref.number)
+        if first != ref.number:
+            merged[ref.number] = first
+
+    new_numbers = {}
+    for number in numbers:
+        number = merged.get(number, number)
+        if number not in new_numbers:
+            new_numbers[number] = len(new_numbers) + 1
+
+    # Text of the new reference for every number that changes.
+    new_refs = {}
+    for number in numbers:
+        new_number = new_numbers[merged.get(number, number)]
+        if new_number != number:
+            new_refs[number] = str(Ref(new_number))
+
+    changes = {}
+    for row, start, end, number in occurrences:
+        new_ref = new_refs.get(number)
+        if new_ref is not None:
+            changes.setdefault(row, []).append((start, end, new_ref))
+    _apply_line_changes(buffer, changes)
+
+    _replace_ref_list(buffer, ref_list_start, body_end, sorted(
+        RefWithUrl(Ref(new_numbers[ref.number]), url)
+        for ref, url in refs_with_urls
+        if ref.number not in merged and ref.number in new_numbers
+    ))
+
+
+@_traced
+def _replace_ref_list(buffer, ref_list_start, body_end, refs_with_urls):
+    '''Replaces the lines between the text of the mail body and the signature
+    with refs_with_urls, separated from both by an empty line.
+
+    Only the lines that differ are written.
+    '''
+    if refs_with_urls:
+        # Empty lines before the reference list are kept.
+        start = ref_list_start
+        new_lines = [str(ref_with_url) for ref_with_url in refs_with_urls]
+        if start == 0 or buffer[start - 1]:
+            new_lines.insert(0, '')
+    else:
+        # Empty lines at the end of the mail body are removed, but not its
+        # first line.
+        start = ref_list_start
+        while start > 1 and not buffer[start - 1]:
+            start -= 1
+        start = max(start, min(body_end, 1))
+        new_lines = []
+
+    signature = buffer[body_end:]
+    if signature:
+        last_line = new_lines[-1] if new_lines else \
+            (buffer[start - 1] if start > 0 else '')
+        if last_line:
+            new_lines.append('')
+        new_lines.extend(signature)
+    if start == 0 and not new_lines:
+        # A buffer always has at least one line.
+        new_lines = ['']
+
+    edit = get_lines_edit(buffer[start:], new_lines)
+    if edit is not None:
+        edit_start, edit_end, lines = edit
+        buffer[start + edit_start:start + edit_end] = lines
+
+
+@_traced
+def _scan_refs(lines):
+    '''Returns (occurrences, numbers), where occurrences are (row, start, end,
+    number) of all references in lines in the order of their appearance and
+    numbers are the distinct numbers in the order of their first appearance.
+
+    Large buffers are split into chunks that are scanned in parallel (see
+    set_scan_workers()). Every chunk returns its numbers in a local order of
+    their first appearance, and these orders are merged in the order of
+    chunks, so the result is the same as when the lines are scanned at once.
+    Chunks return only tuples of integers, which are cheap to send back.
+    '''
+    if _scan_executor is None or len(lines) < PARALLEL_SCAN_MIN_LINES:
+        return _scan_chunk(lines, 0)
+
+    chunk_size = -(-len(lines) // _scan_workers)
+    starts = range(0, len(lines), chunk_size)
+    chunks = _scan_executor.map(
+        _scan_chunk,
+        [lines[start:start + chunk_size] for start in starts],
+        starts
+    )
 
-def _get_used_refs(buffer):
-    used_refs = set()
-    for line in buffer:
-        used_refs |= _get_used_refs_in_line(line)
-    return used_refs
+    occurrences = []
+    numbers = OrderedDict()
+    for chunk_occurrences, chunk_numbers in chunks:
+        occurrences.extend(chunk_occurrences)
+        numbers.update(OrderedDict.fromkeys(chunk_numbers))
+    return occurrences, list(numbers)
 
 
-def _get_used_refs_in_line(line):
-    return set(Ref.from_str(s) for s in re.findall(REF_RE, line))
+def _scan_chunk(lines, start_row):
+    '''Returns (occurrences, numbers) like _scan_refs() for lines that start
+    at start_row of the buffer.
+    '''
+    occurrences = []
+    numbers = OrderedDict()
+    for row, line in enumerate(lines, start_row):
+        for m in REF_RE.finditer(line):
+            number = int(m.group(1)[1:-1])
+            occurrences.append((row, m.start(1), m.end(1), number))
+            numbers[number] = None
+    return occurrences, list(numbers)
 
 
+@_traced
 def _add_block(buffer, lines):
     if not lines:
         return
@@ -336,13 +1780,130 @@ def _put_cursor_at_valid_pos(buffer, cursor):
 def _get_or_create_ref(buffer, ref_or_url):
     '''Returns an existing reference or creates and returns a new reference.
     '''
-    ref = Ref.from_str(ref_or_url)
+    ref = _parse_ref(ref_or_url)
     if ref is not None:
         return ref
 
-    ref = Ref.from_str('[{}]'.format(ref_or_url))
+    ref = _append_ref_url(buffer, ref_or_url)
+    return ref
+
+
+def _get_or_create_ordered_ref(buffer, index, row, col, ref_or_url):
+    '''Returns (ref, col) with an existing reference or a new reference
+    numbered by its position in the mail body.
+
+    Creating a new reference renumbers the references that follow it, so the
+    returned col is the cursor column after the renumbering.
+    '''
+    ref = _parse_ref(ref_or_url)
+    if ref is not None:
+        return ref, col
+
+    ref, ref_exists = _get_ref_for_url(index.refs_with_urls, ref_or_url)
+    if ref_exists:
+        return ref, col
+
+    ref = Ref(index.get_max_number_before(row, col) + 1)
+    changes = _get_shift_changes(index, ref.number, 1)
+    _apply_line_changes(buffer, changes)
+    _insert_into_ref_list(buffer, index, RefWithUrl(ref, ref_or_url))
+    return ref, _get_moved_col(changes.get(row, []), col)
+
+
+def _parse_ref(ref_or_url):
+    '''Returns a reference if ref_or_url is a reference ([1]) or a reference
+    number (1), None otherwise.
+    '''
+    ref = Ref.from_str(ref_or_url)
     if ref is not None:
         return ref
+    return Ref.from_str('[{}]'.format(ref_or_url))
 
-    ref = _append_ref_url(buffer, ref_or_url)
-    return ref
+
+def _get_shift_changes(index, first_number, delta):
+    '''Returns changes of lines (see _apply_line_changes()) that add delta to
+    numbers of all references numbered at least first_number.
+    '''
+    changes = {}
+    for number, occurrences in index.usages.items():
+        if number < first_number:
+            continue
+        new_ref = str(Ref(number + delta))
+        for occurrence in occurrences:
+            changes.setdefault(occurrence.row, []).append(
+                (occurrence.start, occurrence.end, new_ref)
+            )
+    return changes
+
+
+@_traced
+def _apply_line_changes(buffer, changes):
+    '''Applies changes to lines of the buffer.
+
+    changes is a dictionary {row: [(start, end, text), ...]}, where every
+    change replaces buffer[row][start:end] with text. Only the changed rows
+    are read and written.
+    '''
+    for row, row_changes in changes.items():
+        line = buffer[row]
+        for start, end, text in sorted(row_changes, reverse=True):
+            line = line[:start] + text + line[end:]
+        buffer[row] = line
+
+
+def _get_moved_col(row_changes, col):
+    '''Returns the column where col ends up after applying row_changes (see
+    _apply_line_changes()) to its row.
+    '''
+    for start, end, text in row_changes:
+        if end <= col:
+            col += len(text) - (end - start)
+    return col
+
+
+def _shift_ref_with_url(ref_with_url, first_number, delta):
+    ref, url = ref_with_url
+    if ref.number < first_number:
+        return ref_with_url
+    return RefWithUrl(Ref(ref.number + delta), url)
+
+
+def _insert_into_ref_list(buffer, index, ref_with_url):
+    '''Inserts ref_with_url into the reference list before the first URL with
+    the same or a higher number, renumbering the URLs with such numbers.
+    '''
+    refs = index.refs_with_urls
+    if not refs:
+        _add_empty_line_before_ref_list_if_needed(buffer, refs)
+        buffer.append(str(ref_with_url))
+        return
+
+    number = ref_with_url.ref.number
+    first = next(
+        (i for i, (ref, url) in enumerate(refs) if ref.number >= number),
+        len(refs)
+    )
+    new_lines = [str(ref_with_url)] + [
+        str(_shift_ref_with_url(ref, number, 1)) for ref in refs[first:]
+    ]
+    buffer[index.ref_list_start + first:index.ref_list_end] = new_lines
+
+
+def _remove_from_ref_list(buffer, index, number):
+    '''Removes the URL with the given number from the reference list and
+    renumbers URLs with higher numbers to fill the gap.
+    '''
+    refs = index.refs_with_urls
+    first = next(
+        (i for i, (ref, url) in enumerate(refs) if ref.number >= number),
+        None
+    )
+    if first is None:
+        return
+
+    new_lines = [
+        str(_shift_ref_with_url(ref, number + 1, -1))
+        for ref in refs[first:]
+        if ref.ref.number != number
+    ]
+    buffer[index.ref_list_start + first:index.ref_list_end] = new_lines
@@ -5,15 +5,68 @@
 " License:   MIT, see the LICENSE file for more details
 "
 
-if !has('python3') || exists('loaded_vim_mail_refs')
+if exists('loaded_vim_mail_refs')
 	finish
 endif
 
+" The engine either runs in the embedded Python interpreter ('python3') or in
+" a separate process that Vim talks to over a channel ('server').
+if !exists('g:mail_refs_backend')
+	let g:mail_refs_backend = has('python3') ? 'python3' : 'server'
+endif
+
+if g:mail_refs_backend == 'python3'
+	if !has('python3')
+		finish
+	endif
+	python3 import sys
+	python3 import vim
+	python3 sys.path.append(vim.eval('expand("<sfile>:h")'))
+	python3 import vim_mail_refs
+	python3 import vim_mail_refs_bridge
+	if exists('g:mail_refs_tracking_params')
+		python3 vim_mail_refs.set_tracking_params(
+			\ vim.eval('g:mail_refs_tracking_params'))
+	endif
+elseif g:mail_refs_backend == 'server'
+	if !has('job') || !has('channel')
+		finish
+	endif
+	let s:server_script = expand('<sfile>:h') . '/vim_mail_refs_server.py'
+	" Python interpreter used to start the server.
+	let g:mail_refs_server_python = get(g:, 'mail_refs_server_python', 'python3')
+	" Address (host:port) of a shared server. When empty, the server is
+	" started as a job of this Vim instance.
+	let g:mail_refs_server_address = get(g:, 'mail_refs_server_address', '')
+	" Maximal time to wait for a response from the server (in milliseconds).
+	let g:mail_refs_server_timeout = get(g:, 'mail_refs_server_timeout', 2000)
+	" Number of processes of the server scanning huge mails in parallel (0
+	" scans them in the server process).
+	let g:mail_refs_scan_workers = get(g:, 'mail_refs_scan_workers', 0)
+else
+	finish
+endif
+
+" Number new references by their position in the mail.
+let g:mail_refs_ordered = get(g:, 'mail_refs_ordered', 0)
+" Build the reference index in the background when Vim is idle.
+let g:mail_refs_prewarm = get(g:, 'mail_refs_prewarm', 1)
+" Cache indexes of edited files on disk, so that reopening a postponed draft
+" does not have to parse it again.
+let g:mail_refs_index_cache = get(g:, 'mail_refs_index_cache', 1)
+" Directory of the cache. When empty, $XDG_CACHE_HOME/vim-mail-refs (or
+" ~/.cache/vim-mail-refs) is used.
+let g:mail_refs_cache_dir = get(g:, 'mail_refs_cache_dir', '')
+" Find references by matchbufline() in Vim (only with the 'python3' backend
+" and in Vim with matchbufline()), so that lines without references are not
+" passed to Python at all.
+let g:mail_refs_native_scan = get(g:, 'mail_refs_native_scan', 0)
+" Show the URL of the reference under the cursor.
+let g:mail_refs_show_url = get(g:, 'mail_refs_show_url', 0)
+" Highlight dangling references and list unused URLs while typing.
+let g:mail_refs_diagnostics = get(g:, 'mail_refs_diagnostics', 0)
 
-python3 import sys
-python3 import vim
-python3 sys.path.append(vim.eval('expand("<sfile>:h")'))
-python3 import vim_mail_refs
+highlight default link MailRefsDangling SpellBad
 
 
 function! s:GetCursorPosForPython()
@@ -46,15 +99,22 @@ function! s:SetCursorPosInVim(row, col)
 	" right) col times.
 	execute 'normal! ' . (a:row + 1) . 'G'
 	execute 'normal! 0'
-	execute 'normal! ' . a:col . 'l'
+	if a:col > 0
+		execute 'normal! ' . a:col . 'l'
+	endif
 endfunction
 
 
 function! s:AddMailRef()
-	let ref_url = input('Enter URL: ')
-	if ref_url != ''
-		call s:AddMailRefOrUrl(ref_url)
+	if g:mail_refs_backend == 'server'
+		let ref_url = input('Enter URL: ', '', 'customlist,MailRefsCompleteUrl')
+	else
+		let ref_url = input('Enter URL: ')
+	endif
+	if ref_url == ''
+		return
 	endif
+	call s:AddMailRefOrUrl(ref_url)
 endfunction
 
 
@@ -69,27 +129,19 @@ endfunction
 function! s:AddMailRefOrUrl(ref_or_url)
 	let [row, col] = s:GetCursorPosForPython()
 
-python3 << END
-row, col = vim_mail_refs.add_ref(
-	vim.current.buffer,
-	(int(vim.eval('l:row')), int(vim.eval('l:col'))),
-	vim.eval('a:ref_or_url')
-)
-vim.command('let row = {}'.format(row))
-vim.command('let col = {}'.format(col))
-END
-
-	call s:SetCursorPosInVim(row, col)
+	let response = s:Request('add_ref', {
+		\ 'cursor': [row, col],
+		\ 'ref_or_url': a:ref_or_url,
+		\ 'ordered': g:mail_refs_ordered ? v:true : v:false
+		\ })
+	if !empty(response)
+		call s:SetCursorPosInVim(response.cursor[0], response.cursor[1])
+	endif
 endfunction
 
 
 function! s:GetRefFromMenuWithRefsWithUrls()
-python3 << END
-refs_with_urls = vim_mail_refs.get_refs_with_urls_for_menu(
-	vim.current.buffer
-)
-vim.command('let refs_with_urls = {}'.format(refs_with_urls))
-END
+	let refs_with_urls = get(s:Request('menu', {}), 'refs_with_urls', [])
 
 	echohl Title
 	echo 'Existing references:'
@@ -103,24 +155,761 @@ END
 endfunction
 
 
-function! s:FixMailRefs()
+function! s:FixMailRefs(range, line1, line2)
+	let [row, col] = s:GetCursorPosForPython()
+	" Zero-based [start, end) rows, or none for the whole buffer.
+	let line_range = a:range > 0 ? [a:line1 - 1, a:line2] : v:null
+
+	let response = s:Request('fix', {
+		\ 'cursor': [row, col],
+		\ 'range': line_range
+		\ })
+	if !empty(response)
+		call s:SetCursorPosInVim(response.cursor[0], response.cursor[1])
+	endif
+endfunction
+
+
+function! s:CheckMailRefs(range, line1, line2)
+	let line_range = a:range > 0 ? [a:line1 - 1, a:line2] : v:null
+
+	let problems = get(s:Request('check', {'range': line_range}),
+		\ 'problems', [])
+
+	let items = []
+	for [row, col, message] in problems
+		call add(items, {
+			\ 'bufnr': bufnr('%'),
+			\ 'lnum': row + 1,
+			\ 'col': byteidxcomp(getline(row + 1), col) + 1,
+			\ 'text': message
+			\ })
+	endfor
+	call setloclist(0, [], ' ', {'title': 'Mail references', 'items': items})
+	if empty(items)
+		echo 'No problems with references found'
+	endif
+	lwindow
+endfunction
+
+
+function! s:PasteMailRefs(register)
 	let [row, col] = s:GetCursorPosForPython()
+	let text = getreg(a:register, 1, 1)
+
+	let response = s:Request('paste', {
+		\ 'cursor': [row, col],
+		\ 'text': text
+		\ })
+	if !empty(response)
+		call s:SetCursorPosInVim(response.cursor[0], response.cursor[1])
+	endif
+endfunction
+
+
+function! s:ExtractMailRefs()
+	let [row, col] = s:GetCursorPosForPython()
+
+	let response = s:Request('extract', {'cursor': [row, col]})
+	if !empty(response)
+		call s:SetCursorPosInVim(response.cursor[0], response.cursor[1])
+	endif
+endfunction
+
+
+function! s:RemoveMailRef()
+	let [row, col] = s:GetCursorPosForPython()
+
+	let response = s:Request('remove', {'cursor': [row, col]})
+	if !empty(response)
+		call s:SetCursorPosInVim(response.cursor[0], response.cursor[1])
+	endif
+endfunction
+
+
+function! s:MailRefJump()
+	let [row, col] = s:GetCursorPosForPython()
+
+	let target = get(s:Request('jump', {'cursor': [row, col]}), 'target')
+	let target = type(target) == v:t_list ? target : []
+
+	if empty(target)
+		echo 'No reference to jump to'
+		return
+	endif
+	" Remember the current position in the jump list.
+	normal! m'
+	call s:SetCursorPosInVim(target[0], target[1])
+endfunction
+
+
+function! s:MailRefUsages(use_quickfix)
+	let [row, col] = s:GetCursorPosForPython()
+
+	let response = s:Request('usages', {'cursor': [row, col]})
+	let ref = get(response, 'ref')
+	let positions = get(response, 'positions', [])
+
+	if type(ref) != v:t_number || ref == 0
+		echo 'No reference under cursor'
+		return
+	endif
+
+	let items = []
+	for [pos_row, pos_col] in positions
+		let line = getline(pos_row + 1)
+		call add(items, {
+			\ 'bufnr': bufnr('%'),
+			\ 'lnum': pos_row + 1,
+			\ 'col': byteidxcomp(line, pos_col) + 1,
+			\ 'text': line
+			\ })
+	endfor
+	let what = {'title': 'Uses of [' . ref . ']', 'items': items}
+	if a:use_quickfix
+		call setqflist([], ' ', what)
+		cwindow
+	else
+		call setloclist(0, [], ' ', what)
+		lwindow
+	endif
+endfunction
+
+
+function! s:StopTracing(path)
+	let response = s:Request('trace_stop', {'path': a:path})
+	if !empty(response)
+		echo 'Trace with ' . response.events . ' events written to ' . a:path
+	endif
+endfunction
+
+
+function! MailRefsStatus()
+	" Returns a short summary of references in the current buffer for use in
+	" the statusline, e.g. 'refs 3/4, 1 dangling, needs renumbering' (3 used
+	" references, 4 URLs). The summary is cached until the buffer changes.
+	" Errors are never reported, as Vim would blank the statusline, and the
+	" server is not started from here.
+	if &filetype !=# 'mail'
+		return ''
+	endif
+	if get(b:, 'mail_refs_status_tick', -1) == b:changedtick
+		return b:mail_refs_status
+	endif
+	if g:mail_refs_backend == 'server'
+		if !s:ServerIsOpen()
+			return ''
+		endif
+		" The server is not waited for. Until it responds, the summary of the
+		" previous version of the buffer is shown.
+		if get(b:, 'mail_refs_status_request_tick', -1) != b:changedtick
+			let b:mail_refs_status_request_tick = b:changedtick
+			call s:ServerRequestAsync('stats', {},
+				\ function('s:OnStats', [bufnr('%'), b:changedtick]))
+		endif
+		return get(b:, 'mail_refs_status', '')
+	endif
+
+	try
+		let stats = s:Request('stats', {})
+	catch
+		return ''
+	endtry
+	if empty(stats)
+		return ''
+	endif
+	let b:mail_refs_status = s:FormatStatus(stats)
+	let b:mail_refs_status_tick = b:changedtick
+	return b:mail_refs_status
+endfunction
+
+
+function! s:OnStats(bufnr, changedtick, stats)
+	call setbufvar(a:bufnr, 'mail_refs_status', s:FormatStatus(a:stats))
+	call setbufvar(a:bufnr, 'mail_refs_status_tick', a:changedtick)
+	redrawstatus!
+endfunction
+
+
+function! s:FormatStatus(stats)
+	let stats = a:stats
+	let status = ''
+	if stats.used > 0 || stats.defined > 0
+		let status = 'refs ' . stats.used . '/' . stats.defined
+		if stats.dangling > 0
+			let status .= ', ' . stats.dangling . ' dangling'
+		endif
+		if stats.needs_renumbering
+			let status .= ', needs renumbering'
+		endif
+	endif
+	return status
+endfunction
+
+
+function! s:ShowUrlUnderCursor()
+	" This is called on every cursor movement, so lines without references are
+	" skipped without calling the engine.
+	if getline('.') !~# '\[\d\+\]'
+		call s:HideUrl()
+		return
+	endif
+
+	" Unlike s:GetCursorPosForPython(), no options are changed, so that moving
+	" the cursor does not trigger redraws or OptionSet autocommands.
+	let row = line('.') - 1
+	let col = charidx(getline('.'), col('.') - 1, v:true)
+	if g:mail_refs_backend == 'server'
+		" The URL is shown when the server responds, unless the cursor has
+		" moved in the meantime.
+		call s:ServerRequestAsync('url_at', {'cursor': [row, col]},
+			\ function('s:OnUrlAt', [bufnr('%'), getcurpos()]))
+		return
+	endif
+	call s:ShowUrl(s:Request('url_at', {'cursor': [row, col]}))
+endfunction
+
+
+function! s:OnUrlAt(bufnr, curpos, response)
+	if bufnr('%') == a:bufnr && getcurpos() == a:curpos
+		call s:ShowUrl(a:response)
+	endif
+endfunction
+
+
+function! s:ShowUrl(response)
+	let url = get(a:response, 'url')
+	let url = type(url) == v:t_string ? url : ''
+
+	if url == ''
+		call s:HideUrl()
+	elseif exists('*popup_atcursor')
+		if url !=# s:shown_url || empty(popup_getpos(s:url_popup))
+			call s:HideUrl()
+			let s:url_popup = popup_atcursor(url, {'moved': 'WORD'})
+			let s:shown_url = url
+		endif
+	else
+		echo url[: &columns - 12]
+	endif
+endfunction
+
+
+let s:url_popup = 0
+let s:shown_url = ''
+
+
+function! s:HideUrl()
+	if s:url_popup
+		call popup_close(s:url_popup)
+		let s:url_popup = 0
+	endif
+	let s:shown_url = ''
+endfunction
+
+
+function! s:UpdateDiagnostics()
+	if g:mail_refs_backend == 'server'
+		" Typing is not blocked while the server checks the buffer. Until a
+		" command starts the server, there are no diagnostics.
+		call s:ServerRequestAsync('diagnostics', {},
+			\ function('s:OnDiagnostics', [bufnr('%')]))
+		return
+	endif
+	call s:ShowDiagnostics(s:Request('diagnostics', {}))
+endfunction
+
+
+function! s:OnDiagnostics(bufnr, response)
+	if bufnr('%') == a:bufnr
+		call s:ShowDiagnostics(a:response)
+	endif
+endfunction
+
+
+function! s:ShowDiagnostics(response)
+	let response = a:response
+	let dangling = get(response, 'dangling', [])
+	let unused = get(response, 'unused', [])
+
+	" The index is re-built only for changed lines, but placing highlights
+	" and updating the location list is done only when something changed.
+	if dangling != get(w:, 'mail_refs_dangling', [])
+		call s:HighlightDanglingRefs(dangling)
+	endif
+	if unused != get(w:, 'mail_refs_unused', [])
+		call s:ListUnusedUrls(unused)
+	endif
+endfunction
+
+
+function! s:ClearDiagnostics()
+	" Highlights belong to the window, so they have to be removed when another
+	" buffer is shown in it.
+	call s:HighlightDanglingRefs([])
+endfunction
+
+
+function! s:HighlightDanglingRefs(dangling)
+	for id in get(w:, 'mail_refs_match_ids', [])
+		silent! call matchdelete(id)
+	endfor
+
+	let positions = []
+	for [row, start, end] in a:dangling
+		let line = getline(row + 1)
+		let byte_start = byteidxcomp(line, start)
+		call add(positions,
+			\ [row + 1, byte_start + 1, byteidxcomp(line, end) - byte_start])
+	endfor
+	" Older versions of Vim accept at most 8 positions per matchaddpos().
+	let w:mail_refs_match_ids = []
+	for i in range(0, len(positions) - 1, 8)
+		call add(w:mail_refs_match_ids,
+			\ matchaddpos('MailRefsDangling', positions[i : i + 7]))
+	endfor
+	let w:mail_refs_dangling = a:dangling
+endfunction
+
+
+function! s:ListUnusedUrls(unused)
+	let items = []
+	for [row, ref_with_url] in a:unused
+		call add(items, {
+			\ 'bufnr': bufnr('%'),
+			\ 'lnum': row + 1,
+			\ 'text': 'Unused URL: ' . ref_with_url
+			\ })
+	endfor
+	" Reuse our location list so that other lists are not overwritten.
+	let id = get(w:, 'mail_refs_loclist_id', 0)
+	if id != 0 && getloclist(0, {'id': id}).id == id
+		call setloclist(0, [], 'r', {'id': id, 'items': items})
+	else
+		call setloclist(0, [], ' ', {'title': 'Unused URLs', 'items': items})
+		let w:mail_refs_loclist_id = getloclist(0, {'id': 0}).id
+	endif
+	let w:mail_refs_unused = a:unused
+endfunction
+
+
+function! s:PrewarmIndex()
+	" Lets the index of the buffer be built before the next command needs it.
+	" Only a snapshot of the lines is taken here, the index is built in a
+	" background thread (or by the server).
+	if get(b:, 'mail_refs_prewarm_tick', -1) == b:changedtick
+		return
+	endif
+	let b:mail_refs_prewarm_tick = b:changedtick
+
+	if g:mail_refs_backend == 'server'
+		if get(b:, 'mail_refs_server_tick', -1) == b:changedtick
+			return
+		endif
+		call s:ServerRequestAsync('prewarm', {}, v:null)
+	else
+		call s:PythonRequest('prewarm', {})
+	endif
+endfunction
+
+
+function! s:LoadIndexCache()
+	if expand('%:p') == ''
+		return
+	endif
+	call s:Request('load_cache', s:GetIndexCacheArgs())
+endfunction
+
+
+function! s:SaveIndexCache()
+	if expand('%:p') == ''
+		return
+	endif
+	call s:Request('save_cache', s:GetIndexCacheArgs())
+endfunction
+
+
+function! s:GetIndexCacheArgs()
+	return {
+		\ 'path': expand('%:p'),
+		\ 'cache_dir': g:mail_refs_cache_dir != '' ?
+		\     expand(g:mail_refs_cache_dir) : v:null
+		\ }
+endfunction
+
+
+function! s:SetUpBuffer()
+	augroup vim_mail_refs_buffer
+		autocmd! * <buffer>
+		if g:mail_refs_index_cache
+			autocmd BufWritePost <buffer> call s:SaveIndexCache()
+		endif
+		if g:mail_refs_show_url
+			autocmd CursorMoved,CursorHold <buffer> call s:ShowUrlUnderCursor()
+		endif
+		if g:mail_refs_prewarm
+			autocmd BufEnter,CursorHold <buffer> call s:PrewarmIndex()
+		endif
+		if g:mail_refs_diagnostics
+			autocmd BufEnter,TextChanged,TextChangedI <buffer>
+				\ call s:UpdateDiagnostics()
+			autocmd BufLeave <buffer> call s:ClearDiagnostics()
+		endif
+	augroup END
+	call s:TrackChanges()
+	if g:mail_refs_index_cache
+		call s:LoadIndexCache()
+	endif
+	if g:mail_refs_diagnostics
+		call s:UpdateDiagnostics()
+	endif
+endfunction
+
+
+function! s:TrackChanges()
+	" Collects lines changed since the engine has seen the buffer, so that
+	" only these lines are scanned again (and sent to the server).
+	if !exists('*listener_add')
+		return
+	endif
+	if !exists('b:mail_refs_listener')
+		let b:mail_refs_listener = listener_add(function('s:OnLinesChanged'))
+	endif
+	let b:mail_refs_changed_span = v:null
+	if g:mail_refs_backend == 'python3'
+		call s:PythonRequest('track', {})
+	endif
+endfunction
+
+
+function! s:OnLinesChanged(bufnr, start, end, added, changes)
+	let span = getbufvar(a:bufnr, 'mail_refs_changed_span', v:null)
+	for change in a:changes
+		let span = s:AddChangedLines(span,
+			\ change.lnum - 1, change.end - 1, change.added)
+	endfor
+	call setbufvar(a:bufnr, 'mail_refs_changed_span', span)
+endfunction
+
+
+function! s:AddChangedLines(span, start, end, added)
+	" Returns the span [start, old_end, new_end] (zero-based) of lines that
+	" replaced lines [start, old_end) before the first change, extended by a
+	" change that replaced lines [start, end) with end - start + added lines.
+	if a:span is v:null
+		return [a:start, a:end, a:end + a:added]
+	endif
+	let [start, old_end, new_end] = a:span
+	if a:end > new_end
+		let old_end += a:end - new_end
+		let new_end = a:end
+	endif
+	return [min([start, a:start]), old_end, new_end + a:added]
+endfunction
+
+
+function! s:TakeChangedLines()
+	" Returns the span of lines changed since the last call (see
+	" s:AddChangedLines()), [0, 0, 0] when nothing has changed, or v:null
+	" when changes are not tracked.
+	if !exists('b:mail_refs_listener')
+		return v:null
+	endif
+	call listener_flush()
+	let span = b:mail_refs_changed_span
+	let b:mail_refs_changed_span = v:null
+	return span is v:null ? [0, 0, 0] : span
+endfunction
+
+
+function! s:AddLinesForServer(request)
+	" Adds lines that the server does not have yet to the request: either
+	" only the changed lines, or all of them.
+	let span = s:TakeChangedLines()
+	let server_tick = get(b:, 'mail_refs_server_tick', -1)
+	if server_tick == b:changedtick
+		return
+	endif
+	if span isnot v:null && server_tick != -1
+		let a:request.base_changedtick = server_tick
+		let a:request.changed_lines =
+			\ [span[0], span[1], getline(span[0] + 1, span[2])]
+	else
+		let a:request.lines = getline(1, '$')
+	endif
+endfunction
+
+
+function! s:ForgetBuffer(bufnr)
+	if g:mail_refs_backend == 'server'
+		if s:ServerIsOpen()
+			call ch_sendexpr(s:channel, {'method': 'close', 'buffer': a:bufnr})
+		endif
+	else
+		call s:PythonRequest('close', {'buffer': a:bufnr})
+	endif
+endfunction
+
 
-python3 << END
-row, col = vim_mail_refs.fix_mail_refs(
-	vim.current.buffer,
-	(int(vim.eval('l:row')), int(vim.eval('l:col')))
-)
-vim.command('let row = {}'.format(row))
-vim.command('let col = {}'.format(col))
-END
+function! s:Request(method, args)
+	" Runs the method of the engine for the current buffer and returns its
+	" response. Returns an empty dictionary on failure.
+	if g:mail_refs_backend == 'server'
+		return s:ServerRequest(a:method, a:args)
+	endif
+	let span = s:TakeChangedLines()
+	if span isnot v:null && span != [0, 0, 0]
+		call s:PythonRequest('replace_rows', {'span': span})
+	endif
+	if g:mail_refs_native_scan && exists('*matchbufline') &&
+			\ s:UsesIndex(a:method, a:args)
+		call s:NativeScan()
+	endif
+	return s:PythonRequest(a:method, a:args)
+endfunction
+
+
+" Methods that use the index of the buffer.
+let s:native_scan_methods = ['fix', 'menu', 'check', 'paste', 'remove',
+	\ 'url_at', 'jump', 'usages', 'diagnostics', 'stats', 'save_cache']
+
+
+function! s:UsesIndex(method, args)
+	" Adding a reference by the next unused number reads only the reference
+	" list, so the index is used (and worth building natively) only with
+	" ordered numbering.
+	if a:method == 'add_ref'
+		return get(a:args, 'ordered', v:false) is v:true
+	endif
+	return index(s:native_scan_methods, a:method) != -1
+endfunction
+
+" Reference that may be in the mail body (the same as REF_RE in
+" vim_mail_refs.py). The character before the reference is captured, so that
+" Python can check it by the same rules as REF_RE (\w in Vim is only ASCII).
+let s:native_ref_pattern = '\(.\)\=\zs\[\d\+\]\[\@!'
+
+
+function! s:NativeScan()
+	" Indexes the buffer from matches found by matchbufline(). Only the
+	" matches and the lines of the reference list are passed to Python.
+	if get(b:, 'mail_refs_native_tick', -1) == b:changedtick
+		return
+	endif
+	let matches = []
+	let lines = {}
+	for m in matchbufline('%', s:native_ref_pattern, 1, '$',
+			\ {'submatches': v:true})
+		if !has_key(lines, m.lnum)
+			let lines[m.lnum] = getline(m.lnum)
+		endif
+		" Python works with characters, not bytes.
+		let start = charidx(lines[m.lnum], m.byteidx, v:true)
+		call add(matches, [m.lnum - 1, start, start + strchars(m.text),
+			\ m.text, m.submatches[0]])
+	endfor
+	let signatures = matchbufline('%', '^--[[:space:]]*$', 1, '$')
+	call s:PythonRequest('native_index', {
+		\ 'matches': matches,
+		\ 'signature': empty(signatures) ? v:null : signatures[-1].lnum - 1
+		\ })
+	let b:mail_refs_native_tick = b:changedtick
+endfunction
+
+
+function! s:PythonRequest(method, args)
+	" Calls the entry point of the method in vim_mail_refs_bridge.py. The
+	" arguments are bound to it as a Vim dictionary and the response is
+	" converted to a Vim dictionary by py3eval(), so nothing is formatted into
+	" Vim script.
+	return py3eval('vim_mail_refs_bridge.' . a:method .
+		\ '(vim.bindeval("a:args"))')
+endfunction
 
-	call s:SetCursorPosInVim(row, col)
+
+function! s:ServerIsOpen()
+	return exists('s:channel') && ch_status(s:channel) == 'open'
 endfunction
 
 
+function! s:ServerChannel()
+	if s:ServerIsOpen()
+		return s:channel
+	endif
+
+	if g:mail_refs_server_address != ''
+		let s:channel = ch_open(g:mail_refs_server_address, {'mode': 'json'})
+	else
+		let command = [g:mail_refs_server_python, s:server_script, '--stdio']
+		if exists('g:mail_refs_tracking_params')
+			let command += ['--tracking-params',
+				\ join(g:mail_refs_tracking_params, ',')]
+		endif
+		if g:mail_refs_scan_workers > 0
+			let command += ['--scan-workers', string(g:mail_refs_scan_workers)]
+		endif
+		let s:job = job_start(command, {'mode': 'json', 'stoponexit': 'term'})
+		let s:channel = job_getchannel(s:job)
+	endif
+	" The server does not know any buffers of this Vim instance.
+	for bufnr in range(1, bufnr('$'))
+		call setbufvar(bufnr, 'mail_refs_server_tick', -1)
+	endfor
+	return s:channel
+endfunction
+
+
+function! s:ServerRequest(method, args)
+	" Sends a request for the current buffer to the server and returns its
+	" response. An edit of the buffer contained in the response is applied.
+	" Returns an empty dictionary on failure.
+	let channel = s:ServerChannel()
+	if ch_status(channel) != 'open'
+		echoerr 'vim-mail-refs: cannot connect to the server'
+		return {}
+	endif
+
+	let request = extend({
+		\ 'method': a:method,
+		\ 'buffer': bufnr('%'),
+		\ 'changedtick': b:changedtick
+		\ }, a:args)
+	call s:AddLinesForServer(request)
+	let options = {'timeout': g:mail_refs_server_timeout}
+	let response = ch_evalexpr(channel, request, options)
+	if type(response) == v:t_dict && get(response, 'stale', 0)
+		let request.lines = getline(1, '$')
+		let response = ch_evalexpr(channel, request, options)
+	endif
+	if type(response) != v:t_dict || has_key(response, 'error')
+		" The server may be left with other lines than the buffer (e.g. an
+		" edit that was not received), so send them with the next request.
+		let b:mail_refs_server_tick = -1
+		if type(response) != v:t_dict
+			echoerr 'vim-mail-refs: no response from the server'
+		else
+			echoerr 'vim-mail-refs: ' . response.error
+		endif
+		return {}
+	endif
+
+	let b:mail_refs_server_tick = b:changedtick
+	if get(response, 'edit', v:null) isnot v:null
+		call s:ApplyEdit(response.edit)
+		" The server already has the edited lines.
+		call s:TakeChangedLines()
+		let b:mail_refs_server_tick = b:changedtick
+		call ch_sendexpr(channel, {
+			\ 'method': 'sync',
+			\ 'buffer': bufnr('%'),
+			\ 'changedtick': b:changedtick
+			\ })
+	endif
+	return response
+endfunction
+
+
+function! s:ServerRequestAsync(method, args, Callback)
+	" Sends a request for the current buffer to the server without waiting
+	" for its response. Callback is called with the response when the buffer
+	" has not changed in the meantime (v:null for no callback). This is done
+	" from autocommands and the statusline, so failures are not reported and
+	" the server is not started from here (only by commands).
+	if !s:ServerIsOpen()
+		return
+	endif
+	let channel = s:channel
+
+	let request = extend({
+		\ 'method': a:method,
+		\ 'buffer': bufnr('%'),
+		\ 'changedtick': b:changedtick
+		\ }, a:args)
+	call s:AddLinesForServer(request)
+	call ch_sendexpr(channel, request,
+		\ {'callback': function('s:OnServerResponse', [request, a:Callback])})
+	" Requests are handled in the order in which they are sent, so the
+	" following requests do not have to send the lines again.
+	let b:mail_refs_server_tick = b:changedtick
+endfunction
+
+
+function! s:OnServerResponse(request, Callback, channel, response)
+	let bufnr = a:request.buffer
+	let changedtick = a:request.changedtick
+	let unchanged = getbufvar(bufnr, 'changedtick', -1) == changedtick
+	if type(a:response) == v:t_dict && get(a:response, 'stale', 0) &&
+			\ unchanged && !has_key(a:request, 'lines')
+		let a:request.lines = getbufline(bufnr, 1, '$')
+		call ch_sendexpr(a:channel, a:request, {'callback':
+			\ function('s:OnServerResponse', [a:request, a:Callback])})
+		return
+	endif
+	if type(a:response) != v:t_dict || has_key(a:response, 'error') ||
+			\ get(a:response, 'stale', 0)
+		" The server may have other lines than the buffer, so send them with
+		" the next request.
+		if getbufvar(bufnr, 'mail_refs_server_tick', -1) == changedtick
+			call setbufvar(bufnr, 'mail_refs_server_tick', -1)
+		endif
+		return
+	endif
+	if unchanged && a:Callback isnot v:null
+		call a:Callback(a:response)
+	endif
+endfunction
+
+
+function! s:ApplyEdit(edit)
+	" Replaces lines [start, end) (zero-based) of the current buffer with the
+	" given lines.
+	let [start, end, lines] = a:edit
+	let common = min([end - start, len(lines)])
+	if common > 0
+		call setline(start + 1, lines[: common - 1])
+	endif
+	if len(lines) > common
+		call append(start + common, lines[common :])
+	elseif end - start > common
+		call deletebufline('%', start + common + 1, end)
+	endif
+endfunction
+
+
+function! MailRefsCompleteUrl(arg_lead, cmd_line, cursor_pos)
+	" Completes URLs from the history shared by all clients of the server.
+	let channel = s:ServerChannel()
+	if ch_status(channel) != 'open'
+		return []
+	endif
+	let response = ch_evalexpr(channel,
+		\ {'method': 'history', 'prefix': a:arg_lead},
+		\ {'timeout': g:mail_refs_server_timeout})
+	return type(response) == v:t_dict ? get(response, 'urls', []) : []
+endfunction
+
+
+augroup vim_mail_refs
+	autocmd!
+	autocmd FileType mail call s:SetUpBuffer()
+	autocmd BufUnload * call s:ForgetBuffer(str2nr(expand('<abuf>')))
+augroup END
+
+
 command! AddMailRef call s:AddMailRef()
 command! AddMailRefFromMenu call s:AddMailRefFromMenu()
-command! FixMailRefs call s:FixMailRefs()
+command! -range FixMailRefs call s:FixMailRefs(<range>, <line1>, <line2>)
+command! -range CheckMailRefs call s:CheckMailRefs(<range>, <line1>, <line2>)
+command! ExtractMailRefs call s:ExtractMailRefs()
+command! -register PasteMailRefs call s:PasteMailRefs(<q-reg>)
+command! RemoveMailRef call s:RemoveMailRef()
+command! MailRefJump call s:MailRefJump()
+command! -bang MailRefUsages call s:MailRefUsages(<bang>0)
+command! MailRefsTraceStart call s:Request('trace_start', {})
+command! -nargs=1 -complete=file MailRefsTraceStop
+	\ call s:StopTracing(fnamemodify(<q-args>, ':p'))
+
+" The buffer that caused loading of the plugin.
+call s:SetUpBuffer()
 
 let loaded_vim_mail_refs = 1
@@ -0,0 +1,274 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+'''An end-to-end benchmark of the plugin in a headless Vim.
+
+For every mail size, a generated mail is opened in `vim -Nu NONE -Es` with
+the plugin loaded. Then :AddMailRef, :AddMailRefFromMenu and :FixMailRefs are
+run with scripted input and their latencies are measured by reltime() inside
+Vim, so they include everything the user waits for (cursor conversions, the
+Python or server round trip and buffer updates). A run is measured only when
+the command has changed the buffer without an error. The startup time
+(loading of the plugin and the mail) is taken from --startuptime of a
+separate run.
+
+Neovim is not supported, as the plugin needs Vim's python3 interface
+(vim.bindeval()) or its jobs and channels (job_start(), ch_evalexpr()).
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+
+
+# Directory that has to be put into 'runtimepath' to load the plugin.
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)
+)))
+
+# Numbers of references in the generated mails.
+MAIL_SIZES = (10, 100, 1000)
+
+# Commands that are measured together with the input they ask for (if any).
+COMMANDS = (
+    ('AddMailRef', 'https://example.com/new'),
+    ('AddMailRefFromMenu', '1'),
+    ('FixMailRefs', ''),
+)
+
+# Vim script loading the plugin and the mail. It is run on its own to measure
+# the startup time.
+STARTUP_SCRIPT = r'''
+set runtimepath^={plugin_dir}
+filetype plugin on
+{setup}
+edit {mail}
+qall!
+'''
+
+# Vim script measuring the commands. The mail is re-read before every run, so
+# all runs start from the same buffer. The first run of every command is not
+# measured (it may start the server or fill caches). Runs that reported an
+# error or did not change the buffer are counted as failed.
+BENCHMARK_SCRIPT = r'''
+set runtimepath^={plugin_dir}
+filetype plugin on
+{setup}
+edit {mail}
+let s:results = {{'loaded': exists(':FixMailRefs') == 2}}
+for [s:command, s:input] in {commands}
+  let s:latencies = []
+  let s:failed = 0
+  if s:results.loaded
+    for s:i in range({runs} + 1)
+      silent edit! {mail}
+      call cursor(1, 1)
+      if s:input != ''
+        call feedkeys(s:input . "\<CR>", 't')
+      endif
+      let v:errmsg = ''
+      let s:changedtick = b:changedtick
+      let s:start = reltime()
+      silent! execute s:command
+      let s:latency = reltimefloat(reltime(s:start))
+      if v:errmsg != '' || b:changedtick == s:changedtick
+        let s:failed += 1
+      elseif s:i > 0
+        call add(s:latencies, s:latency * 1000)
+      endif
+    endfor
+  endif
+  let s:results[s:command] = {{'latencies': s:latencies, 'failed': s:failed}}
+endfor
+call writefile([json_encode(s:results)], {output})
+qall!
+'''
+
+
+def generate_mail(refs):
+    '''Returns lines of a mail with the given number of references.
+
+    The references are used in the reverse order and the reference list ends
+    with an unused URL, so that :FixMailRefs always has something to fix.
+    '''
+    lines = ['Hi,', '']
+    lines.extend(
+        'see [{}] for more details.'.format(i) for i in range(refs, 0, -1)
+    )
+    lines.append('')
+    lines.extend(
+        '[{}] https://example.com/{}'.format(i, i) for i in range(1, refs + 2)
+    )
+    lines.extend(['', '-- ', 'Signature'])
+    return lines
+
+
+def run_benchmark(refs, runs, backend=None):
+    '''Runs the benchmark in Vim with a mail with refs references.
+
+    Returns a dictionary with the startup time, the median and maximal
+    latencies of all commands (in milliseconds) and the numbers of their
+    failed runs. When the plugin could not be loaded, 'loaded' is False and
+    there are no latencies.
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mail = os.path.join(tmp_dir, 'mail.eml')
+        with open(mail, 'w') as f:
+            f.write('\n'.join(generate_mail(refs)) + '\n')
+        script = os.path.join(tmp_dir, 'script.vim')
+        output = os.path.join(tmp_dir, 'results.json')
+        startuptime = os.path.join(tmp_dir, 'startuptime.log')
+
+        _write_script(script, STARTUP_SCRIPT, mail, backend)
+        _run_vim(script, ['--startuptime', startuptime])
+        startup_ms = parse_startuptime(startuptime)
+
+        _write_script(
+            script, BENCHMARK_SCRIPT, mail, backend,
+            commands=json.dumps([list(command) for command in COMMANDS]),
+            runs=runs,
+            output=_vim_string(output)
+        )
+        _run_vim(script)
+        with open(output) as f:
+            results = json.load(f)
+
+    report = {
+        'refs': refs,
+        'loaded': bool(results.pop('loaded')),
+        'startup_ms': startup_ms,
+    }
+    for command, result in results.items():
+        latencies = result['latencies']
+        report[command] = {
+            'median_ms': statistics.median(latencies) if latencies else None,
+            'max_ms': max(latencies) if latencies else None,
+            'failed': result['failed'],
+        }
+    return report
+
+
+def format_report(reports):
+    '''Returns a table comparing the reports of run_benchmark().'''
+    header = ['refs', 'startup'] + [command for command, _ in COMMANDS]
+    rows = [header]
+    for report in reports:
+        row = [str(report['refs']), _format_ms(report['startup_ms'])]
+        for command, _ in COMMANDS:
+            if not report['loaded']:
+                row.append('not loaded')
+                continue
+            result = report.get(command)
+            if result is None:
+                row.append('-')
+                continue
+            if result['median_ms'] is None:
+                cell = 'failed'
+            else:
+                cell = '{} (max {})'.format(
+                    _format_ms(result['median_ms']),
+                    _format_ms(result['max_ms'])
+                )
+                if result['failed']:
+                    cell += ', {} failed'.format(result['failed'])
+            row.append(cell)
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(row, widths))
+        .rstrip()
+        for row in rows
+    )
+
+
+def parse_startuptime(path):
+    '''Returns the total startup time (in milliseconds) from a --startuptime
+    log, or None if there is no log.
+    '''
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    total = None
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0][0].isdigit():
+            total = float(fields[0])
+    return total
+
+
+def _write_script(path, template, mail, backend, **kwargs):
+    setup = ''
+    if backend is not None:
+        setup = 'let g:mail_refs_backend = {}'.format(_vim_string(backend))
+    with open(path, 'w') as f:
+        f.write(template.format(
+            plugin_dir=PLUGIN_DIR.replace(' ', r'\ '),
+            setup=setup,
+            mail=mail.replace(' ', r'\ '),
+            **kwargs
+        ))
+
+
+def _run_vim(script, args=()):
+    command = ['vim', '-Nu', 'NONE', '-i', 'NONE', '-Es']
+    subprocess.run(
+        command + list(args) + ['-S', script],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=600
+    )
+
+
+def _vim_string(s):
+    return "'{}'".format(s.replace("'", "''"))
+
+
+def _format_ms(ms):
+    if ms is None:
+        return '-'
+    return '{:.2f} ms'.format(ms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', metavar='REFS', type=int, nargs='+',
+        default=list(MAIL_SIZES),
+        help='numbers of references in the generated mails'
+    )
+    parser.add_argument(
+        '--runs', type=int, default=10,
+        help='number of measured runs of every command'
+    )
+    parser.add_argument(
+        '--backend', choices=['python3', 'server'],
+        help='backend of the plugin (chosen by the plugin by default)'
+    )
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the results as JSON'
+    )
+    args = parser.parse_args(argv)
+
+    reports = [
+        run_benchmark(refs, args.runs, args.backend) for refs in args.sizes
+    ]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+
+
+if __name__ == '__main__':
+    main()
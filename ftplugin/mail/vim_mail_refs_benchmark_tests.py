@@ -0,0 +1,100 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+import os
+import tempfile
+import unittest
+
+from vim_mail_refs import RefIndex
+from vim_mail_refs import fix_mail_refs
+from vim_mail_refs_benchmark import format_report
+from vim_mail_refs_benchmark import generate_mail
+from vim_mail_refs_benchmark import parse_startuptime
+
+
+class GenerateMailTests(unittest.TestCase):
+    def test_generates_mail_with_given_number_of_references(self):
+        index = RefIndex(generate_mail(3))
+
+        self.assertEqual(len(index.occurrences), 3)
+        self.assertEqual(len(index.refs_with_urls), 4)
+
+    def test_generates_mail_that_needs_fixing(self):
+        for refs in (1, 3):
+            with self.subTest(refs=refs):
+                lines = generate_mail(refs)
+                fixed_lines = lines[:]
+
+                fix_mail_refs(fixed_lines, (0, 0))
+
+                self.assertNotEqual(fixed_lines, lines)
+
+
+class FormatReportTests(unittest.TestCase):
+    def test_formats_latencies_of_commands(self):
+        report = format_report([{
+            'refs': 10,
+            'loaded': True,
+            'startup_ms': 12.5,
+            'AddMailRef': {'median_ms': 1.0, 'max_ms': 2.0, 'failed': 0},
+            'AddMailRefFromMenu': {
+                'median_ms': 1.5, 'max_ms': 3.0, 'failed': 0
+            },
+            'FixMailRefs': {'median_ms': 0.5, 'max_ms': 0.75, 'failed': 0},
+        }])
+
+        self.assertEqual(
+            report.splitlines()[1].split(),
+            [
+                '10', '12.50', 'ms',
+                '1.00', 'ms', '(max', '2.00', 'ms)',
+                '1.50', 'ms', '(max', '3.00', 'ms)',
+                '0.50', 'ms', '(max', '0.75', 'ms)'
+            ]
+        )
+
+    def test_reports_when_plugin_was_not_loaded(self):
+        report = format_report([{
+            'refs': 10,
+            'loaded': False,
+            'startup_ms': None,
+        }])
+
+        self.assertIn('not loaded', report.splitlines()[1])
+
+    def test_reports_failed_runs(self):
+        report = format_report([{
+            'refs': 10,
+            'loaded': True,
+            'startup_ms': 12.5,
+            'AddMailRef': {'median_ms': 1.0, 'max_ms': 2.0, 'failed': 2},
+            'AddMailRefFromMenu': {
+                'median_ms': None, 'max_ms': None, 'failed': 11
+            },
+            'FixMailRefs': {'median_ms': 0.5, 'max_ms': 0.75, 'failed': 0},
+        }])
+
+        row = report.splitlines()[1]
+        self.assertIn('(max 2.00 ms), 2 failed', row)
+        self.assertRegex(row, r' failed +0\.50 ms')
+
+
+class ParseStartuptimeTests(unittest.TestCase):
+    def test_returns_total_time_from_last_line(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'startuptime.log')
+            with open(path, 'w') as f:
+                f.write(
+                    'times in msec\n'
+                    '000.007  000.007: --- VIM STARTING ---\n'
+                    '010.206  000.025: --- VIM STARTED ---\n'
+                )
+
+            self.assertEqual(parse_startuptime(path), 10.206)
+
+    def test_returns_none_when_there_is_no_log(self):
+        self.assertIsNone(parse_startuptime('/nonexistent/startuptime.log'))
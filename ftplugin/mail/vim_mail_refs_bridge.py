@@ -0,0 +1,233 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+'''Entry points of the embedded Python backend.
+
+Every command of the plugin has one function here. It is called from Vim by
+
+    py3eval('vim_mail_refs_bridge.<method>(vim.bindeval("a:args"))')
+
+where a:args is the dictionary of arguments that would be sent to the server
+(see vim_mail_refs_server.py), and it works with the current buffer. The
+returned dictionary has the same form as the response of the server (without
+'edit', as the buffer is changed in place). Arguments and results are passed
+as Vim dictionaries and lists, so no values are formatted into or parsed from
+Vim script.
+'''
+
+import vim
+
+import vim_mail_refs
+
+
+def add_ref(args):
+    buffer = vim.current.buffer
+    cursor = vim_mail_refs.add_ref(
+        buffer,
+        _get_cursor(args),
+        _to_str(args['ref_or_url']),
+        ordered=bool(args.get('ordered', False)),
+        changedtick=_get_changedtick(buffer)
+    )
+    return {'cursor': list(cursor)}
+
+
+def menu(args):
+    buffer = vim.current.buffer
+    refs_with_urls = vim_mail_refs.get_refs_with_urls_for_menu(
+        buffer, _get_changedtick(buffer)
+    )
+    return {'refs_with_urls': refs_with_urls}
+
+
+def fix(args):
+    buffer = vim.current.buffer
+    cursor = vim_mail_refs.fix_mail_refs(
+        buffer,
+        _get_cursor(args),
+        _get_range(args),
+        _get_changedtick(buffer)
+    )
+    return {'cursor': list(cursor)}
+
+
+def check(args):
+    buffer = vim.current.buffer
+    problems = vim_mail_refs.check_mail_refs(
+        buffer, _get_range(args), _get_changedtick(buffer)
+    )
+    return {'problems': [list(problem) for problem in problems]}
+
+
+def paste(args):
+    buffer = vim.current.buffer
+    cursor = vim_mail_refs.paste_mail_refs(
+        buffer,
+        _get_cursor(args),
+        [_to_str(line) for line in args['text']],
+        _get_changedtick(buffer)
+    )
+    return {'cursor': list(cursor)}
+
+
+def extract(args):
+    cursor = vim_mail_refs.extract_mail_refs(
+        vim.current.buffer, _get_cursor(args)
+    )
+    return {'cursor': list(cursor)}
+
+
+def remove(args):
+    buffer = vim.current.buffer
+    cursor = vim_mail_refs.remove_ref(
+        buffer, _get_cursor(args), _get_changedtick(buffer)
+    )
+    return {'cursor': list(cursor)}
+
+
+def url_at(args):
+    buffer = vim.current.buffer
+    url = vim_mail_refs.get_url_at_cursor(
+        buffer, _get_cursor(args), _get_changedtick(buffer)
+    )
+    return {'url': url}
+
+
+def jump(args):
+    buffer = vim.current.buffer
+    target = vim_mail_refs.get_ref_jump_target(
+        buffer, _get_cursor(args), _get_changedtick(buffer)
+    )
+    return {'target': list(target) if target is not None else None}
+
+
+def usages(args):
+    buffer = vim.current.buffer
+    number, positions = vim_mail_refs.get_ref_usages(
+        buffer, _get_cursor(args), _get_changedtick(buffer)
+    )
+    return {
+        'ref': number,
+        'positions': [list(position) for position in positions]
+    }
+
+
+def diagnostics(args):
+    buffer = vim.current.buffer
+    dangling, unused = vim_mail_refs.get_ref_diagnostics(
+        buffer, _get_changedtick(buffer)
+    )
+    return {
+        'dangling': [
+            [occurrence.row, occurrence.start, occurrence.end]
+            for occurrence in dangling
+        ],
+        'unused': [
+            [row, str(ref_with_url)] for row, ref_with_url in unused
+        ],
+    }
+
+
+def stats(args):
+    buffer = vim.current.buffer
+    stats = vim_mail_refs.get_ref_stats(buffer, _get_changedtick(buffer))
+    return dict(stats._asdict())
+
+
+def prewarm(args):
+    buffer = vim.current.buffer
+    vim_mail_refs.prewarm_ref_index(buffer, _get_changedtick(buffer))
+    return {}
+
+
+def native_index(args):
+    buffer = vim.current.buffer
+    vim_mail_refs.index_ref_matches(
+        buffer,
+        _get_changedtick(buffer),
+        [
+            (int(row), int(start), int(end), _to_str(text), _to_str(prefix))
+            for row, start, end, text, prefix in args['matches']
+        ],
+        args.get('signature')
+    )
+    return {}
+
+
+def track(args):
+    vim_mail_refs.track_rows(vim.current.buffer)
+    return {}
+
+
+def replace_rows(args):
+    start, end, new_end = (int(row) for row in args['span'])
+    vim_mail_refs.replace_rows(
+        vim.current.buffer, start, end, new_end - start
+    )
+    return {}
+
+
+def load_cache(args):
+    buffer = vim.current.buffer
+    loaded = vim_mail_refs.load_ref_index(
+        buffer,
+        _get_changedtick(buffer),
+        _to_str(args['path']),
+        _to_str(args.get('cache_dir'))
+    )
+    return {'loaded': loaded}
+
+
+def save_cache(args):
+    buffer = vim.current.buffer
+    vim_mail_refs.save_ref_index(
+        buffer,
+        _get_changedtick(buffer),
+        _to_str(args['path']),
+        _to_str(args.get('cache_dir'))
+    )
+    return {}
+
+
+def trace_start(args):
+    vim_mail_refs.start_tracing()
+    return {}
+
+
+def trace_stop(args):
+    events = vim_mail_refs.stop_tracing(_to_str(args['path']))
+    return {'events': len(events)}
+
+
+def close(args):
+    vim_mail_refs.forget_ref_index(int(args['buffer']))
+    return {}
+
+
+def _get_changedtick(buffer):
+    return buffer.vars['changedtick']
+
+
+def _get_cursor(args):
+    row, col = args['cursor']
+    return int(row), int(col)
+
+
+def _get_range(args):
+    # v:null (no range) is passed as None.
+    line_range = args.get('range')
+    if line_range is None:
+        return None
+    start_row, end_row = line_range
+    return int(start_row), int(end_row)
+
+
+def _to_str(value):
+    # Strings in bound Vim dictionaries and lists are bytes.
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
@@ -0,0 +1,181 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+import sys
+import types
+import unittest
+
+from unittest import mock
+
+# The bridge imports the vim module, which exists only inside of Vim.
+vim = types.ModuleType('vim')
+vim.current = types.SimpleNamespace(buffer=None)
+sys.modules.setdefault('vim', vim)
+
+import vim_mail_refs  # noqa: E402
+import vim_mail_refs_bridge  # noqa: E402
+
+
+class Buffer(list):
+    '''Lines with a number and variables, like vim.current.buffer.
+
+    As in Vim, b:changedtick is incremented by every change of the lines.
+    '''
+
+    def __init__(self, lines, number=1, changedtick=1):
+        super().__init__(lines)
+        self.number = number
+        self.vars = {'changedtick': changedtick}
+        vim_mail_refs.forget_ref_index(number)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.vars['changedtick'] += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.vars['changedtick'] += 1
+
+    def append(self, line):
+        super().append(line)
+        self.vars['changedtick'] += 1
+
+    def insert(self, index, line):
+        super().insert(index, line)
+        self.vars['changedtick'] += 1
+
+
+class BridgeTests(unittest.TestCase):
+    def setUp(self):
+        self.vim = sys.modules['vim']
+        self.old_buffer = self.vim.current.buffer
+
+    def tearDown(self):
+        self.vim.current.buffer = self.old_buffer
+
+    def set_buffer(self, lines, changedtick=1):
+        self.vim.current.buffer = Buffer(lines, changedtick=changedtick)
+        return self.vim.current.buffer
+
+    def test_add_ref_decodes_url_passed_as_bytes(self):
+        buffer = self.set_buffer(['see ', '', '[1] URL1'])
+
+        response = vim_mail_refs_bridge.add_ref({
+            'cursor': [0, 3],
+            'ref_or_url': b'https://a.com/x',
+        })
+
+        self.assertEqual(
+            buffer,
+            [
+                'see [2]',
+                #      ^
+                '',
+                '[1] URL1',
+                '[2] https://a.com/x'
+            ]
+        )
+        self.assertEqual(response, {'cursor': [0, 6]})
+
+    def test_add_ref_keeps_quotes_and_backslashes_in_url(self):
+        url = "https://a.com/it's\\x"
+        buffer = self.set_buffer([''])
+
+        vim_mail_refs_bridge.add_ref({
+            'cursor': [0, 0],
+            'ref_or_url': url.encode('utf-8'),
+        })
+
+        self.assertEqual(buffer[-1], '[1] ' + url)
+
+    def test_menu_returns_url_with_quotes_and_backslashes_as_str(self):
+        self.set_buffer(['[1]', '', "[1] https://a.com/it's\\x"])
+
+        response = vim_mail_refs_bridge.menu({})
+
+        self.assertEqual(
+            response,
+            {'refs_with_urls': ["[1] https://a.com/it's\\x"]}
+        )
+
+    def test_fix_without_range_fixes_whole_buffer(self):
+        buffer = self.set_buffer(
+            ['see [2] and [1]', '', '[1] URL1', '[2] URL2']
+        )
+
+        vim_mail_refs_bridge.fix({'cursor': [0, 0], 'range': None})
+
+        self.assertEqual(
+            buffer,
+            ['see [1] and [2]', '', '[1] URL2', '[2] URL1']
+        )
+
+    def test_fix_passes_range_as_tuple_of_ints(self):
+        self.set_buffer(['[1]', '', '[1] URL1'])
+
+        with mock.patch.object(
+                vim_mail_refs, 'fix_mail_refs',
+                return_value=(0, 0)) as fix_mail_refs:
+            vim_mail_refs_bridge.fix({'cursor': [0, 0], 'range': [0, 1]})
+
+        self.assertEqual(fix_mail_refs.call_args[0][2], (0, 1))
+
+    def test_check_without_range_reports_unused_urls(self):
+        self.set_buffer(['text', '', '[1] URL1'])
+
+        response = vim_mail_refs_bridge.check({'range': None})
+
+        self.assertEqual(len(response['problems']), 1)
+        self.assertEqual(response['problems'][0][0], 2)
+
+    def test_passes_changedtick_of_buffer(self):
+        buffer = self.set_buffer(['[1]', '', '[1] URL1'], changedtick=42)
+
+        with mock.patch.object(
+                vim_mail_refs, 'get_refs_with_urls_for_menu',
+                return_value=[]) as get_refs_with_urls_for_menu:
+            vim_mail_refs_bridge.menu({})
+
+        get_refs_with_urls_for_menu.assert_called_once_with(buffer, 42)
+
+    def test_does_not_reuse_index_after_changedtick_changes(self):
+        buffer = self.set_buffer(['[1]', '', '[1] URL1'])
+        vim_mail_refs_bridge.stats({})
+
+        buffer[2:] = ['[1] URL1', '[2] URL2']
+        response = vim_mail_refs_bridge.stats({})
+
+        self.assertEqual(response['defined'], 2)
+
+    def test_paste_decodes_lines_passed_as_bytes(self):
+        buffer = self.set_buffer(['look at [1].', '', '[1] URL1'])
+
+        vim_mail_refs_bridge.paste({
+            'cursor': [0, 0],
+            'text': [b'pasted [1]', b'', b'[1] URL2'],
+        })
+
+        self.assertIn('[2] URL2', buffer)
+
+    def test_jump_returns_None_when_there_is_no_target(self):
+        self.set_buffer(['no references'])
+
+        response = vim_mail_refs_bridge.jump({'cursor': [0, 0]})
+
+        self.assertEqual(response, {'target': None})
+
+    def test_replace_rows_converts_span_to_count_of_new_rows(self):
+        buffer = self.set_buffer(['a', 'b'])
+
+        with mock.patch.object(vim_mail_refs, 'replace_rows') as replace_rows:
+            vim_mail_refs_bridge.replace_rows({'span': [1, 2, 4]})
+
+        replace_rows.assert_called_once_with(buffer, 1, 2, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+'''Converts a plain-text mail with references into Markdown or HTML.
+
+The mail is converted line by line by generators, so even large mails are
+converted in constant memory (apart from the table of URLs and the signature,
+which is held back until the end, as only the last signature delimiter starts
+it). In Markdown, references become reference-style links and the reference
+list becomes their definitions. In HTML, references become links to their
+URLs.
+
+From the command line:
+
+    $ python3 vim_mail_refs_convert.py --format html mail.txt > mail.html
+'''
+
+import argparse
+import html
+import re
+import shutil
+import sys
+import tempfile
+
+from vim_mail_refs import REF_RE
+from vim_mail_refs import SIGNATURE_START_RE
+from vim_mail_refs import RefWithUrl
+
+
+# Supported output formats.
+FORMATS = ('markdown', 'html')
+
+
+def get_ref_urls(lines):
+    '''Returns a dictionary mapping reference numbers to URLs from the
+    reference list of the mail.
+
+    The reference list is the last block of lines that look like its items
+    ([1] URL) that is followed only by empty lines up to the signature, which
+    starts at the last signature delimiter (as in vim_mail_refs). Only the
+    current block and the block before the last delimiter are kept, so the
+    lines can be an iterator over a large file.
+    '''
+    urls = {}
+    # Whether the current block is followed by an empty line.
+    closed = False
+    # URLs of the block before the last signature delimiter (None when there
+    # is no delimiter).
+    body_urls = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if re.match(SIGNATURE_START_RE, line):
+            # Lines up to this delimiter are the mail body unless there is
+            # another delimiter later.
+            body_urls = urls
+            urls = {}
+            closed = False
+            continue
+        ref_with_url = RefWithUrl.from_str(line)
+        if ref_with_url is not None:
+            if closed:
+                urls = {}
+                closed = False
+            urls[ref_with_url.ref.number] = ref_with_url.url
+        elif not line:
+            closed = bool(urls)
+        else:
+            urls = {}
+            closed = False
+    return urls if body_urls is None else body_urls
+
+
+def convert_to_markdown(lines, urls):
+    '''Generates lines of the mail converted to Markdown.
+
+    urls is a dictionary mapping reference numbers to URLs (see
+    get_ref_urls()). References without a URL are left as they are.
+    '''
+    def convert_ref(number):
+        if number not in urls:
+            return '[{}]'.format(number)
+        return r'[\[{0}\]][{0}]'.format(number)
+
+    def convert_body_line(line):
+        return _replace_refs(line, convert_ref, _identity)
+
+    def convert_ref_line(ref_with_url):
+        return '[{}]: {}'.format(ref_with_url.ref.number, ref_with_url.url)
+
+    return _convert(lines, convert_body_line, convert_ref_line, _identity)
+
+
+def convert_to_html(lines, urls):
+    '''Generates lines of the mail converted to HTML.
+
+    urls is a dictionary mapping reference numbers to URLs (see
+    get_ref_urls()). Every line ends with <br>. References without a URL are
+    left as they are.
+    '''
+    def convert_ref(number):
+        url = urls.get(number)
+        if url is None:
+            return '[{}]'.format(number)
+        return '<a href="{}">[{}]</a>'.format(html.escape(url), number)
+
+    def convert_body_line(line):
+        return _replace_refs(line, convert_ref, html.escape) + '<br>'
+
+    def convert_ref_line(ref_with_url):
+        return '<span id="ref-{0}">[{0}]</span> {1}<br>'.format(
+            ref_with_url.ref.number,
+            '<a href="{0}">{0}</a>'.format(html.escape(ref_with_url.url))
+        )
+
+    def convert_other_line(line):
+        return html.escape(line) + '<br>'
+
+    return _convert(
+        lines, convert_body_line, convert_ref_line, convert_other_line
+    )
+
+
+def convert_file(f, output_format):
+    '''Generates lines of the mail from the seekable file f converted to
+    output_format ('markdown' or 'html').
+
+    The file is read twice: first to get the URLs of references and then to
+    convert the mail.
+    '''
+    urls = get_ref_urls(f)
+    f.seek(0)
+    if output_format == 'html':
+        converter = convert_to_html
+    else:
+        converter = convert_to_markdown
+    yield from converter(f, urls)
+
+
+def _convert(lines, convert_body_line, convert_ref_line, convert_other_line):
+    '''Generates converted lines of the mail.
+
+    Lines that look like items of the reference list are held back until it is
+    clear whether they are the reference list at the end of the mail body or
+    just body lines. Similarly, lines from a signature delimiter on are held
+    back until it is clear whether it is the last delimiter (the start of the
+    signature) or whether they are a part of the body.
+    '''
+    pending = []
+    # Lines from the last signature delimiter on (None when there is none).
+    signature = None
+
+    def convert_line(line):
+        nonlocal pending
+        if RefWithUrl.from_str(line) is not None:
+            # Lines separated from this one by an empty line cannot be a part
+            # of the same reference list.
+            if pending and not pending[-1]:
+                for pending_line in pending:
+                    yield convert_body_line(pending_line)
+                pending = []
+            pending.append(line)
+        elif pending and not line:
+            pending.append(line)
+        else:
+            for pending_line in pending:
+                yield convert_body_line(pending_line)
+            pending = []
+            yield convert_body_line(line)
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if re.match(SIGNATURE_START_RE, line):
+            # The previous delimiter did not start the signature.
+            for body_line in signature or []:
+                yield from convert_line(body_line)
+            signature = [line]
+        elif signature is not None:
+            signature.append(line)
+        else:
+            yield from convert_line(line)
+
+    yield from _convert_ref_list(pending, convert_ref_line, convert_other_line)
+    for line in signature or []:
+        yield convert_other_line(line)
+
+
+def _convert_ref_list(lines, convert_ref_line, convert_other_line):
+    for line in lines:
+        ref_with_url = RefWithUrl.from_str(line)
+        if ref_with_url is None:
+            yield convert_other_line(line)
+        else:
+            yield convert_ref_line(ref_with_url)
+
+
+def _replace_refs(line, convert_ref, convert_text):
+    '''Returns the line with references converted by convert_ref(number) and
+    the text between them by convert_text(text).
+    '''
+    parts = []
+    last_end = 0
+    for m in REF_RE.finditer(line):
+        parts.append(convert_text(line[last_end:m.start(1)]))
+        parts.append(convert_ref(int(m.group(1)[1:-1])))
+        last_end = m.end(1)
+    parts.append(convert_text(line[last_end:]))
+    return ''.join(parts)
+
+
+def _identity(line):
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--format', choices=FORMATS, default='markdown',
+        help='output format (default: markdown)'
+    )
+    parser.add_argument(
+        'file', nargs='?', default='-',
+        help='mail to convert (default: standard input)'
+    )
+    args = parser.parse_args(argv)
+
+    if args.file == '-':
+        # The mail is read twice, so standard input is spooled into a
+        # temporary file.
+        f = tempfile.TemporaryFile('w+', encoding='utf-8')
+        shutil.copyfileobj(sys.stdin, f)
+        f.seek(0)
+    else:
+        f = open(args.file, encoding='utf-8')
+
+    with f:
+        for line in convert_file(f, args.format):
+            sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+import io
+import types
+import unittest
+
+from vim_mail_refs_convert import convert_file
+from vim_mail_refs_convert import convert_to_html
+from vim_mail_refs_convert import convert_to_markdown
+from vim_mail_refs_convert import get_ref_urls
+
+
+MAIL = [
+    'look at [1] and [2].',
+    '[3] is not known.',
+    '',
+    '[1] https://a.com/?x=1&y=2',
+    '[2] https://b.com',
+    '',
+    '-- ',
+    'Signature <me>'
+]
+
+MAIL_WITH_QUOTED_SIGNATURE = [
+    'look at [1] in the mail below.',
+    '-- ',
+    'Quoted signature',
+    '',
+    '[1] https://a.com',
+    '',
+    '-- ',
+    'Signature'
+]
+
+
+class GetRefUrlsTests(unittest.TestCase):
+    def test_returns_urls_of_references(self):
+        self.assertEqual(
+            get_ref_urls(MAIL),
+            {1: 'https://a.com/?x=1&y=2', 2: 'https://b.com'}
+        )
+
+    def test_ignores_signature(self):
+        urls = get_ref_urls(['look at [1].', '-- ', '[1] URL1'])
+
+        self.assertEqual(urls, {})
+
+    def test_signature_starts_at_last_delimiter(self):
+        urls = get_ref_urls(MAIL_WITH_QUOTED_SIGNATURE)
+
+        self.assertEqual(urls, {1: 'https://a.com'})
+
+
+class ConvertToMarkdownTests(unittest.TestCase):
+    def test_converts_references_to_reference_links(self):
+        lines = convert_to_markdown(MAIL, get_ref_urls(MAIL))
+
+        self.assertEqual(
+            list(lines),
+            [
+                r'look at [\[1\]][1] and [\[2\]][2].',
+                '[3] is not known.',
+                '',
+                '[1]: https://a.com/?x=1&y=2',
+                '[2]: https://b.com',
+                '',
+                '-- ',
+                'Signature <me>'
+            ]
+        )
+
+    def test_body_lines_looking_like_reference_list_are_kept(self):
+        mail = ['[1] https://a.com', 'is a link.']
+
+        lines = convert_to_markdown(mail, {1: 'https://a.com'})
+
+        self.assertEqual(
+            list(lines),
+            [r'[\[1\]][1] https://a.com', 'is a link.']
+        )
+
+    def test_only_lines_after_last_delimiter_are_signature(self):
+        lines = convert_to_markdown(
+            MAIL_WITH_QUOTED_SIGNATURE,
+            get_ref_urls(MAIL_WITH_QUOTED_SIGNATURE)
+        )
+
+        self.assertEqual(
+            list(lines),
+            [
+                r'look at [\[1\]][1] in the mail below.',
+                '-- ',
+                'Quoted signature',
+                '',
+                '[1]: https://a.com',
+                '',
+                '-- ',
+                'Signature'
+            ]
+        )
+
+    def test_returns_generator(self):
+        lines = convert_to_markdown(iter(MAIL), {})
+
+        self.assertIsInstance(lines, types.GeneratorType)
+
+
+class ConvertToHtmlTests(unittest.TestCase):
+    def test_converts_references_to_links(self):
+        lines = convert_to_html(MAIL, get_ref_urls(MAIL))
+
+        self.assertEqual(
+            list(lines),
+            [
+                'look at <a href="https://a.com/?x=1&amp;y=2">[1]</a> and '
+                '<a href="https://b.com">[2]</a>.<br>',
+                '[3] is not known.<br>',
+                '<br>',
+                '<span id="ref-1">[1]</span> '
+                '<a href="https://a.com/?x=1&amp;y=2">'
+                'https://a.com/?x=1&amp;y=2</a><br>',
+                '<span id="ref-2">[2]</span> '
+                '<a href="https://b.com">https://b.com</a><br>',
+                '<br>',
+                '-- <br>',
+                'Signature &lt;me&gt;<br>'
+            ]
+        )
+
+
+class ConvertFileTests(unittest.TestCase):
+    def test_converts_mail_from_file(self):
+        f = io.StringIO('look at [1].\n\n[1] https://a.com\n')
+
+        lines = convert_file(f, 'markdown')
+
+        self.assertEqual(
+            list(lines),
+            [r'look at [\[1\]][1].', '', '[1]: https://a.com']
+        )
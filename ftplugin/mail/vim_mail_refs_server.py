@@ -0,0 +1,542 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+'''An out-of-process reference engine for Vim.
+
+The server speaks the protocol of Vim channels in the JSON mode: every message
+is a JSON array [id, request] terminated by a newline and every response is
+[id, response]. It can either be started by Vim via job_start() and talk over
+stdin/stdout (--stdio), or listen on a TCP port of the loopback interface
+(--listen) and be shared by all Vim instances on the machine. The port is not
+authenticated, so every local user can talk to a shared server. Therefore, a
+shared server does not accept paths of files to write from its clients.
+
+A request is a dictionary with a 'method' key. Requests working with a buffer
+carry the buffer number and its b:changedtick. The lines of the buffer are sent
+only when the server does not have them yet; the server keeps them, together
+with the reference index, until the buffer changes. After a change, the client
+can send only the changed lines ('changed_lines': [start, end, lines] replacing
+lines [start, end) of the lines the server has for 'base_changedtick'), so
+only these lines are sent and scanned again. Edited lines sent back
+to Vim are kept only after Vim confirms that it has applied the edit by a
+'sync' request.
+'''
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import vim_mail_refs  # noqa: E402
+
+
+# Maximal number of URLs that are remembered in the URL history.
+HISTORY_SIZE = 1000
+
+
+class BufferState:
+    def __init__(self, changedtick, lines):
+        self.changedtick = changedtick
+        self.lines = lines
+        # Edit that the client has not confirmed yet (see 'sync').
+        self.pending_edit = None
+        self._scanned_rows = vim_mail_refs.ScannedRows(len(lines))
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = vim_mail_refs.RefIndex(
+                self.lines, self._scanned_rows
+            )
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        # The index was not built from the scanned rows (e.g. it was loaded
+        # from the cache), so they are filled in from it. Otherwise, the first
+        # change would scan all rows again.
+        self._scanned_rows.seed(self.lines, index)
+        self._index = index
+
+    @property
+    def built_index(self):
+        '''The index of the lines when it has already been built, or None.'''
+        return self._index
+
+    def apply_edit(self, edit):
+        '''Replaces lines [start, end) with lines from edit (start, end,
+        lines).
+        '''
+        start, end, lines = edit
+        self.lines = self.lines[:start] + lines + self.lines[end:]
+        self._scanned_rows.replace_rows(start, end, len(lines))
+        self.pending_edit = None
+        self._index = None
+
+
+class Server:
+    '''Handles requests from Vim.
+
+    Every client (connection) has its own buffers. The URL history is shared
+    among all clients. A shared server ignores cache directories sent by
+    clients and does not write traces.
+    '''
+
+    def __init__(self, history_size=HISTORY_SIZE, shared=False):
+        self._history_size = history_size
+        self._history = OrderedDict()
+        # Requests are handled in several threads at once.
+        self._history_lock = threading.Lock()
+        self._shared = shared
+        self._methods = {
+            'add_ref': self._add_ref,
+            'menu': self._menu,
+            'fix': self._fix,
+            'extract': self._extract,
+            'remove': self._remove,
+            'paste': self._paste,
+            'check': self._check,
+            'url_at': self._get_url_at,
+            'jump': self._get_jump_target,
+            'usages': self._get_usages,
+            'diagnostics': self._get_diagnostics,
+            'stats': self._get_stats,
+            'prewarm': self._prewarm,
+            'load_cache': self._load_cache,
+            'save_cache': self._save_cache,
+            'sync': self._sync,
+            'trace_start': self._start_tracing,
+            'trace_stop': self._stop_tracing,
+            'history': self._get_history,
+        }
+
+    def handle(self, buffers, request):
+        '''Handles the request and returns a response.
+
+        buffers is a dictionary mapping buffer numbers to a BufferState of the
+        client that sent the request.
+        '''
+        if request.get('method') == 'close':
+            buffers.pop(request.get('buffer'), None)
+            return {}
+
+        method_name = request.get('method')
+        method = self._methods.get(method_name)
+        if method is None:
+            return {'error': 'unknown method: {}'.format(method_name)}
+
+        try:
+            if 'buffer' not in request:
+                return method(None, request)
+
+            state = self._get_buffer_state(buffers, request)
+            if state is None:
+                return {'stale': True}
+            return method(state, request)
+        except Exception as e:
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    async def serve(self, reader, writer):
+        '''Serves a single client until it disconnects.'''
+        buffers = {}
+        loop = asyncio.get_event_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                msg_id, request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            # Operations with the buffer may take a while, so they are run
+            # outside of the event loop to keep serving other clients.
+            response = await loop.run_in_executor(
+                None, self.handle, buffers, request
+            )
+            writer.write(_encode_message(msg_id, response))
+            await writer.drain()
+        writer.close()
+
+    def _get_buffer_state(self, buffers, request):
+        bufnr = request['buffer']
+        changedtick = request.get('changedtick')
+        lines = request.get('lines')
+        changed_lines = request.get('changed_lines')
+        state = buffers.get(bufnr)
+        if lines is not None:
+            state = BufferState(changedtick, lines)
+            buffers[bufnr] = state
+        elif state is None:
+            return None
+        elif request['method'] == 'sync':
+            return state
+        elif changed_lines is not None:
+            if state.changedtick != request.get('base_changedtick'):
+                return None
+            state.apply_edit(changed_lines)
+            state.changedtick = changedtick
+        elif state.changedtick != changedtick:
+            return None
+        # An edit that was not confirmed by 'sync' before the next request
+        # has not been applied by the client (e.g. it has timed out).
+        state.pending_edit = None
+        return state
+
+    def _add_ref(self, state, request):
+        lines = state.lines[:]
+        ref_or_url = request['ref_or_url']
+        ordered = request.get('ordered', False)
+        cursor = vim_mail_refs.add_ref(
+            lines,
+            tuple(request['cursor']),
+            ref_or_url,
+            ordered=ordered,
+            index=state.index if ordered else None
+        )
+        if not _is_ref(ref_or_url):
+            self._remember_url(ref_or_url)
+        return self._edit_response(state, lines, cursor)
+
+    def _menu(self, state, request):
+        refs_with_urls = state.index.refs_with_urls
+        return {
+            'refs_with_urls': [
+                str(ref_with_url) for ref_with_url in refs_with_urls
+            ]
+        }
+
+    def _fix(self, state, request):
+        lines = state.lines[:]
+        line_range = request.get('range')
+        # Fixing the whole buffer scans it at once (possibly in parallel), so
+        # the index is built only for a range.
+        cursor = vim_mail_refs.fix_mail_refs(
+            lines,
+            tuple(request['cursor']),
+            tuple(line_range) if line_range else None,
+            index=state.index if line_range else state.built_index
+        )
+        return self._edit_response(state, lines, cursor)
+
+    def _extract(self, state, request):
+        lines = state.lines[:]
+        cursor = vim_mail_refs.extract_mail_refs(
+            lines, tuple(request['cursor'])
+        )
+        return self._edit_response(state, lines, cursor)
+
+    def _remove(self, state, request):
+        lines = state.lines[:]
+        cursor = vim_mail_refs.remove_ref(
+            lines, tuple(request['cursor']), index=state.index
+        )
+        return self._edit_response(state, lines, cursor)
+
+    def _paste(self, state, request):
+        lines = state.lines[:]
+        cursor = vim_mail_refs.paste_mail_refs(
+            lines, tuple(request['cursor']), request['text'],
+            index=state.index
+        )
+        return self._edit_response(state, lines, cursor)
+
+    def _check(self, state, request):
+        line_range = request.get('range')
+        problems = vim_mail_refs.check_mail_refs(
+            state.lines, tuple(line_range) if line_range else None
+        )
+        return {'problems': problems}
+
+    def _get_url_at(self, state, request):
+        return {'url': state.index.get_url_at(*request['cursor'])}
+
+    def _get_jump_target(self, state, request):
+        return {'target': state.index.get_jump_target(*request['cursor'])}
+
+    def _get_usages(self, state, request):
+        number, positions = state.index.get_usages(*request['cursor'])
+        return {'ref': number, 'positions': positions}
+
+    def _get_diagnostics(self, state, request):
+        dangling, unused = state.index.get_diagnostics()
+        return {
+            'dangling': [
+                [occurrence.row, occurrence.start, occurrence.end]
+                for occurrence in dangling
+            ],
+            'unused': [
+                [row, str(ref_with_url)] for row, ref_with_url in unused
+            ],
+        }
+
+    def _get_stats(self, state, request):
+        return dict(state.index.get_stats()._asdict())
+
+    def _prewarm(self, state, request):
+        # Build the index so that the following requests do not have to.
+        state.index
+        return {}
+
+    def _load_cache(self, state, request):
+        index = vim_mail_refs.read_cached_ref_index(
+            state.lines, request['path'], self._get_cache_dir(request)
+        )
+        if index is not None:
+            state.index = index
+        return {'loaded': index is not None}
+
+    def _save_cache(self, state, request):
+        vim_mail_refs.write_cached_ref_index(
+            state.index, state.lines, request['path'],
+            self._get_cache_dir(request)
+        )
+        return {}
+
+    def _get_cache_dir(self, request):
+        if self._shared:
+            return None
+        return request.get('cache_dir')
+
+    def _sync(self, state, request):
+        # The client has applied the last edit, so the edited lines correspond
+        # to the new b:changedtick.
+        if state.pending_edit is not None:
+            state.apply_edit(state.pending_edit)
+            state.changedtick = request['changedtick']
+        return {}
+
+    def _start_tracing(self, state, request):
+        if self._shared:
+            return {'error': 'tracing is not available on a shared server'}
+        vim_mail_refs.start_tracing()
+        return {}
+
+    def _stop_tracing(self, state, request):
+        if self._shared:
+            return {'error': 'tracing is not available on a shared server'}
+        events = vim_mail_refs.stop_tracing(request['path'])
+        return {'events': len(events)}
+
+    def _get_history(self, state, request):
+        prefix = request.get('prefix', '')
+        with self._history_lock:
+            urls = [
+                url for url in reversed(self._history)
+                if url.startswith(prefix)
+            ]
+        return {'urls': urls}
+
+    def _edit_response(self, state, lines, cursor):
+        edit = vim_mail_refs.get_lines_edit(state.lines, lines)
+        if edit is not None:
+            state.pending_edit = edit
+        return {'cursor': list(cursor), 'edit': edit}
+
+    def _remember_url(self, url):
+        with self._history_lock:
+            self._history.pop(url, None)
+            self._history[url] = None
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+
+
+def _is_ref(ref_or_url):
+    # The same rule as add_ref() uses to tell references from URLs.
+    return vim_mail_refs._parse_ref(ref_or_url) is not None
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False
+
+
+def _encode_message(msg_id, response):
+    return (json.dumps([msg_id, response]) + '\n').encode('utf-8')
+
+
+async def serve_stdio(server):
+    '''Serves a single client (Vim) over stdin and stdout.'''
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, sys.stdout
+    )
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    await server.serve(reader, writer)
+
+
+async def serve_tcp(server, host, port):
+    '''Serves all clients connecting to host:port.'''
+    tcp_server = await asyncio.start_server(server.serve, host, port)
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+async def run_load_test(sessions, requests_per_session, refs_per_mail=50):
+    '''Simulates sessions concurrent compose sessions against a local server.
+
+    Returns a dictionary with the number of requests, the total time and
+    latency percentiles (in milliseconds).
+    '''
+    server = Server()
+    tcp_server = await asyncio.start_server(server.serve, '127.0.0.1', 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    latencies = []
+
+    start = time.perf_counter()
+    async with tcp_server:
+        await asyncio.gather(*[
+            _run_session(port, requests_per_session, refs_per_mail, latencies)
+            for _ in range(sessions)
+        ])
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'total_s': total,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+async def _run_session(port, requests, refs_per_mail, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = _generate_mail(refs_per_mail)
+    changedtick = 1
+    msg_id = 0
+
+    async def call(request):
+        nonlocal msg_id
+        msg_id += 1
+        request_start = time.perf_counter()
+        writer.write(_encode_message(msg_id, request))
+        await writer.drain()
+        _, response = json.loads((await reader.readline()).decode('utf-8'))
+        latencies.append(time.perf_counter() - request_start)
+        return response
+
+    for i in range(requests):
+        request = {'buffer': 1, 'changedtick': changedtick}
+        if i == 0:
+            request['lines'] = lines
+        if i % 3 == 0:
+            await call(dict(request, method='menu'))
+            continue
+        if i % 3 == 1:
+            request.update(
+                method='add_ref',
+                cursor=[0, 0],
+                ref_or_url='https://example.com/{}'.format(i)
+            )
+        else:
+            request.update(method='fix', cursor=[0, 0])
+        response = await call(request)
+        if response.get('edit') is not None:
+            changedtick += 1
+            await call({
+                'method': 'sync', 'buffer': 1, 'changedtick': changedtick
+            })
+
+    writer.close()
+
+
+def _generate_mail(refs):
+    lines = ['Hi,', '']
+    lines.extend(
+        'see [{}] for more details.'.format(i) for i in range(1, refs + 1)
+    )
+    lines.append('')
+    lines.extend(
+        '[{}] https://example.com/{}'.format(i, i) for i in range(1, refs + 1)
+    )
+    return lines
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    i = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[i]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        '--stdio', action='store_true',
+        help='serve a single client over stdin and stdout'
+    )
+    group.add_argument(
+        '--listen', metavar='HOST:PORT',
+        help='serve all clients connecting to HOST:PORT (HOST has to be a '
+             'loopback address)'
+    )
+    group.add_argument(
+        '--load-test', metavar='SESSIONS', type=int,
+        help='run a load test with SESSIONS concurrent sessions'
+    )
+    parser.add_argument(
+        '--requests', type=int, default=100,
+        help='number of requests per session in the load test'
+    )
+    parser.add_argument(
+        '--tracking-params', metavar='PARAMS',
+        help='comma-separated query parameters ignored when comparing URLs'
+    )
+    parser.add_argument(
+        '--scan-workers', metavar='WORKERS', type=int, default=0,
+        help='number of processes scanning large mails (default: 0, none)'
+    )
+    args = parser.parse_args(argv)
+
+    if args.tracking_params is not None:
+        vim_mail_refs.set_tracking_params(
+            param for param in args.tracking_params.split(',') if param
+        )
+    # The scanning processes are set up before the event loop starts threads
+    # of its executor.
+    vim_mail_refs.set_scan_workers(args.scan_workers)
+
+    if args.load_test is not None:
+        stats = asyncio.run(run_load_test(args.load_test, args.requests))
+        print(json.dumps(stats, indent=2))
+        return
+
+    if args.listen is not None:
+        host, port = args.listen.rsplit(':', 1)
+        if not _is_loopback(host):
+            parser.error('{} is not a loopback address'.format(host))
+
+    try:
+        if args.stdio:
+            asyncio.run(serve_stdio(Server()))
+        else:
+            asyncio.run(serve_tcp(Server(shared=True), host, int(port)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,622 @@
+#
+# Project:   vim-mail-refs
+# Copyright: (c) 2016 by Daniela Ďuričeková <daniela.duricekova@protonmail.com>
+#            and contributors
+# License:   MIT, see the LICENSE file for more details
+#
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+import vim_mail_refs
+
+from vim_mail_refs import Ref
+from vim_mail_refs import RefWithUrl
+from vim_mail_refs_server import Server
+from vim_mail_refs_server import run_load_test
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.buffers = {}
+
+    def handle(self, **request):
+        return self.server.handle(self.buffers, request)
+
+    def test_returns_error_for_unknown_method(self):
+        response = self.handle(method='xxx')
+
+        self.assertIn('error', response)
+
+    def test_add_ref_returns_edit_and_cursor(self):
+        response = self.handle(
+            method='add_ref',
+            buffer=1,
+            changedtick=1,
+            lines=['look at '],
+            cursor=[0, 7],
+            ref_or_url='URL'
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [0, 1, ['look at [1]', '', '[1] URL']]
+        )
+        self.assertEqual(response['cursor'], [0, 10])
+
+    def test_requests_lines_when_buffer_is_unknown(self):
+        response = self.handle(method='menu', buffer=1, changedtick=1)
+
+        self.assertEqual(response, {'stale': True})
+
+    def test_requests_lines_when_buffer_has_changed(self):
+        self.handle(method='menu', buffer=1, changedtick=1, lines=[''])
+
+        response = self.handle(method='menu', buffer=1, changedtick=2)
+
+        self.assertEqual(response, {'stale': True})
+
+    def test_keeps_lines_of_buffer_between_requests(self):
+        self.handle(
+            method='menu',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1']
+        )
+
+        response = self.handle(method='menu', buffer=1, changedtick=1)
+
+        self.assertEqual(response, {'refs_with_urls': ['[1] URL1']})
+
+    def test_keeps_edited_lines_after_sync(self):
+        self.handle(
+            method='add_ref',
+            buffer=1,
+            changedtick=1,
+            lines=['look at '],
+            cursor=[0, 7],
+            ref_or_url='URL'
+        )
+        self.handle(method='sync', buffer=1, changedtick=2)
+
+        response = self.handle(method='menu', buffer=1, changedtick=2)
+
+        self.assertEqual(response, {'refs_with_urls': ['[1] URL']})
+
+    def test_applies_changed_lines(self):
+        self.handle(
+            method='menu',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1']
+        )
+
+        response = self.handle(
+            method='diagnostics',
+            buffer=1,
+            changedtick=3,
+            base_changedtick=1,
+            changed_lines=[0, 1, ['look at [1] and [2].', 'New line.']]
+        )
+
+        self.assertEqual(response['dangling'], [[0, 16, 19]])
+
+    def test_requests_lines_when_changed_lines_have_other_base(self):
+        self.handle(method='menu', buffer=1, changedtick=1, lines=[''])
+
+        response = self.handle(
+            method='menu',
+            buffer=1,
+            changedtick=3,
+            base_changedtick=2,
+            changed_lines=[0, 1, ['look at [1].']]
+        )
+
+        self.assertEqual(response, {'stale': True})
+
+    def test_forgets_edited_lines_that_were_not_synced(self):
+        self.handle(
+            method='fix',
+            buffer=1,
+            changedtick=1,
+            lines=['see [2] [1]', '', '[1] http://a', '[2] http://b'],
+            cursor=[0, 0]
+        )
+
+        # The client has not applied the edit, so it sends the same
+        # changedtick again.
+        response = self.handle(
+            method='add_ref',
+            buffer=1,
+            changedtick=1,
+            cursor=[0, 11],
+            ref_or_url='http://c'
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [0, 4, [
+                'see [2] [1] [3]',
+                '',
+                '[1] http://a',
+                '[2] http://b',
+                '[3] http://c'
+            ]]
+        )
+
+    def test_ignores_sync_without_edit(self):
+        self.handle(method='menu', buffer=1, changedtick=1, lines=[''])
+        self.handle(method='sync', buffer=1, changedtick=2)
+
+        response = self.handle(method='menu', buffer=1, changedtick=2)
+
+        self.assertEqual(response, {'stale': True})
+
+    def test_fix_returns_edit_and_cursor(self):
+        response = self.handle(
+            method='fix',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [2].', '', '[2] URL'],
+            cursor=[0, 0]
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [0, 3, ['look at [1].', '', '[1] URL']]
+        )
+        self.assertEqual(response['cursor'], [0, 0])
+
+    def test_extract_returns_edit_and_cursor(self):
+        response = self.handle(
+            method='extract',
+            buffer=1,
+            changedtick=1,
+            lines=['see https://a.com'],
+            cursor=[0, 2]
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [0, 1, ['see [1]', '', '[1] https://a.com']]
+        )
+        self.assertEqual(response['cursor'], [0, 2])
+
+    def test_add_ref_can_number_reference_by_its_position(self):
+        response = self.handle(
+            method='add_ref',
+            buffer=1,
+            changedtick=1,
+            lines=['a ', 'b [1]', '', '[1] URL1'],
+            cursor=[0, 1],
+            ref_or_url='URL2',
+            ordered=True
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [0, 4, ['a [1]', 'b [2]', '', '[1] URL2', '[2] URL1']]
+        )
+
+    def test_remove_returns_edit_and_cursor(self):
+        response = self.handle(
+            method='remove',
+            buffer=1,
+            changedtick=1,
+            lines=['a [1] b', '', '[1] URL1'],
+            cursor=[0, 3]
+        )
+
+        self.assertEqual(response['edit'], [0, 3, ['a b']])
+        self.assertEqual(response['cursor'], [0, 1])
+
+    def test_url_at_returns_url_of_reference_under_cursor(self):
+        response = self.handle(
+            method='url_at',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1'],
+            cursor=[0, 9]
+        )
+
+        self.assertEqual(response, {'url': 'URL1'})
+
+    def test_url_at_returns_None_when_there_is_no_reference(self):
+        response = self.handle(
+            method='url_at',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1'],
+            cursor=[0, 2]
+        )
+
+        self.assertEqual(response, {'url': None})
+
+    def test_jump_returns_position_of_url(self):
+        response = self.handle(
+            method='jump',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1'],
+            cursor=[0, 9]
+        )
+
+        self.assertEqual(response, {'target': (2, 0)})
+
+    def test_usages_returns_positions_of_all_uses(self):
+        response = self.handle(
+            method='usages',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', 'Also [1].', '', '[1] URL1'],
+            cursor=[3, 0]
+        )
+
+        self.assertEqual(response, {'ref': 1, 'positions': [(0, 8), (1, 5)]})
+
+    def test_diagnostics_returns_dangling_references_and_unused_urls(self):
+        response = self.handle(
+            method='diagnostics',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [2].', '', '[1] URL1'],
+        )
+
+        self.assertEqual(
+            response,
+            {'dangling': [[0, 8, 11]], 'unused': [[2, '[1] URL1']]}
+        )
+
+    def test_stats_returns_statistics_of_references(self):
+        response = self.handle(
+            method='stats',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [2] and [2].', '', '[1] URL1'],
+        )
+
+        self.assertEqual(
+            response,
+            {
+                'total': 2,
+                'used': 1,
+                'defined': 1,
+                'dangling': 1,
+                'needs_renumbering': True
+            }
+        )
+
+    def test_prewarm_keeps_lines_of_buffer(self):
+        self.handle(
+            method='prewarm',
+            buffer=1,
+            changedtick=1,
+            lines=['look at [1].', '', '[1] URL1']
+        )
+
+        response = self.handle(method='menu', buffer=1, changedtick=1)
+
+        self.assertEqual(response, {'refs_with_urls': ['[1] URL1']})
+
+    def test_saved_index_is_loaded_for_same_path_and_lines(self):
+        lines = ['look at [1].', '', '[1] URL1']
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.handle(
+                method='save_cache',
+                buffer=1,
+                changedtick=1,
+                lines=lines,
+                path='/mail',
+                cache_dir=cache_dir
+            )
+            self.buffers.clear()
+
+            response = self.handle(
+                method='load_cache',
+                buffer=1,
+                changedtick=1,
+                lines=lines,
+                path='/mail',
+                cache_dir=cache_dir
+            )
+
+        self.assertEqual(response, {'loaded': True})
+        self.assertEqual(
+            self.buffers[1].index.refs_with_urls,
+            [RefWithUrl(Ref(1), 'URL1')]
+        )
+
+    def test_loaded_index_is_updated_by_scanning_only_changed_rows(self):
+        lines = ['look at [1].', 'and [2].', '', '[1] URL1', '[2] URL2']
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.handle(
+                method='save_cache',
+                buffer=1,
+                changedtick=1,
+                lines=lines,
+                path='/mail',
+                cache_dir=cache_dir
+            )
+            self.buffers.clear()
+            self.handle(
+                method='load_cache',
+                buffer=1,
+                changedtick=1,
+                lines=lines,
+                path='/mail',
+                cache_dir=cache_dir
+            )
+
+        with mock.patch.object(
+                vim_mail_refs, '_get_refs_in_line',
+                wraps=vim_mail_refs._get_refs_in_line) as get_refs_in_line:
+            response = self.handle(
+                method='stats',
+                buffer=1,
+                changedtick=2,
+                base_changedtick=1,
+                changed_lines=[1, 2, ['and [3].']]
+            )
+
+        self.assertCountEqual(
+            [call[0][0] for call in get_refs_in_line.call_args_list],
+            ['and [3].', '[1] URL1', '[2] URL2']
+        )
+        self.assertEqual(response['dangling'], 1)
+
+    def test_load_cache_reports_when_nothing_is_cached(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            response = self.handle(
+                method='load_cache',
+                buffer=1,
+                changedtick=1,
+                lines=['look at [1].'],
+                path='/mail',
+                cache_dir=cache_dir
+            )
+
+        self.assertEqual(response, {'loaded': False})
+
+    def test_trace_contains_phases_of_commands(self):
+        self.handle(method='trace_start')
+        self.handle(
+            method='fix',
+            buffer=1,
+            changedtick=1,
+            lines=['[2] [1]', '', '[1] A', '[2] B'],
+            cursor=[0, 0]
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'trace.json')
+
+            response = self.handle(method='trace_stop', path=path)
+
+            with open(path) as f:
+                trace = json.load(f)
+        names = [event['name'] for event in trace['traceEvents']]
+        self.assertEqual(response, {'events': len(names)})
+        self.assertIn('fix_mail_refs', names)
+        self.assertIn('_renumber_refs', names)
+
+    def test_paste_returns_edit_with_remapped_references(self):
+        response = self.handle(
+            method='paste',
+            buffer=1,
+            changedtick=1,
+            lines=['see [1]', '', '[1] URL1'],
+            cursor=[0, 0],
+            text=['pasted [1] and [2]', '', '[1] URL2', '[2] URL1']
+        )
+
+        self.assertEqual(
+            response,
+            {
+                'cursor': [1, 0],
+                'edit': [1, 3, ['pasted [2] and [1]', '', '[1] URL1',
+                                '[2] URL2']]
+            }
+        )
+
+    def test_fix_can_be_limited_to_range(self):
+        response = self.handle(
+            method='fix',
+            buffer=1,
+            changedtick=1,
+            lines=[
+                '[2] [1]', '[4] [3]', '', '[1] A', '[2] B', '[3] C', '[4] D'
+            ],
+            cursor=[0, 0],
+            range=[1, 2]
+        )
+
+        self.assertEqual(
+            response['edit'],
+            [1, 7, ['[3] [4]', '', '[1] A', '[2] B', '[3] D', '[4] C']]
+        )
+
+    def test_editing_requests_reuse_index_of_buffer(self):
+        lines = ['[2] [1]', '', '[1] A', '[2] B']
+        requests = [
+            dict(method='add_ref', cursor=[0, 7], ref_or_url='C',
+                 ordered=True),
+            dict(method='fix', cursor=[0, 0], range=[0, 1]),
+            dict(method='remove', cursor=[0, 1]),
+            dict(method='paste', cursor=[0, 0], text=['[1]', '', '[1] A']),
+        ]
+        for request in requests:
+            with self.subTest(method=request['method']):
+                self.handle(
+                    method='prewarm', buffer=1, changedtick=1, lines=lines
+                )
+
+                with mock.patch.object(
+                        vim_mail_refs, 'RefIndex',
+                        side_effect=AssertionError('index was rebuilt')):
+                    response = self.handle(buffer=1, changedtick=1, **request)
+
+                self.assertIsNotNone(response.get('edit'), response)
+
+    def test_fix_of_whole_buffer_reuses_built_index(self):
+        self.handle(
+            method='prewarm',
+            buffer=1,
+            changedtick=1,
+            lines=['[2] [1]', '', '[1] A', '[2] B']
+        )
+
+        with mock.patch.object(vim_mail_refs, '_scan_refs') as scan_refs:
+            response = self.handle(
+                method='fix', buffer=1, changedtick=1, cursor=[0, 0]
+            )
+
+        scan_refs.assert_not_called()
+        self.assertEqual(
+            response['edit'], [0, 4, ['[1] [2]', '', '[1] B', '[2] A']]
+        )
+
+    def test_check_returns_problems_in_range(self):
+        response = self.handle(
+            method='check',
+            buffer=1,
+            changedtick=1,
+            lines=['[2]', '[3]', '', '[1] A'],
+            range=[1, 2]
+        )
+
+        self.assertEqual(
+            response,
+            {'problems': [(1, 0, 'reference [3] has no URL')]}
+        )
+
+    def test_close_forgets_buffer(self):
+        self.handle(method='menu', buffer=1, changedtick=1, lines=[''])
+
+        self.handle(method='close', buffer=1)
+
+        self.assertEqual(self.buffers, {})
+
+    def test_history_is_shared_among_clients(self):
+        self.server.handle({}, {
+            'method': 'add_ref',
+            'buffer': 1,
+            'changedtick': 1,
+            'lines': [''],
+            'cursor': [0, 0],
+            'ref_or_url': 'https://a'
+        })
+
+        response = self.server.handle({}, {
+            'method': 'history',
+            'prefix': 'https:'
+        })
+
+        self.assertEqual(response, {'urls': ['https://a']})
+
+    def test_history_can_be_changed_from_several_threads(self):
+        def add_urls(thread):
+            for i in range(1000):
+                url = 'https://{}.com/{}'.format(thread, i)
+                self.server._remember_url(url)
+                self.handle(method='history', prefix='https://')
+
+        threads = [
+            threading.Thread(target=add_urls, args=(i,)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            len(self.handle(method='history', prefix='')['urls']), 1000
+        )
+
+    def test_returns_error_when_request_without_buffer_fails(self):
+        response = self.handle(method='trace_stop')
+
+        self.assertIn('error', response)
+
+    def test_shared_server_ignores_cache_dir_of_client(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                tempfile.TemporaryDirectory() as cache_home, \
+                mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            other_file = os.path.join(cache_dir, 'other.json')
+            with open(other_file, 'w') as f:
+                f.write('{}')
+            server = Server(shared=True)
+
+            server.handle({}, {
+                'method': 'save_cache',
+                'buffer': 1,
+                'changedtick': 1,
+                'lines': ['look at [1].'],
+                'path': '/mail',
+                'cache_dir': cache_dir
+            })
+
+            self.assertEqual(os.listdir(cache_dir), ['other.json'])
+            self.assertEqual(
+                len(os.listdir(os.path.join(cache_home, 'vim-mail-refs'))), 1
+            )
+
+    def test_shared_server_does_not_write_traces(self):
+        server = Server(shared=True)
+
+        response = server.handle({}, {'method': 'trace_start'})
+
+        self.assertIn('error', response)
+
+    def test_references_are_not_put_into_history(self):
+        self.handle(
+            method='add_ref',
+            buffer=1,
+            changedtick=1,
+            lines=['[1]', '', '[1] URL'],
+            cursor=[0, 0],
+            ref_or_url='1'
+        )
+
+        response = self.handle(method='history')
+
+        self.assertEqual(response, {'urls': []})
+
+
+class ServeTests(unittest.TestCase):
+    def test_responds_with_same_message_id(self):
+        async def communicate():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'[7, {"method": "history"}]\n')
+            reader.feed_eof()
+            writer = FakeWriter()
+            await Server().serve(reader, writer)
+            return writer.data
+
+        data = asyncio.run(communicate())
+
+        self.assertEqual(json.loads(data.decode('utf-8')), [7, {'urls': []}])
+
+    def test_load_test_reports_all_requests(self):
+        stats = asyncio.run(run_load_test(sessions=3, requests_per_session=4))
+
+        self.assertGreaterEqual(stats['requests'], 3 * 4)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
@@ -5,13 +5,62 @@
 # License:   MIT, see the LICENSE file for more details
 #
 
+import json
+import os
+import re
+import tempfile
 import unittest
 
+from unittest import mock
+
+import vim_mail_refs
+
+from vim_mail_refs import TRACKING_PARAMS
 from vim_mail_refs import Ref
+from vim_mail_refs import RefDiagnostics
+from vim_mail_refs import RefIndex
+from vim_mail_refs import RefOccurrence
+from vim_mail_refs import RefStats
 from vim_mail_refs import RefWithUrl
 from vim_mail_refs import add_ref
+from vim_mail_refs import canonicalize_url
+from vim_mail_refs import check_mail_refs
+from vim_mail_refs import extract_mail_refs
 from vim_mail_refs import fix_mail_refs
+from vim_mail_refs import forget_ref_index
+from vim_mail_refs import get_lines_edit
+from vim_mail_refs import get_ref_diagnostics
+from vim_mail_refs import get_ref_index
+from vim_mail_refs import get_ref_jump_target
+from vim_mail_refs import get_ref_stats
+from vim_mail_refs import get_ref_usages
 from vim_mail_refs import get_refs_with_urls_for_menu
+from vim_mail_refs import get_url_at_cursor
+from vim_mail_refs import index_ref_matches
+from vim_mail_refs import load_ref_index
+from vim_mail_refs import paste_mail_refs
+from vim_mail_refs import prewarm_ref_index
+from vim_mail_refs import read_cached_ref_index
+from vim_mail_refs import remove_ref
+from vim_mail_refs import replace_rows
+from vim_mail_refs import save_ref_index
+from vim_mail_refs import set_scan_workers
+from vim_mail_refs import set_tracking_params
+from vim_mail_refs import start_tracing
+from vim_mail_refs import stop_tracing
+from vim_mail_refs import track_rows
+from vim_mail_refs import write_cached_ref_index
+
+
+class Buffer(list):
+    '''Lines with a number, so that their index is cached like the index of a
+    Vim buffer.
+    '''
+
+    def __init__(self, lines, number=1):
+        super().__init__(lines)
+        self.number = number
+        forget_ref_index(number)
 
 
 class RefTests(unittest.TestCase):
@@ -88,6 +137,25 @@ class AddRefTests(unittest.TestCase):
         )
         self.assertEqual(new_cursor, (0, 2))
 
+    def test_existing_ref_is_reused_for_equivalent_url(self):
+        buffer = [
+            'see [1] and',
+            #         ^
+            '',
+            '[1] https://a.com/x'
+        ]
+
+        add_ref(buffer, cursor=(0, 10), ref_or_url='https://A.com/x/')
+
+        self.assertEqual(
+            buffer,
+            [
+                'see [1] and [1]',
+                '',
+                '[1] https://a.com/x'
+            ]
+        )
+
     def test_ref_is_appended_correctly_when_buffer_is_not_empty(self):
         buffer = ['look at ']
         #                 ^
@@ -393,6 +461,278 @@ class AddRefTests(unittest.TestCase):
         self.assertEqual(new_cursor, (1, 15))
 
 
+class AddOrderedRefTests(unittest.TestCase):
+    def test_ref_is_added_correctly_when_buffer_is_empty(self):
+        buffer = ['']
+
+        new_cursor = add_ref(
+            buffer, cursor=(0, 0), ref_or_url='URL', ordered=True
+        )
+
+        self.assertEqual(
+            buffer,
+            [
+                '[1]',
+                #  ^
+                '',
+                '[1] URL'
+            ]
+        )
+        self.assertEqual(new_cursor, (0, 2))
+
+    def test_new_ref_gets_number_by_its_position(self):
+        buffer = [
+            'look at [1].',
+            'Also look at .',
+            #            ^
+            'And finally at [2] and [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+        new_cursor = add_ref(
+            buffer, cursor=(1, 12), ref_or_url='URL4', ordered=True
+        )
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'Also look at [2].',
+                #               ^
+                'And finally at [3] and [4].',
+                '',
+                '[1] URL1',
+                '[2] URL4',
+                '[3] URL2',
+                '[4] URL3',
+                '',
+                '-- ',
+                'Signature'
+            ]
+        )
+        self.assertEqual(new_cursor, (1, 15))
+
+    def test_shifts_references_with_huge_numbers(self):
+        buffer = [
+            'look at .',
+            #       ^
+            'And at [999999999].',
+            '',
+            '[999999999] URL1'
+        ]
+
+        add_ref(buffer, cursor=(0, 7), ref_or_url='URL2', ordered=True)
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'And at [1000000000].',
+                '',
+                '[1] URL2',
+                '[1000000000] URL1'
+            ]
+        )
+
+    def test_cursor_is_moved_when_refs_before_it_get_longer(self):
+        buffer = [
+            'look at [9] and .',
+            #               ^
+            'Also [1], [2], [3], [4], [5], [6], [7], [8].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '[4] URL4',
+            '[5] URL5',
+            '[6] URL6',
+            '[7] URL7',
+            '[8] URL8',
+            '[9] URL9'
+        ]
+
+        new_cursor = add_ref(
+            buffer, cursor=(0, 15), ref_or_url='URL10', ordered=True
+        )
+
+        self.assertEqual(buffer[0], 'look at [9] and [10].')
+        self.assertEqual(buffer[-1], '[10] URL10')
+        self.assertEqual(new_cursor, (0, 19))
+
+    def test_uses_existing_ref_when_url_has_already_been_added(self):
+        buffer = [
+            'look at .',
+            #       ^
+            'Also look at [1] and [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        new_cursor = add_ref(
+            buffer, cursor=(0, 7), ref_or_url='URL2', ordered=True
+        )
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [2].',
+                #          ^
+                'Also look at [1] and [2].',
+                '',
+                '[1] URL1',
+                '[2] URL2'
+            ]
+        )
+        self.assertEqual(new_cursor, (0, 10))
+
+
+class RemoveRefTests(unittest.TestCase):
+    def test_does_nothing_when_cursor_is_not_on_reference(self):
+        buffer = [
+            'look at [1].',
+            #  ^
+            '',
+            '[1] URL1'
+        ]
+        orig_buffer = buffer[:]
+
+        new_cursor = remove_ref(buffer, cursor=(0, 2))
+
+        self.assertEqual(buffer, orig_buffer)
+        self.assertEqual(new_cursor, (0, 2))
+
+    def test_shifts_references_with_huge_numbers(self):
+        buffer = [
+            'look at [1] and [999999999].',
+            #         ^
+            '',
+            '[1] URL1',
+            '[999999999] URL2'
+        ]
+
+        remove_ref(buffer, cursor=(0, 9))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at and [999999998].',
+                '',
+                '[999999998] URL2'
+            ]
+        )
+
+    def test_keeps_url_when_reference_is_still_used(self):
+        buffer = [
+            'look at [1] and [2].',
+            #         ^
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        new_cursor = remove_ref(buffer, cursor=(0, 9))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at and [2].',
+                #       ^
+                'Also look at [1].',
+                '',
+                '[1] URL1',
+                '[2] URL2'
+            ]
+        )
+        self.assertEqual(new_cursor, (0, 7))
+
+    def test_removes_url_and_renumbers_following_references(self):
+        buffer = [
+            'look at [1], [2] and [3].',
+            #              ^
+            'Also look at [3] and [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+        new_cursor = remove_ref(buffer, cursor=(0, 14))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1], and [2].',
+                #            ^
+                'Also look at [2] and [1].',
+                '',
+                '[1] URL1',
+                '[2] URL3',
+                '',
+                '-- ',
+                'Signature'
+            ]
+        )
+        self.assertEqual(new_cursor, (0, 12))
+
+    def test_removes_all_uses_when_cursor_is_on_url(self):
+        buffer = [
+            'look at [1] and [2].',
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            #     ^
+            '[2] URL2'
+        ]
+
+        new_cursor = remove_ref(buffer, cursor=(3, 5))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at and [1].',
+                'Also look at.',
+                '',
+                '[1] URL2'
+                #     ^
+            ]
+        )
+        self.assertEqual(new_cursor, (3, 5))
+
+    def test_removes_empty_reference_list(self):
+        buffer = [
+            'look at [1].',
+            #         ^
+            '',
+            '[1] URL1',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+        remove_ref(buffer, cursor=(0, 9))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at.',
+                '',
+                '-- ',
+                'Signature'
+            ]
+        )
+
+
 class GetRefsWithUrlsForMenuTests(unittest.TestCase):
     def test_return_empty_list_when_there_are_no_references(self):
         buffer = []
@@ -420,6 +760,20 @@ class GetRefsWithUrlsForMenuTests(unittest.TestCase):
             ]
         )
 
+    def test_returns_correct_list_when_changedtick_is_given(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] url1',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+        refs_with_urls = get_refs_with_urls_for_menu(buffer, changedtick=1)
+
+        self.assertEqual(refs_with_urls, ['[1] url1'])
+
     def test_returns_correct_list_when_there_is_signature(self):
         buffer = [
             'look at [1].',
@@ -747,3 +1101,1386 @@ class FixMailRefsTests(unittest.TestCase):
             ]
         )
         self.assertEqual(new_cursor, (0, 12))
+
+    def test_merges_references_to_equivalent_urls(self):
+        buffer = [
+            'look at [1], [2] and [3].',
+            '',
+            '[1] https://a.com/x',
+            '[2] https://b.com',
+            '[3] HTTPS://A.com/x/?utm_source=news'
+        ]
+
+        fix_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1], [2] and [1].',
+                '',
+                '[1] https://a.com/x',
+                '[2] https://b.com'
+            ]
+        )
+
+
+class ParallelFixMailRefsTests(unittest.TestCase):
+    def setUp(self):
+        self.orig_min_lines = vim_mail_refs.PARALLEL_SCAN_MIN_LINES
+        vim_mail_refs.PARALLEL_SCAN_MIN_LINES = 1
+        set_scan_workers(3)
+
+    def tearDown(self):
+        set_scan_workers(0)
+        vim_mail_refs.PARALLEL_SCAN_MIN_LINES = self.orig_min_lines
+
+    def test_result_is_same_as_when_scanned_at_once(self):
+        buffer = [
+            'look at [5] and [3].',
+            'Also look at [3]',
+            '[1][2] is not a reference, [4] is.',
+            '',
+            'Then [3], [6] and [5].',
+            'And [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '[4] URL4',
+            '[5] URL5',
+            '[6] URL6',
+            '',
+            '-- ',
+            'Signature'
+        ]
+        expected_buffer = buffer[:]
+        set_scan_workers(0)
+        fix_mail_refs(expected_buffer, cursor=(0, 0))
+        set_scan_workers(3)
+
+        fix_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(buffer, expected_buffer)
+        self.assertEqual(
+            buffer[:6],
+            [
+                'look at [1] and [2].',
+                'Also look at [2]',
+                '[1][2] is not a reference, [3] is.',
+                '',
+                'Then [2], [4] and [1].',
+                'And [5].',
+            ]
+        )
+
+    def test_chunks_return_only_integers(self):
+        occurrences, numbers = vim_mail_refs._scan_chunk(
+            ['none', 'look at [2] and [1][2] and [2].'], 5
+        )
+
+        self.assertEqual(occurrences, [(6, 8, 11, 2), (6, 27, 30, 2)])
+        self.assertEqual(numbers, [2])
+
+    def test_mail_body_is_scanned_only_once(self):
+        buffer = ['look at [2] and [1].', '', '[1] URL1', '[2] URL2', '[3] X']
+
+        with mock.patch.object(
+                vim_mail_refs, '_scan_refs',
+                wraps=vim_mail_refs._scan_refs) as scan_refs:
+            fix_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(scan_refs.call_count, 1)
+        self.assertEqual(
+            buffer, ['look at [1] and [2].', '', '[1] URL2', '[2] URL1']
+        )
+
+
+class CanonicalizeUrlTests(unittest.TestCase):
+    def tearDown(self):
+        set_tracking_params(TRACKING_PARAMS)
+
+    def test_lowercases_scheme_and_host_but_not_path(self):
+        self.assertEqual(
+            canonicalize_url('HTTPS://User@Example.COM/Path'),
+            'https://User@example.com/Path'
+        )
+
+    def test_removes_trailing_slash(self):
+        self.assertEqual(
+            canonicalize_url('https://example.com/a/'),
+            'https://example.com/a'
+        )
+        self.assertEqual(
+            canonicalize_url('https://example.com/'),
+            'https://example.com'
+        )
+
+    def test_removes_tracking_params(self):
+        self.assertEqual(
+            canonicalize_url(
+                'https://example.com/?utm_source=x&id=1&utm_medium=y#top'
+            ),
+            'https://example.com?id=1#top'
+        )
+
+    def test_removes_given_tracking_params(self):
+        self.assertEqual(
+            canonicalize_url('https://example.com/?ref=x&id=1', ['ref']),
+            'https://example.com?id=1'
+        )
+
+    def test_removes_tracking_params_set_by_set_tracking_params(self):
+        set_tracking_params(['ref'])
+
+        self.assertEqual(
+            canonicalize_url('https://example.com/?ref=x&utm_source=y'),
+            'https://example.com?utm_source=y'
+        )
+
+    def test_returns_strings_that_are_not_urls_unchanged(self):
+        self.assertEqual(canonicalize_url('URL1/'), 'URL1/')
+
+
+class RefIndexTests(unittest.TestCase):
+    def test_index_of_empty_buffer_is_empty(self):
+        index = RefIndex([])
+
+        self.assertEqual(index.refs_with_urls, [])
+        self.assertEqual(index.occurrences, [])
+
+    def test_finds_references_in_mail_body(self):
+        index = RefIndex([
+            'look at [1] and [2].',
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ])
+
+        self.assertEqual(
+            index.occurrences,
+            [
+                RefOccurrence(0, 8, 11, Ref(1)),
+                RefOccurrence(0, 16, 19, Ref(2)),
+                RefOccurrence(1, 13, 16, Ref(1))
+            ]
+        )
+
+    def test_finds_reference_list_before_signature(self):
+        index = RefIndex([
+            'look at [1].',
+            '',
+            '[1] URL1',
+            '',
+            '-- ',
+            'Signature [2]',
+            '[2] xxx'
+        ])
+
+        self.assertEqual(index.body_end, 4)
+        self.assertEqual((index.ref_list_start, index.ref_list_end), (2, 3))
+        self.assertEqual(index.refs_with_urls, [RefWithUrl(Ref(1), 'URL1')])
+        self.assertEqual(index.occurrences, [RefOccurrence(0, 8, 11, Ref(1))])
+
+    def test_list_bounds_point_after_body_when_there_is_no_list(self):
+        index = RefIndex([
+            'Hello!',
+            '',
+            '-- ',
+            'Signature'
+        ])
+
+        self.assertEqual((index.ref_list_start, index.ref_list_end), (1, 1))
+
+    def test_get_ref_at_returns_reference_at_position(self):
+        index = RefIndex([
+            'look at [1] and [12].',
+            '',
+            '[1] URL1',
+            '[12] URL12'
+        ])
+
+        self.assertIsNone(index.get_ref_at(0, 7))
+        self.assertEqual(index.get_ref_at(0, 8).ref, Ref(1))
+        self.assertEqual(index.get_ref_at(0, 10).ref, Ref(1))
+        self.assertIsNone(index.get_ref_at(0, 11))
+        self.assertEqual(index.get_ref_at(0, 19).ref, Ref(12))
+        self.assertIsNone(index.get_ref_at(1, 0))
+        self.assertIsNone(index.get_ref_at(2, 0))
+
+
+class GetRefIndexTests(unittest.TestCase):
+    def test_reuses_index_when_changedtick_is_same(self):
+        buffer = Buffer(['look at [1].'])
+
+        index = get_ref_index(buffer, changedtick=1)
+
+        self.assertIs(get_ref_index(buffer, changedtick=1), index)
+
+    def test_rebuilds_index_when_changedtick_changes(self):
+        buffer = Buffer(['look at [1].'])
+        index = get_ref_index(buffer, changedtick=1)
+
+        buffer[0] = 'look at [2].'
+
+        new_index = get_ref_index(buffer, changedtick=2)
+        self.assertIsNot(new_index, index)
+        self.assertEqual(new_index.occurrences[0].ref, Ref(2))
+
+    def test_does_not_cache_index_of_buffer_without_number(self):
+        buffer = ['look at [1].']
+        index = get_ref_index(buffer, changedtick=1)
+
+        self.assertIsNot(get_ref_index(buffer, changedtick=1), index)
+
+
+class TrackRowsTests(unittest.TestCase):
+    def test_scans_only_replaced_rows(self):
+        buffer = Buffer(['look at [1].', 'and [2].', '', '[1] URL1'])
+        track_rows(buffer)
+        get_ref_index(buffer, changedtick=1)
+
+        buffer[0] = 'look at [3].'
+        # Rows that were not reported as replaced are not scanned again.
+        buffer[1] = 'and [4].'
+        replace_rows(buffer, 0, 1, 1)
+
+        index = get_ref_index(buffer, changedtick=2)
+        self.assertEqual(
+            [occurrence.ref for occurrence in index.occurrences],
+            [Ref(3), Ref(2)]
+        )
+
+    def test_shifts_rows_after_inserted_rows(self):
+        buffer = Buffer(['look at [1].', '', '[1] URL1', '-- ', 'Signature'])
+        track_rows(buffer)
+        get_ref_index(buffer, changedtick=1)
+
+        buffer[1:1] = ['New [2].', 'Lines.']
+        replace_rows(buffer, 1, 1, 2)
+
+        index = get_ref_index(buffer, changedtick=2)
+        self.assertEqual(vars(index), vars(RefIndex(buffer[:])))
+
+    def test_scans_all_rows_when_number_of_rows_does_not_match(self):
+        buffer = Buffer(['look at [1].'])
+        track_rows(buffer)
+        get_ref_index(buffer, changedtick=1)
+
+        buffer[:] = ['look at [2].', 'and [3].']
+
+        index = get_ref_index(buffer, changedtick=2)
+        self.assertEqual(vars(index), vars(RefIndex(buffer[:])))
+
+
+class PrewarmRefIndexTests(unittest.TestCase):
+    def test_index_is_used_when_changedtick_is_same(self):
+        buffer = Buffer(['look at [1].'])
+        prewarm_ref_index(buffer, changedtick=1)
+
+        # Changes without changing changedtick are not reflected.
+        buffer[0] = 'look at [2].'
+
+        index = get_ref_index(buffer, changedtick=1)
+        self.assertEqual(index.occurrences[0].ref, Ref(1))
+
+    def test_index_is_not_used_when_changedtick_differs(self):
+        buffer = Buffer(['look at [1].'])
+        prewarm_ref_index(buffer, changedtick=1)
+
+        buffer[0] = 'look at [2].'
+
+        index = get_ref_index(buffer, changedtick=2)
+        self.assertEqual(index.occurrences[0].ref, Ref(2))
+
+    def test_does_not_rebuild_index_that_is_already_built(self):
+        buffer = Buffer(['look at [1].'])
+        index = get_ref_index(buffer, changedtick=1)
+
+        prewarm_ref_index(buffer, changedtick=1)
+
+        self.assertIs(get_ref_index(buffer, changedtick=1), index)
+
+
+class RefIndexCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp_dir.name
+        self.lines = [
+            'look at [2] and [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_indexes_equal(self, index, expected_index):
+        self.assertEqual(vars(index), vars(expected_index))
+
+    def test_cached_index_is_same_as_built_index(self):
+        index = RefIndex(self.lines)
+        write_cached_ref_index(index, self.lines, '/mail', self.cache_dir)
+
+        cached_index = read_cached_ref_index(
+            self.lines, '/mail', self.cache_dir
+        )
+
+        self.assert_indexes_equal(cached_index, index)
+
+    def test_returns_none_when_lines_differ(self):
+        write_cached_ref_index(
+            RefIndex(self.lines), self.lines, '/mail', self.cache_dir
+        )
+
+        cached_index = read_cached_ref_index(
+            ['look at [1].'], '/mail', self.cache_dir
+        )
+
+        self.assertIsNone(cached_index)
+
+    def test_returns_none_when_nothing_is_cached_for_path(self):
+        write_cached_ref_index(
+            RefIndex(self.lines), self.lines, '/mail', self.cache_dir
+        )
+
+        cached_index = read_cached_ref_index(
+            self.lines, '/other', self.cache_dir
+        )
+
+        self.assertIsNone(cached_index)
+
+    def test_returns_none_when_version_differs(self):
+        write_cached_ref_index(
+            RefIndex(self.lines), self.lines, '/mail', self.cache_dir
+        )
+        [name] = os.listdir(self.cache_dir)
+        cache_path = os.path.join(self.cache_dir, name)
+        with open(cache_path) as f:
+            data = json.load(f)
+        data['version'] = -1
+        with open(cache_path, 'w') as f:
+            json.dump(data, f)
+
+        cached_index = read_cached_ref_index(
+            self.lines, '/mail', self.cache_dir
+        )
+
+        self.assertIsNone(cached_index)
+
+    def test_returns_none_when_cached_index_is_corrupted(self):
+        write_cached_ref_index(
+            RefIndex(self.lines), self.lines, '/mail', self.cache_dir
+        )
+        [name] = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, name), 'w') as f:
+            f.write('{"vers')
+
+        cached_index = read_cached_ref_index(
+            self.lines, '/mail', self.cache_dir
+        )
+
+        self.assertIsNone(cached_index)
+
+    def test_least_recently_used_indexes_are_removed_over_size_limit(self):
+        index = RefIndex(self.lines)
+        for i, path in enumerate(['/mail1', '/mail2', '/mail3']):
+            write_cached_ref_index(
+                index, self.lines, path, self.cache_dir, size_limit=10 ** 6
+            )
+            # Make the order of use unambiguous.
+            for name in os.listdir(self.cache_dir):
+                name_path = os.path.join(self.cache_dir, name)
+                mtime = os.stat(name_path).st_mtime
+                os.utime(name_path, (mtime - 10, mtime - 10))
+        size = os.stat(
+            os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        ).st_size
+
+        read_cached_ref_index(self.lines, '/mail1', self.cache_dir)
+        write_cached_ref_index(
+            index, self.lines, '/mail4', self.cache_dir, size_limit=3 * size
+        )
+
+        self.assertIsNotNone(
+            read_cached_ref_index(self.lines, '/mail1', self.cache_dir)
+        )
+        self.assertIsNone(
+            read_cached_ref_index(self.lines, '/mail2', self.cache_dir)
+        )
+        self.assertIsNotNone(
+            read_cached_ref_index(self.lines, '/mail3', self.cache_dir)
+        )
+        self.assertIsNotNone(
+            read_cached_ref_index(self.lines, '/mail4', self.cache_dir)
+        )
+
+    def test_other_files_in_cache_dir_are_not_removed(self):
+        other_path = os.path.join(self.cache_dir, 'important.json')
+        with open(other_path, 'w') as f:
+            f.write('{}')
+        os.utime(other_path, (0, 0))
+
+        write_cached_ref_index(
+            RefIndex(self.lines), self.lines, '/mail', self.cache_dir,
+            size_limit=0
+        )
+
+        self.assertTrue(os.path.exists(other_path))
+
+    def test_temporary_file_is_removed_when_write_fails(self):
+        with mock.patch('json.dump', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                write_cached_ref_index(
+                    RefIndex(self.lines), self.lines, '/mail', self.cache_dir
+                )
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_loaded_index_is_used_by_get_ref_index(self):
+        buffer = Buffer(self.lines, number=1)
+        save_ref_index(buffer, 1, '/mail', self.cache_dir)
+        other_buffer = Buffer(self.lines, number=2)
+
+        loaded = load_ref_index(other_buffer, 5, '/mail', self.cache_dir)
+
+        self.assertTrue(loaded)
+        index = get_ref_index(other_buffer, 5)
+        self.assert_indexes_equal(index, RefIndex(self.lines))
+
+    def test_loaded_index_fills_in_scanned_rows_of_mail_body(self):
+        lines = ['look at [2].', 'and [1]', '', '[1] URL1', '[2] URL2']
+        save_ref_index(Buffer(lines, number=1), 1, '/mail', self.cache_dir)
+        buffer = Buffer(lines, number=2)
+        track_rows(buffer)
+        load_ref_index(buffer, 1, '/mail', self.cache_dir)
+
+        buffer[1] = 'and [3]'
+        replace_rows(buffer, 1, 2, 1)
+        with mock.patch.object(
+                vim_mail_refs, '_get_refs_in_line',
+                wraps=vim_mail_refs._get_refs_in_line) as get_refs_in_line:
+            index = get_ref_index(buffer, changedtick=2)
+
+        scanned_lines = [
+            call[0][0] for call in get_refs_in_line.call_args_list
+        ]
+        self.assertCountEqual(
+            scanned_lines, ['and [3]', '[1] URL1', '[2] URL2']
+        )
+        self.assert_indexes_equal(index, RefIndex(buffer[:]))
+
+    def test_load_returns_false_when_nothing_is_cached(self):
+        loaded = load_ref_index(self.lines, 1, '/mail', self.cache_dir)
+
+        self.assertFalse(loaded)
+
+
+class RefIndexFromMatchesTests(unittest.TestCase):
+    def get_matches(self, lines):
+        # The same matches as found by matchbufline() in the Vim script.
+        return [
+            (row, m.start(2), m.end(2), m.group(2), m.group(1) or '')
+            for row, line in enumerate(lines)
+            for m in re.finditer(r'(.)?(\[\d+\])(?!\[)', line)
+        ]
+
+    def assert_same_as_built_index(self, lines, signature_start=None):
+        index = RefIndex.from_matches(
+            lines, self.get_matches(lines), signature_start
+        )
+
+        self.assertEqual(vars(index), vars(RefIndex(lines)))
+
+    def test_index_is_same_as_built_index(self):
+        self.assert_same_as_built_index([
+            'look at [2], [1] and [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '',
+            '-- ',
+            'Signature [3]'
+        ], signature_start=5)
+
+    def test_skips_matches_that_are_not_references(self):
+        self.assert_same_as_built_index([
+            'a[1] ([2]) [3][4] é[5] [[6]',
+            '',
+            '[6] URL6'
+        ])
+
+    def test_does_not_read_lines_of_mail_body(self):
+        class GuardedBuffer(list):
+            def __getitem__(self, key):
+                if key == 0:
+                    raise AssertionError('line {} was read'.format(key))
+                return super().__getitem__(key)
+
+        buffer = GuardedBuffer(['look at [1].', '', '[1] URL1'])
+
+        index = RefIndex.from_matches(buffer, [(0, 8, 11, '[1]', ' ')])
+
+        self.assertEqual(index.occurrences, [RefOccurrence(0, 8, 11, Ref(1))])
+        self.assertEqual(index.refs_with_urls, [RefWithUrl(Ref(1), 'URL1')])
+
+    def test_index_ref_matches_caches_index(self):
+        buffer = Buffer(['look at [1].'])
+
+        index = index_ref_matches(
+            buffer, 1, [(0, 8, 11, '[1]', ' ')], signature_start=None
+        )
+
+        self.assertIs(get_ref_index(buffer, changedtick=1), index)
+
+    def test_fix_mail_refs_uses_index_instead_of_scanning_mail_body(self):
+        class GuardedBuffer(Buffer):
+            def __getitem__(self, key):
+                if key == 0:
+                    raise AssertionError('line {} was read'.format(key))
+                return super().__getitem__(key)
+
+        buffer = GuardedBuffer([
+            'look at [1].',
+            'and at [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3'
+        ])
+        index_ref_matches(
+            buffer, 1, [(0, 8, 11, '[1]', ' '), (1, 7, 10, '[3]', ' ')]
+        )
+
+        with mock.patch.object(vim_mail_refs, '_scan_refs') as scan_refs:
+            fix_mail_refs(buffer, cursor=(1, 0), changedtick=1)
+
+        scan_refs.assert_not_called()
+        self.assertEqual(
+            list(buffer),
+            ['look at [1].', 'and at [2].', '', '[1] URL1', '[2] URL3']
+        )
+
+
+class TracingTests(unittest.TestCase):
+    def tearDown(self):
+        stop_tracing()
+
+    def fix_mail_refs(self):
+        # Traced versions of functions are looked up in the module.
+        buffer = ['[2] [1]', '', '[1] A', '[2] B', '', '-- ', 'Signature']
+        vim_mail_refs.fix_mail_refs(buffer, (0, 0))
+
+    def test_records_nested_phases_of_command(self):
+        start_tracing()
+        self.fix_mail_refs()
+
+        events = {event['name']: event for event in stop_tracing()}
+
+        command = events['fix_mail_refs']
+        phase = events['_renumber_refs']
+        self.assertEqual(command['ph'], 'X')
+        self.assertGreaterEqual(phase['ts'], command['ts'])
+        self.assertLessEqual(
+            phase['ts'] + phase['dur'], command['ts'] + command['dur']
+        )
+        self.assertIn('_scan_refs', events)
+
+    def test_records_phases_that_are_context_managers(self):
+        start_tracing()
+        vim_mail_refs.add_ref(['look', '', '-- ', 'Signature'], (0, 0), 'URL')
+
+        events = {event['name']: event for event in stop_tracing()}
+
+        self.assertIn('_removed_signature', events)
+
+    def test_functions_are_not_changed_when_tracing_is_stopped(self):
+        fix = vim_mail_refs.fix_mail_refs
+
+        start_tracing()
+        self.assertIsNot(vim_mail_refs.fix_mail_refs, fix)
+        stop_tracing()
+
+        self.assertIs(vim_mail_refs.fix_mail_refs, fix)
+
+    def test_records_nothing_when_tracing_is_not_started(self):
+        self.fix_mail_refs()
+
+        self.assertEqual(stop_tracing(), [])
+
+    def test_writes_trace_in_chrome_trace_event_format(self):
+        start_tracing()
+        self.fix_mail_refs()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'trace.json')
+
+            events = stop_tracing(path)
+
+            with open(path) as f:
+                self.assertEqual(json.load(f)['traceEvents'], events)
+
+
+class GetUrlAtCursorTests(unittest.TestCase):
+    def test_returns_url_of_reference_under_cursor(self):
+        buffer = [
+            'look at [1] and [2].',
+            #                 ^
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        url = get_url_at_cursor(buffer, cursor=(0, 17))
+
+        self.assertEqual(url, 'URL2')
+
+    def test_returns_None_when_cursor_is_not_on_reference(self):
+        buffer = [
+            'look at [1].',
+            #  ^
+            '',
+            '[1] URL1'
+        ]
+
+        url = get_url_at_cursor(buffer, cursor=(0, 2))
+
+        self.assertIsNone(url)
+
+    def test_returns_None_when_reference_has_no_url(self):
+        buffer = [
+            'look at [3].',
+            #         ^
+            '',
+            '[1] URL1'
+        ]
+
+        url = get_url_at_cursor(buffer, cursor=(0, 9))
+
+        self.assertIsNone(url)
+
+
+class GetRefJumpTargetTests(unittest.TestCase):
+    def test_jumps_from_reference_to_its_url(self):
+        buffer = [
+            'look at [1] and [2].',
+            #                 ^
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        target = get_ref_jump_target(buffer, cursor=(0, 17))
+
+        self.assertEqual(target, (3, 0))
+
+    def test_jumps_from_url_to_first_use_of_reference(self):
+        buffer = [
+            'look at [1] and [2].',
+            'Also look at [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+            #     ^
+        ]
+
+        target = get_ref_jump_target(buffer, cursor=(4, 5))
+
+        self.assertEqual(target, (0, 16))
+
+    def test_returns_None_when_cursor_is_not_on_reference(self):
+        buffer = [
+            'look at [1].',
+            #  ^
+            '',
+            '[1] URL1'
+        ]
+
+        target = get_ref_jump_target(buffer, cursor=(0, 2))
+
+        self.assertIsNone(target)
+
+    def test_returns_None_when_reference_has_no_url(self):
+        buffer = [
+            'look at [2].',
+            #         ^
+            '',
+            '[1] URL1'
+        ]
+
+        target = get_ref_jump_target(buffer, cursor=(0, 9))
+
+        self.assertIsNone(target)
+
+    def test_returns_None_when_url_is_not_used(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+            # ^
+        ]
+
+        target = get_ref_jump_target(buffer, cursor=(3, 1))
+
+        self.assertIsNone(target)
+
+
+class GetRefUsagesTests(unittest.TestCase):
+    def test_returns_all_uses_of_reference_under_cursor(self):
+        buffer = [
+            'look at [1] and [2].',
+            #         ^
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        usages = get_ref_usages(buffer, cursor=(0, 9))
+
+        self.assertEqual(usages, (1, [(0, 8), (1, 13)]))
+
+    def test_returns_all_uses_of_reference_when_cursor_is_on_url(self):
+        buffer = [
+            'look at [1] and [2].',
+            'Also look at [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+            #   ^
+        ]
+
+        usages = get_ref_usages(buffer, cursor=(4, 3))
+
+        self.assertEqual(usages, (2, [(0, 16), (1, 13)]))
+
+    def test_returns_no_uses_when_cursor_is_not_on_reference(self):
+        buffer = [
+            'look at [1].',
+            #  ^
+            '',
+            '[1] URL1'
+        ]
+
+        usages = get_ref_usages(buffer, cursor=(0, 2))
+
+        self.assertEqual(usages, (None, []))
+
+
+class GetRefDiagnosticsTests(unittest.TestCase):
+    def test_returns_no_problems_when_references_are_ok(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+
+        diagnostics = get_ref_diagnostics(buffer)
+
+        self.assertEqual(diagnostics, RefDiagnostics([], []))
+
+    def test_returns_references_without_url(self):
+        buffer = [
+            'look at [1] and [3].',
+            'Also look at [3].',
+            '',
+            '[1] URL1'
+        ]
+
+        diagnostics = get_ref_diagnostics(buffer)
+
+        self.assertEqual(
+            diagnostics.dangling,
+            [
+                RefOccurrence(0, 16, 19, Ref(3)),
+                RefOccurrence(1, 13, 16, Ref(3))
+            ]
+        )
+
+    def test_returns_unused_urls(self):
+        buffer = [
+            'look at [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '',
+            '-- ',
+            'Signature [1]'
+        ]
+
+        diagnostics = get_ref_diagnostics(buffer)
+
+        self.assertEqual(
+            diagnostics.unused,
+            [
+                (2, RefWithUrl(Ref(1), 'URL1')),
+                (4, RefWithUrl(Ref(3), 'URL3'))
+            ]
+        )
+
+    def test_reflects_changed_lines(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+        get_ref_diagnostics(buffer, changedtick=1)
+
+        buffer[0] = 'look at [2].'
+
+        diagnostics = get_ref_diagnostics(buffer, changedtick=2)
+        self.assertEqual(
+            diagnostics,
+            RefDiagnostics(
+                [RefOccurrence(0, 8, 11, Ref(2))],
+                [(2, RefWithUrl(Ref(1), 'URL1'))]
+            )
+        )
+
+
+class GetRefStatsTests(unittest.TestCase):
+    def test_returns_zeros_when_there_are_no_references(self):
+        stats = get_ref_stats(['Hello!'])
+
+        self.assertEqual(stats, RefStats(0, 0, 0, 0, False))
+
+    def test_returns_correct_counts(self):
+        buffer = [
+            'look at [1] and [2].',
+            'Also look at [1] and [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[4] URL4'
+        ]
+
+        stats = get_ref_stats(buffer)
+
+        self.assertEqual(stats.total, 4)
+        self.assertEqual(stats.used, 3)
+        self.assertEqual(stats.defined, 3)
+        self.assertEqual(stats.dangling, 1)
+
+    def test_references_do_not_need_renumbering_when_they_are_ordered(self):
+        buffer = [
+            'look at [1] and [2].',
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        stats = get_ref_stats(buffer)
+
+        self.assertFalse(stats.needs_renumbering)
+
+    def test_references_need_renumbering_when_they_are_not_ordered(self):
+        buffer = [
+            'look at [2] and [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        stats = get_ref_stats(buffer)
+
+        self.assertTrue(stats.needs_renumbering)
+
+    def test_references_need_renumbering_when_urls_are_not_ordered(self):
+        buffer = [
+            'look at [1] and [2].',
+            '',
+            '[2] URL2',
+            '[1] URL1'
+        ]
+
+        stats = get_ref_stats(buffer)
+
+        self.assertTrue(stats.needs_renumbering)
+
+    def test_reuses_stats_when_changedtick_is_same(self):
+        buffer = Buffer(['look at [1].'])
+
+        stats = get_ref_stats(buffer, changedtick=1)
+
+        self.assertIs(get_ref_stats(buffer, changedtick=1), stats)
+
+
+class ExtractMailRefsTests(unittest.TestCase):
+    def test_does_nothing_when_there_are_no_urls(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+        orig_buffer = buffer[:]
+
+        new_cursor = extract_mail_refs(buffer, cursor=(0, 2))
+
+        self.assertEqual(buffer, orig_buffer)
+        self.assertEqual(new_cursor, (0, 2))
+
+    def test_replaces_urls_with_references(self):
+        buffer = [
+            'look at https://a.com/x and http://b.com.',
+            'Also look at <ftp://c.com/file>!'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [2].',
+                'Also look at [3]!',
+                '',
+                '[1] https://a.com/x',
+                '[2] http://b.com',
+                '[3] ftp://c.com/file'
+            ]
+        )
+
+    def test_replaces_urls_that_are_all_in_ref_list(self):
+        buffer = [
+            'look at https://a.com and [2].',
+            '',
+            '[1] https://a.com',
+            '[2] https://b.com'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [2].',
+                '',
+                '[1] https://a.com',
+                '[2] https://b.com'
+            ]
+        )
+
+    def test_reuses_references_for_same_urls(self):
+        buffer = [
+            'look at [1] and https://b.com.',
+            'Also look at https://a.com and https://b.com.',
+            '',
+            '[1] https://a.com'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [2].',
+                'Also look at [1] and [2].',
+                '',
+                '[1] https://a.com',
+                '[2] https://b.com'
+            ]
+        )
+
+    def test_new_references_do_not_clash_with_used_references(self):
+        buffer = [
+            'look at [3] and https://b.com.',
+            '',
+            '[1] https://a.com'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [3] and [4].',
+                '',
+                '[1] https://a.com',
+                '[4] https://b.com'
+            ]
+        )
+
+    def test_keeps_parentheses_that_are_part_of_url(self):
+        buffer = ['(see https://w.org/Vim_(editor))']
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                '(see [1])',
+                '',
+                '[1] https://w.org/Vim_(editor)'
+            ]
+        )
+
+    def test_separates_reference_from_preceding_word(self):
+        buffer = ['see:https://a.com and (x)https://b.com']
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(buffer[0], 'see:[1] and (x) [2]')
+
+    def test_reference_list_is_placed_before_signature(self):
+        buffer = [
+            'look at https://a.com',
+            '-- ',
+            'Signature https://me.com'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1]',
+                '',
+                '[1] https://a.com',
+                '',
+                '-- ',
+                'Signature https://me.com'
+            ]
+        )
+
+    def test_cursor_stays_at_same_text(self):
+        buffer = [
+            'look at https://a.com/long/url and here.',
+            #                                   ^
+        ]
+
+        new_cursor = extract_mail_refs(buffer, cursor=(0, 35))
+
+        self.assertEqual(buffer[0], 'look at [1] and here.')
+        #                                            ^
+        self.assertEqual(new_cursor, (0, 16))
+
+    def test_reuses_references_for_equivalent_urls(self):
+        buffer = [
+            'look at https://a.com/?utm_source=x and https://A.com/.',
+            '',
+            '[1] https://a.com'
+        ]
+
+        extract_mail_refs(buffer, cursor=(0, 0))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [1].',
+                '',
+                '[1] https://a.com'
+            ]
+        )
+
+    def test_cursor_inside_url_is_moved_to_reference(self):
+        buffer = [
+            'look at https://a.com/long/url and here.',
+            #                   ^
+        ]
+
+        new_cursor = extract_mail_refs(buffer, cursor=(0, 19))
+
+        self.assertEqual(new_cursor, (0, 8))
+
+
+class PasteMailRefsTests(unittest.TestCase):
+    def test_pastes_lines_without_references_below_cursor_line(self):
+        buffer = [
+            'line 1',
+            'line 2'
+        ]
+
+        new_cursor = paste_mail_refs(buffer, (0, 3), ['pasted'])
+
+        self.assertEqual(buffer, ['line 1', 'pasted', 'line 2'])
+        self.assertEqual(new_cursor, (1, 0))
+
+    def test_remaps_pasted_references_to_existing_urls(self):
+        buffer = [
+            'look at [1] and [2].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        paste_mail_refs(buffer, (0, 0), [
+            'pasted [1] and [2]',
+            '',
+            '[1] URL2',
+            '[2] URL1'
+        ])
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [2].',
+                'pasted [2] and [1]',
+                '',
+                '[1] URL1',
+                '[2] URL2'
+            ]
+        )
+
+    def test_ignores_further_urls_of_pasted_reference(self):
+        buffer = ['look at [1].', '', '[1] http://c']
+
+        paste_mail_refs(
+            buffer, (0, 0), ['x [1]', '', '[1] http://a', '[1] http://b']
+        )
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'x [2]',
+                '',
+                '[1] http://c',
+                '[2] http://a'
+            ]
+        )
+
+    def test_gives_new_references_to_new_urls(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1',
+            '',
+            '-- ',
+            'Signature'
+        ]
+
+        paste_mail_refs(buffer, (0, 0), [
+            'pasted [1], [2] and [1]',
+            '',
+            '[1] URL3',
+            '[2] URL1'
+        ])
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'pasted [2], [1] and [2]',
+                '',
+                '[1] URL1',
+                '[2] URL3',
+                '',
+                '-- ',
+                'Signature'
+            ]
+        )
+
+    def test_adds_reference_list_when_there_is_none(self):
+        buffer = [
+            'Hi,'
+        ]
+
+        paste_mail_refs(buffer, (0, 0), ['pasted [1]', '', '[1] URL1'])
+
+        self.assertEqual(buffer, ['Hi,', 'pasted [1]', '', '[1] URL1'])
+
+    def test_keeps_references_without_url(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+
+        paste_mail_refs(buffer, (0, 0), ['pasted [1] and [7]', '', '[1] URL2'])
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'pasted [2] and [7]',
+                '',
+                '[1] URL1',
+                '[2] URL2'
+            ]
+        )
+
+    def test_pastes_into_mail_body_when_cursor_is_on_reference_list(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+
+        new_cursor = paste_mail_refs(buffer, (2, 0), ['pasted [1]', '',
+                                                      '[1] URL1'])
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'pasted [1]',
+                '',
+                '[1] URL1'
+            ]
+        )
+        self.assertEqual(new_cursor, (1, 0))
+
+    def test_changes_buffer_by_single_edit(self):
+        class Buffer(list):
+            def __setitem__(self, key, value):
+                self.setitem_calls = getattr(self, 'setitem_calls', 0) + 1
+                super().__setitem__(key, value)
+
+        buffer = Buffer(['look at [1].', '', '[1] URL1'])
+
+        paste_mail_refs(buffer, (0, 0), ['pasted [1]', '', '[1] URL2'])
+
+        self.assertEqual(buffer.setitem_calls, 1)
+
+
+class GetLinesEditTests(unittest.TestCase):
+    def test_returns_None_when_lines_are_same(self):
+        self.assertIsNone(get_lines_edit(['a', 'b'], ['a', 'b']))
+
+    def test_returns_only_changed_lines(self):
+        edit = get_lines_edit(['a', 'b', 'c'], ['a', 'x', 'y', 'c'])
+
+        self.assertEqual(edit, [1, 2, ['x', 'y']])
+
+    def test_returns_correct_edit_when_lines_are_removed(self):
+        edit = get_lines_edit(['a', 'b', 'c'], ['a'])
+
+        self.assertEqual(edit, [1, 3, []])
+
+
+class FixMailRefsInRangeTests(unittest.TestCase):
+    def test_does_nothing_when_refs_in_range_are_ordered(self):
+        buffer = [
+            'look at [2].',
+            'Also look at [1] and [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '[4] URL4'
+        ]
+        orig_buffer = buffer[:]
+
+        new_cursor = fix_mail_refs(buffer, cursor=(1, 2), line_range=(1, 2))
+
+        self.assertEqual(buffer, orig_buffer)
+        self.assertEqual(new_cursor, (1, 2))
+
+    def test_renumbers_only_refs_used_in_range(self):
+        buffer = [
+            'look at [1].',
+            'Also look at [4] and [2].',
+            #                       ^
+            'And finally at [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2',
+            '[3] URL3',
+            '[4] URL4',
+            '[5] URL5'
+        ]
+
+        new_cursor = fix_mail_refs(buffer, cursor=(1, 23), line_range=(1, 2))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1].',
+                'Also look at [2] and [4].',
+                #                       ^
+                'And finally at [3].',
+                '',
+                '[1] URL1',
+                '[2] URL4',
+                '[3] URL3',
+                '[4] URL2',
+                '[5] URL5'
+            ]
+        )
+        self.assertEqual(new_cursor, (1, 23))
+
+    def test_updates_uses_of_renumbered_refs_outside_of_range(self):
+        buffer = [
+            'look at [2] and [1].',
+            'Also look at [1].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        fix_mail_refs(buffer, cursor=(0, 0), line_range=(0, 1))
+
+        self.assertEqual(
+            buffer,
+            [
+                'look at [1] and [2].',
+                'Also look at [2].',
+                '',
+                '[1] URL2',
+                '[2] URL1'
+            ]
+        )
+
+    def test_cursor_is_moved_when_refs_before_it_change_length(self):
+        buffer = [
+            'look at [10] and [9].',
+            #                   ^
+            '',
+            '[9] URL9',
+            '[10] URL10'
+        ]
+
+        new_cursor = fix_mail_refs(buffer, cursor=(0, 19), line_range=(0, 1))
+
+        self.assertEqual(buffer[0], 'look at [9] and [10].')
+        #                                              ^
+        self.assertEqual(new_cursor, (0, 18))
+
+
+class CheckMailRefsTests(unittest.TestCase):
+    def test_returns_no_problems_when_references_are_ok(self):
+        buffer = [
+            'look at [1].',
+            '',
+            '[1] URL1'
+        ]
+
+        problems = check_mail_refs(buffer)
+
+        self.assertEqual(problems, [])
+
+    def test_returns_references_without_url_and_unused_urls(self):
+        buffer = [
+            'look at [1] and [3].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        problems = check_mail_refs(buffer)
+
+        self.assertEqual(
+            problems,
+            [
+                (0, 16, 'reference [3] has no URL'),
+                (3, 0, 'URL [2] is not used')
+            ]
+        )
+
+    def test_checks_only_references_in_range(self):
+        buffer = [
+            'look at [3].',
+            'Also look at [1] and [4].',
+            '',
+            '[1] URL1',
+            '[2] URL2'
+        ]
+
+        problems = check_mail_refs(buffer, line_range=(1, 2))
+
+        self.assertEqual(problems, [(1, 21, 'reference [4] has no URL')])